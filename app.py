@@ -1,14 +1,35 @@
-from flask import Flask, jsonify, render_template, request, send_file, redirect, url_for
+from flask import Flask, jsonify, render_template, request, send_file, redirect, url_for, g, has_request_context
 from collections import OrderedDict
+from dataclasses import dataclass
 import sqlite3
 from pathlib import Path
 from datetime import datetime
 import io
-from pdfgen import build_entrega_pdf
+import base64
+import hashlib
+import functools
+import csv
+import json
+import click
+import multiprocessing
+import zlib
+import zipfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import uuid
+from pdfgen import (
+    render_entrega_pdf, render_entregas_pdf, build_estado_cuenta_pdf, build_reporte_cuentas_pdf,
+    guardar_archivo, guardar_pdf, ruta_logo, PLANTILLA_VERSION, LOGO_MM,
+)
+import pdfrecursos
 import re
+import os
+import queue
+import threading
+import time
 
-# Ruta a la base de datos
-DB_PATH = Path("3d_iego.db")
+# Ruta a la base de datos (DB_PATH en el entorno para usar otra, p. ej. en pruebas)
+DB_PATH = Path(os.environ.get("DB_PATH", "3d_iego.db"))
 
 # Flask config
 app = Flask(__name__, template_folder="templates", static_folder="static")
@@ -18,76 +39,1606 @@ app = Flask(__name__, template_folder="templates", static_folder="static")
 # UTILIDADES BASE DE DATOS
 # ---------------------------
 
+# Pool de conexiones (configurable por variables de entorno)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+
+
+class ConexionPool(sqlite3.Connection):
+    """
+    Conexión SQLite que, al hacer close(), vuelve al pool en vez de cerrarse.
+    Así las rutas siguen usando conn.close() como siempre.
+    """
+
+    def close(self):
+        pool = getattr(self, "_pool", None)
+        if pool is None:
+            super().close()
+        else:
+            pool.devolver(self)
+
+    def cerrar_real(self):
+        self._pool = None
+        super().close()
+
+
+class PoolConexiones:
+    """
+    Pool acotado de conexiones SQLite reutilizables.
+    Los PRAGMAs se aplican una sola vez, al abrir cada conexión.
+    """
+
+    def __init__(self, db_path, tamano=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.db_path = db_path
+        self.tamano = max(1, int(tamano))
+        self.timeout = timeout
+        self._libres = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.trazador = None
+        self._creadas = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "esperas": 0,
+            "espera_total_ms": 0.0,
+            "espera_max_ms": 0.0,
+            "descartadas": 0,
+        }
+
+    def _abrir(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+            check_same_thread=False,
+            factory=ConexionPool,
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = {-abs(DB_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+        conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn._pool = self
+        return conn
+
+    def obtener(self):
+        try:
+            conn = self._libres.get_nowait()
+            with self._lock:
+                self._stats["hits"] += 1
+        except queue.Empty:
+            with self._lock:
+                crear = self._creadas < self.tamano
+                if crear:
+                    self._creadas += 1
+                    self._stats["misses"] += 1
+
+            if crear:
+                try:
+                    conn = self._abrir()
+                except Exception:
+                    with self._lock:
+                        self._creadas -= 1
+                    raise
+            else:
+                t0 = time.perf_counter()
+                try:
+                    conn = self._libres.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("Pool de conexiones agotado")
+                espera_ms = (time.perf_counter() - t0) * 1000.0
+                with self._lock:
+                    self._stats["hits"] += 1
+                    self._stats["esperas"] += 1
+                    self._stats["espera_total_ms"] += espera_ms
+                    self._stats["espera_max_ms"] = max(self._stats["espera_max_ms"], espera_ms)
+
+        conn._en_pool = False
+        # Marca de este préstamo: quien la guardó puede saber si la conexión sigue siendo suya.
+        conn._prestamo = object()
+        conn.row_factory = sqlite3.Row
+        conn.set_trace_callback(self.trazador)
+        return conn
+
+    def devolver(self, conn):
+        # Evita que un doble close() meta dos veces la misma conexión.
+        if getattr(conn, "_en_pool", False):
+            return
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.cerrar_real()
+            with self._lock:
+                self._creadas -= 1
+                self._stats["descartadas"] += 1
+            return
+
+        conn._en_pool = True
+        self._libres.put(conn)
+
+    def estadisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["tamano"] = self.tamano
+            stats["abiertas"] = self._creadas
+        stats["libres"] = self._libres.qsize()
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / total) if total else 0.0
+        stats["espera_media_ms"] = (
+            stats["espera_total_ms"] / stats["esperas"] if stats["esperas"] else 0.0
+        )
+        return stats
+
+    def cerrar_todo(self):
+        while True:
+            try:
+                conn = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            conn.cerrar_real()
+            with self._lock:
+                self._creadas -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_esquema_listo = False
+
+
+def obtener_pool(migrar=False):
+    """
+    Devuelve el pool del proceso. La primera vez que se pide con migrar=True
+    aplica las migraciones pendientes, una sola vez por proceso.
+    """
+    global _pool, _esquema_listo
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PoolConexiones(DB_PATH)
+    if migrar and not _esquema_listo:
+        with _pool_lock:
+            if not _esquema_listo:
+                conn = _pool.obtener()
+                try:
+                    aplicar_migraciones(conn)
+                finally:
+                    conn.close()
+                _esquema_listo = True
+    return _pool
+
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = obtener_pool(migrar=True).obtener()
+    if has_request_context():
+        # Se registra para devolverla al pool aunque la ruta falle antes del close().
+        g.setdefault("_conexiones", []).append((conn, conn._prestamo))
     return conn
 
 
-def asegurar_columnas_entregas(cur, conn):
+@app.teardown_request
+def _devolver_conexiones(exc=None):
+    for conn, prestamo in g.pop("_conexiones", []):
+        # Si la ruta ya la cerró, otro hilo puede tenerla prestada: solo se devuelve
+        # si sigue siendo el mismo préstamo que tomó este request.
+        if conn._prestamo is prestamo and not conn._en_pool:
+            conn.close()
+
+
+# ---------------------------
+# ESQUEMA Y MIGRACIONES
+# ---------------------------
+
+def _columnas_tabla(cur, tabla):
+    cur.execute(f"PRAGMA table_info({tabla})")
+    return {f[1] for f in cur.fetchall()}
+
+
+def _agregar_columna(cur, tabla, columna, definicion):
+    if columna not in _columnas_tabla(cur, tabla):
+        cur.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+
+def _migracion_tablas_base(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS productos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            tipo_pieza TEXT,
+            subtipo TEXT,
+            stock INTEGER NOT NULL DEFAULT 0,
+            precio REAL NOT NULL DEFAULT 0,
+            precio_revendedor REAL NOT NULL DEFAULT 0,
+            notas TEXT,
+            activo INTEGER NOT NULL DEFAULT 1,
+            created_at TEXT,
+            updated_at TEXT
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS revendedores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            contacto TEXT,
+            notas TEXT,
+            saldo_inicial REAL NOT NULL DEFAULT 0,
+            activo INTEGER NOT NULL DEFAULT 1,
+            created_at TEXT,
+            updated_at TEXT
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS entregas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha DATE NOT NULL,
+            tipo_cliente TEXT NOT NULL,
+            revendedor_id INTEGER,
+            cliente_nombre TEXT,
+            cantidad_total INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS entrega_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entrega_id INTEGER NOT NULL,
+            producto_id INTEGER,
+            nombre_pieza TEXT NOT NULL,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            precio_unitario REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pagos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha DATE NOT NULL,
+            tipo_cliente TEXT NOT NULL,
+            revendedor_id INTEGER,
+            nombre_particular TEXT,
+            descripcion TEXT,
+            categoria_precio TEXT NOT NULL,
+            monto REAL NOT NULL,
+            division INTEGER NOT NULL,
+            costo REAL NOT NULL,
+            ganancia REAL NOT NULL,
+            ganancia_individual REAL NOT NULL,
+            mes_clave TEXT NOT NULL
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS gastos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha DATE NOT NULL,
+            tipo TEXT NOT NULL,
+            descripcion TEXT,
+            monto REAL NOT NULL,
+            mes_clave TEXT NOT NULL
+        );
+    """)
+
+
+def _migracion_columnas_extra(cur):
+    # Entrega / devolución
+    _agregar_columna(cur, "entregas", "tipo_movimiento", "TEXT NOT NULL DEFAULT 'entrega'")
+    _agregar_columna(cur, "entregas", "descripcion", "TEXT")
+    # Gastos de filamento
+    _agregar_columna(cur, "gastos", "es_filamento", "INTEGER DEFAULT 0")
+
+
+# Índices para los caminos calientes (dashboard, cuentas, saldos y movimientos).
+# Elegidos a partir de EXPLAIN QUERY PLAN; ver auditar_planes().
+INDICES = [
+    ("idx_pagos_mes_fecha", "pagos (mes_clave, fecha, id)"),
+    ("idx_pagos_fecha", "pagos (fecha, monto, costo, ganancia_individual)"),
+    ("idx_pagos_revendedor", "pagos (revendedor_id, tipo_cliente, fecha, monto)"),
+    ("idx_gastos_mes_tipo", "gastos (mes_clave, tipo, es_filamento, monto)"),
+    ("idx_gastos_tipo_fecha", "gastos (tipo, fecha, es_filamento, monto)"),
+    ("idx_entregas_revendedor", "entregas (revendedor_id, tipo_cliente, fecha, total)"),
+    ("idx_entregas_fecha", "entregas (fecha)"),
+    ("idx_entrega_items_entrega", "entrega_items (entrega_id)"),
+    ("idx_revendedores_activo_nombre", "revendedores (activo, nombre)"),
+]
+
+
+def _migracion_indices(cur):
+    for nombre, definicion in INDICES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {nombre} ON {definicion}")
+
+
+def _migracion_indices_resumen(cur):
+    # Cubren las pasadas únicas de calcular_resumen_cuentas() sobre pagos y gastos.
+    cur.execute("DROP INDEX IF EXISTS idx_pagos_fecha")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pagos_resumen
+        ON pagos (fecha, mes_clave, monto, costo, ganancia_individual)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_gastos_resumen
+        ON gastos (fecha, tipo, es_filamento, mes_clave, monto)
+    """)
+
+
+def _migracion_saldos_revendedores(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS revendedor_saldos (
+            revendedor_id INTEGER PRIMARY KEY,
+            total_entregas REAL NOT NULL DEFAULT 0,
+            total_pagos REAL NOT NULL DEFAULT 0,
+            updated_at TEXT
+        );
+    """)
+    reconstruir_saldos(cur)
+
+
+def _migracion_resumen_mensual(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS resumen_mensual (
+            mes_clave TEXT PRIMARY KEY,
+            monto REAL NOT NULL DEFAULT 0,
+            costo REAL NOT NULL DEFAULT 0,
+            ganancia REAL NOT NULL DEFAULT 0,
+            ganancia_individual REAL NOT NULL DEFAULT 0,
+            gastos REAL NOT NULL DEFAULT 0,
+            filamento REAL NOT NULL DEFAULT 0,
+            pagos_ayudante REAL NOT NULL DEFAULT 0,
+            n_pagos INTEGER NOT NULL DEFAULT 0,
+            n_gastos INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    reconstruir_resumen_mensual(cur)
+
+
+def _migracion_indice_entregas_revendedor_fecha(cur):
+    # Historial por revendedor ordenado por fecha (listado paginado y movimientos).
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_entregas_revendedor_fecha
+        ON entregas (revendedor_id, fecha)
+    """)
+
+
+def _migracion_stock_movimientos(cur):
+    # Journal append-only de cambios de stock + snapshots periódicos para reconstruir
+    # el stock a cualquier fecha. El historial arranca con el stock actual ('inicial').
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stock_movimientos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+            producto_id INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            motivo TEXT NOT NULL,
+            entrega_id INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_stock_movimientos_producto
+        ON stock_movimientos (producto_id, id)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            ultimo_movimiento_id INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_stock_snapshots_fecha
+        ON stock_snapshots (fecha)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+            snapshot_id INTEGER NOT NULL,
+            producto_id INTEGER NOT NULL,
+            stock INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_id, producto_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        INSERT INTO stock_movimientos (producto_id, delta, motivo)
+        SELECT id, stock, 'inicial'
+        FROM productos
+        WHERE IFNULL(stock, 0) != 0
+    """)
+    tomar_snapshot_stock(cur)
+
+
+def _migracion_idempotencia(cur):
+    # Respuestas guardadas por Idempotency-Key (POST de entregas y devoluciones).
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            ruta TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            huella TEXT NOT NULL,
+            estado INTEGER,
+            respuesta TEXT,
+            creado REAL NOT NULL,
+            PRIMARY KEY (ruta, clave)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_idempotencia_creado
+        ON idempotencia (creado)
+    """)
+
+
+def _migracion_meses_cerrados(cur):
+    # Totales congelados de los meses cerrados (mismas columnas que resumen_mensual).
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS meses_cerrados (
+            mes_clave TEXT PRIMARY KEY,
+            cerrado_en TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+            monto REAL NOT NULL DEFAULT 0,
+            costo REAL NOT NULL DEFAULT 0,
+            ganancia REAL NOT NULL DEFAULT 0,
+            ganancia_individual REAL NOT NULL DEFAULT 0,
+            gastos REAL NOT NULL DEFAULT 0,
+            filamento REAL NOT NULL DEFAULT 0,
+            pagos_ayudante REAL NOT NULL DEFAULT 0,
+            n_pagos INTEGER NOT NULL DEFAULT 0,
+            n_gastos INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+
+# (versión, descripción, función). Nunca reordenar ni editar una ya publicada:
+# los cambios nuevos van siempre al final con la versión siguiente.
+MIGRACIONES = [
+    (1, "Tablas base", _migracion_tablas_base),
+    (2, "Columnas tipo_movimiento/descripcion en entregas y es_filamento en gastos", _migracion_columnas_extra),
+    (3, "Índices de consultas frecuentes", _migracion_indices),
+    (4, "Saldos materializados de revendedores", _migracion_saldos_revendedores),
+    (5, "Índices cubrientes para el resumen de cuentas", _migracion_indices_resumen),
+    (6, "Resumen mensual de pagos y gastos", _migracion_resumen_mensual),
+    (7, "Índice de entregas por revendedor y fecha", _migracion_indice_entregas_revendedor_fecha),
+    (8, "Journal de movimientos de stock y snapshots", _migracion_stock_movimientos),
+    (9, "Respuestas por Idempotency-Key", _migracion_idempotencia),
+    (10, "Cierre de mes con totales congelados", _migracion_meses_cerrados),
+]
+
+
+def version_esquema(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            aplicada_en TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+    """)
+    cur.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version")
+    return int(cur.fetchone()[0])
+
+
+def aplicar_migraciones(conn):
+    """
+    Aplica en orden las migraciones pendientes, cada una en su propia transacción.
+    Devuelve la lista de versiones aplicadas.
+    """
+    aplicadas = []
+    actual = version_esquema(conn)
+
+    for version, descripcion, funcion in MIGRACIONES:
+        if version <= actual:
+            continue
+
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Otro proceso pudo haberla aplicado mientras esperábamos el lock.
+            cur.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cur.fetchone():
+                conn.rollback()
+                continue
+
+            funcion(cur)
+            cur.execute(
+                "INSERT INTO schema_version (version, descripcion) VALUES (?, ?)",
+                (version, descripcion),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        aplicadas.append(version)
+
+    return aplicadas
+
+
+@app.cli.command("migrar")
+def cli_migrar():
+    """Aplica las migraciones pendientes del esquema."""
+    conn = obtener_pool().obtener()
+    try:
+        aplicadas = aplicar_migraciones(conn)
+        version = version_esquema(conn)
+    finally:
+        conn.close()
+
+    if aplicadas:
+        print(f"Migraciones aplicadas: {', '.join(str(v) for v in aplicadas)}")
+    print(f"Versión de esquema: {version}")
+
+
+def _rutas_auditadas(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM revendedores WHERE activo = 1")
+    rev_id = int(cur.fetchone()[0]) or 1
+    return [
+        "/",
+        "/cuentas",
+        "/api/revendedores",
+        f"/api/revendedores/{rev_id}/movimientos",
+    ]
+
+
+# Tablas de resumen con una fila por mes: recorrerlas enteras es lo esperado.
+TABLAS_RESUMEN = {"resumen_mensual", "meses_cerrados"}
+
+
+def auditar_planes():
+    """
+    Ejecuta las rutas calientes capturando sus SELECT y pasa cada uno por
+    EXPLAIN QUERY PLAN. Devuelve [(sql, detalle)] de los pasos que recorren
+    una tabla completa (SCAN sin índice).
+    """
+    pool = obtener_pool(migrar=True)
+    capturadas = []
+
+    conn = pool.obtener()
+    try:
+        rutas = _rutas_auditadas(conn)
+    finally:
+        conn.close()
+
+    # Sin esto el dashboard saldría de la cache y no se verían sus consultas.
+    cache_dashboard.invalidar()
+
+    pool.trazador = capturadas.append
+    try:
+        cliente = app.test_client()
+        for url in rutas:
+            cliente.get(url)
+    finally:
+        pool.trazador = None
+
+    consultas = []
+    for sql in capturadas:
+        if re.match(r"^\s*(SELECT|WITH)\b", sql, re.IGNORECASE) and sql not in consultas:
+            consultas.append(sql)
+
+    problemas = []
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        for sql in consultas:
+            ctes = {n.lower() for n in re.findall(r"(\w+)\s+AS\s*\(", sql, re.IGNORECASE)}
+            for fila in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+                detalle = fila[3]
+                m = re.match(r"SCAN (\S+)", detalle)
+                if not m or "INDEX" in detalle:
+                    continue
+                objeto = m.group(1)
+                if objeto == "CONSTANT" or objeto.startswith("(") or objeto.lower() in ctes:
+                    continue
+                if objeto in TABLAS_RESUMEN:
+                    continue
+                problemas.append((" ".join(sql.split()), detalle))
+    finally:
+        conn.close()
+
+    return problemas
+
+
+@app.cli.command("verificar-indices")
+def cli_verificar_indices():
+    """Falla si alguna consulta caliente hace un full table scan."""
+    problemas = auditar_planes()
+    for sql, detalle in problemas:
+        print(f"{detalle}\n    {sql}\n")
+    if problemas:
+        raise SystemExit(1)
+    print("OK: ninguna consulta caliente recorre una tabla completa.")
+
+
+# ---------------------------
+# SALDOS DE REVENDEDORES (materializados)
+# ---------------------------
+
+def _en_lotes(valores, tamano=500):
+    valores = list(valores)
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+_ORIGEN_SALDOS = {
+    # tabla -> (columna de importe, columna de revendedor_saldos)
+    "entregas": ("total", "total_entregas"),
+    "pagos": ("monto", "total_pagos"),
+}
+
+
+def acumular_saldos(cur, tabla, ids, signo):
+    """
+    Suma (signo=1) o resta (signo=-1) al saldo materializado las filas de
+    entregas/pagos indicadas. Se llama dentro de la misma transacción que el
+    INSERT/UPDATE/DELETE: con +1 después de escribir y con -1 antes de borrar.
+    """
+    importe, destino = _ORIGEN_SALDOS[tabla]
+
+    for lote in _en_lotes(ids):
+        placeholders = ",".join("?" for _ in lote)
+        cur.execute(f"""
+            INSERT INTO revendedor_saldos (revendedor_id, {destino}, updated_at)
+            SELECT revendedor_id, ? * COALESCE(SUM({importe}), 0), datetime('now')
+            FROM {tabla}
+            WHERE id IN ({placeholders})
+              AND tipo_cliente = 'revendedor'
+              AND revendedor_id IS NOT NULL
+            GROUP BY revendedor_id
+            ON CONFLICT(revendedor_id) DO UPDATE SET
+                {destino} = {destino} + excluded.{destino},
+                updated_at = excluded.updated_at
+        """, [signo, *lote])
+
+
+def _saldos_desde_historial(cur):
+    cur.execute("""
+        SELECT
+            revendedor_id,
+            SUM(total_entregas) AS total_entregas,
+            SUM(total_pagos) AS total_pagos
+        FROM (
+            SELECT revendedor_id, SUM(total) AS total_entregas, 0 AS total_pagos
+            FROM entregas
+            WHERE tipo_cliente = 'revendedor' AND revendedor_id IS NOT NULL
+            GROUP BY revendedor_id
+            UNION ALL
+            SELECT revendedor_id, 0, SUM(monto)
+            FROM pagos
+            WHERE tipo_cliente = 'revendedor' AND revendedor_id IS NOT NULL
+            GROUP BY revendedor_id
+        )
+        GROUP BY revendedor_id
+    """)
+    return {
+        int(f[0]): (float(f[1] or 0), float(f[2] or 0))
+        for f in cur.fetchall()
+    }
+
+
+def reconstruir_saldos(cur):
+    """
+    Recalcula revendedor_saldos desde cero a partir de entregas y pagos.
+    """
+    saldos = _saldos_desde_historial(cur)
+    cur.execute("DELETE FROM revendedor_saldos")
+    cur.executemany("""
+        INSERT INTO revendedor_saldos (revendedor_id, total_entregas, total_pagos, updated_at)
+        VALUES (?, ?, ?, datetime('now'))
+    """, [(rev_id, e, p) for rev_id, (e, p) in saldos.items()])
+    return len(saldos)
+
+
+def verificar_saldos(cur, tolerancia=0.005):
+    """
+    Compara revendedor_saldos con lo que da el historial completo.
+    Devuelve [(revendedor_id, materializado, esperado)] de los que no coinciden.
+    """
+    esperados = _saldos_desde_historial(cur)
+
+    cur.execute("SELECT revendedor_id, total_entregas, total_pagos FROM revendedor_saldos")
+    materializados = {
+        int(f[0]): (float(f[1] or 0), float(f[2] or 0))
+        for f in cur.fetchall()
+    }
+
+    diferencias = []
+    for rev_id in sorted(set(esperados) | set(materializados)):
+        actual = materializados.get(rev_id, (0.0, 0.0))
+        esperado = esperados.get(rev_id, (0.0, 0.0))
+        if any(abs(a - b) > tolerancia for a, b in zip(actual, esperado)):
+            diferencias.append((rev_id, actual, esperado))
+    return diferencias
+
+
+@app.cli.command("reconstruir-saldos")
+def cli_reconstruir_saldos():
+    """Recalcula los saldos materializados de revendedores."""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        n = reconstruir_saldos(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Saldos reconstruidos: {n} revendedores")
+
+
+@app.cli.command("verificar-saldos")
+def cli_verificar_saldos():
+    """Falla si los saldos materializados no coinciden con el historial."""
+    conn = get_conn()
+    try:
+        diferencias = verificar_saldos(conn.cursor())
+    finally:
+        conn.close()
+
+    for rev_id, actual, esperado in diferencias:
+        print(f"Revendedor {rev_id}: materializado (entregas, pagos)={actual} esperado={esperado}")
+    if diferencias:
+        raise SystemExit(1)
+    print("OK: saldos consistentes.")
+
+
+# ---------------------------
+# RESUMEN MENSUAL (pagos + gastos por mes)
+# ---------------------------
+
+_SQL_RESUMEN_PAGOS = """
+    SELECT
+        mes_clave,
+        COALESCE(SUM(monto), 0) AS monto,
+        COALESCE(SUM(costo), 0) AS costo,
+        COALESCE(SUM(ganancia), 0) AS ganancia,
+        COALESCE(SUM(ganancia_individual), 0) AS ganancia_individual,
+        COUNT(*) AS n_pagos
+    FROM pagos
+    {filtro}
+    GROUP BY mes_clave
+"""
+
+_SQL_RESUMEN_GASTOS = """
+    SELECT
+        mes_clave,
+        COALESCE(SUM(CASE WHEN tipo = 'gasto' AND IFNULL(es_filamento, 0) = 0
+                          THEN monto END), 0) AS gastos,
+        COALESCE(SUM(CASE WHEN tipo = 'gasto' AND IFNULL(es_filamento, 0) = 1
+                          THEN monto END), 0) AS filamento,
+        COALESCE(SUM(CASE WHEN tipo = 'pago_ayudante' THEN monto END), 0) AS pagos_ayudante,
+        COUNT(*) AS n_gastos
+    FROM gastos
+    {filtro}
+    GROUP BY mes_clave
+"""
+
+_COLUMNAS_RESUMEN = {
+    "pagos": (_SQL_RESUMEN_PAGOS, ["monto", "costo", "ganancia", "ganancia_individual", "n_pagos"]),
+    "gastos": (_SQL_RESUMEN_GASTOS, ["gastos", "filamento", "pagos_ayudante", "n_gastos"]),
+}
+
+
+def acumular_resumen_mensual(cur, tabla, ids, signo):
+    """
+    Suma (signo=1) o resta (signo=-1) las filas de pagos/gastos indicadas al
+    resumen_mensual de su mes. Igual que acumular_saldos(): +1 después de
+    escribir y -1 antes de modificar o borrar, en la misma transacción.
+    """
+    sql, columnas = _COLUMNAS_RESUMEN[tabla]
+    signo = 1 if signo > 0 else -1
+    destino = ", ".join(columnas)
+    valores = ", ".join(f"{signo} * {c}" for c in columnas)
+    actualizar = ", ".join(f"{c} = {c} + excluded.{c}" for c in columnas)
+
+    for lote in _en_lotes(ids):
+        placeholders = ",".join("?" for _ in lote)
+        origen = sql.format(filtro=f"WHERE id IN ({placeholders})")
+        cur.execute(f"""
+            INSERT INTO resumen_mensual (mes_clave, {destino})
+            SELECT mes_clave, {valores}
+            FROM ({origen})
+            WHERE true
+            ON CONFLICT(mes_clave) DO UPDATE SET {actualizar}
+        """, lote)
+
+
+def reconstruir_resumen_mensual(cur):
+    """
+    Recalcula resumen_mensual desde cero a partir de pagos y gastos.
+    """
+    cur.execute("DELETE FROM resumen_mensual")
+    for tabla, (sql, columnas) in _COLUMNAS_RESUMEN.items():
+        destino = ", ".join(columnas)
+        actualizar = ", ".join(f"{c} = excluded.{c}" for c in columnas)
+        cur.execute(f"""
+            INSERT INTO resumen_mensual (mes_clave, {destino})
+            SELECT mes_clave, {destino}
+            FROM ({sql.format(filtro="")})
+            WHERE true
+            ON CONFLICT(mes_clave) DO UPDATE SET {actualizar}
+        """)
+    cur.execute("SELECT COUNT(*) FROM resumen_mensual")
+    return int(cur.fetchone()[0])
+
+
+@app.cli.command("reconstruir-resumen")
+def cli_reconstruir_resumen():
+    """Recalcula (backfill) el resumen mensual de pagos y gastos."""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        n = reconstruir_resumen_mensual(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Resumen mensual reconstruido: {n} meses")
+
+
+# ---------------------------
+# CIERRE DE MES (totales congelados)
+# ---------------------------
+
+_COLUMNAS_CIERRE = ["monto", "costo", "ganancia", "ganancia_individual",
+                    "gastos", "filamento", "pagos_ayudante", "n_pagos", "n_gastos"]
+
+# Una fila por mes: la congelada si el mes está cerrado, si no la de resumen_mensual.
+_SQL_RESUMEN_CON_CIERRES = f"""
+    SELECT mes_clave, {", ".join(_COLUMNAS_CIERRE)}
+    FROM meses_cerrados
+    UNION ALL
+    SELECT mes_clave, {", ".join(_COLUMNAS_CIERRE)}
+    FROM resumen_mensual
+    WHERE mes_clave NOT IN (SELECT mes_clave FROM meses_cerrados)
+"""
+
+
+def meses_cerrados(cur, meses):
+    """Cuáles de los meses ('YYYY-MM') indicados están cerrados."""
+    meses = sorted({m for m in meses if m})
+    cerrados = set()
+    for lote in _en_lotes(meses):
+        placeholders = ",".join("?" for _ in lote)
+        cur.execute(f"SELECT mes_clave FROM meses_cerrados WHERE mes_clave IN ({placeholders})", lote)
+        cerrados.update(f[0] for f in cur.fetchall())
+    return cerrados
+
+
+def error_mes_cerrado(cur, meses):
+    """Mensaje de error si alguno de los meses está cerrado; None si se pueden tocar."""
+    cerrados = sorted(meses_cerrados(cur, meses))
+    if not cerrados:
+        return None
+    if len(cerrados) == 1:
+        return f"El mes {cerrados[0]} está cerrado y no admite cambios."
+    return f"Los meses {', '.join(cerrados)} están cerrados y no admiten cambios."
+
+
+def cierre_de_mes(cur, mes_clave):
+    """Fila congelada del mes (dict) o None si el mes está abierto."""
+    cur.execute(f"""
+        SELECT mes_clave, cerrado_en, {", ".join(_COLUMNAS_CIERRE)}
+        FROM meses_cerrados
+        WHERE mes_clave = ?
+    """, (mes_clave,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return dict(zip(["mes_clave", "cerrado_en"] + _COLUMNAS_CIERRE, tuple(row)))
+
+
+def cerrar_mes(cur, mes_clave, mes_actual=None):
+    """
+    Congela los totales de pagos y gastos del mes en meses_cerrados, calculados
+    desde las filas (no desde resumen_mensual, que además queda alineado con ellos).
+    Solo meses ya terminados. Dentro de la transacción abierta en `cur`.
+    Devuelve la fila congelada; ValueError si el mes no se puede cerrar.
+    """
+    mes_actual = mes_actual or datetime.now().strftime("%Y-%m")
+    if not re.match(r"^\d{4}-\d{2}$", mes_clave or ""):
+        raise ValueError("El mes debe ser YYYY-MM")
+    if mes_clave >= mes_actual:
+        raise ValueError("Solo se pueden cerrar meses ya terminados")
+    if meses_cerrados(cur, [mes_clave]):
+        raise ValueError(f"El mes {mes_clave} ya está cerrado")
+
+    valores = dict.fromkeys(_COLUMNAS_CIERRE, 0)
+    for sql, columnas in _COLUMNAS_RESUMEN.values():
+        cur.execute(sql.format(filtro="WHERE mes_clave = ?"), (mes_clave,))
+        row = cur.fetchone()
+        if row:
+            valores.update({c: row[i + 1] for i, c in enumerate(columnas)})
+
+    destino = ", ".join(_COLUMNAS_CIERRE)
+    placeholders = ", ".join("?" for _ in _COLUMNAS_CIERRE)
+    params = [mes_clave] + [valores[c] for c in _COLUMNAS_CIERRE]
+    cur.execute(f"""
+        INSERT INTO meses_cerrados (mes_clave, {destino})
+        VALUES (?, {placeholders})
+    """, params)
+    actualizar = ", ".join(f"{c} = excluded.{c}" for c in _COLUMNAS_CIERRE)
+    cur.execute(f"""
+        INSERT INTO resumen_mensual (mes_clave, {destino})
+        VALUES (?, {placeholders})
+        ON CONFLICT(mes_clave) DO UPDATE SET {actualizar}
+    """, params)
+    return cierre_de_mes(cur, mes_clave)
+
+
+def reabrir_mes(cur, mes_clave):
+    """Descongela el mes (vuelve a leerse de resumen_mensual y acepta cambios)."""
+    cur.execute("DELETE FROM meses_cerrados WHERE mes_clave = ?", (mes_clave,))
+    return cur.rowcount > 0
+
+
+@app.cli.command("cerrar-mes")
+@click.argument("mes")
+@click.option("--reabrir", is_flag=True, help="Descongela el mes en lugar de cerrarlo.")
+def cli_cerrar_mes(mes, reabrir):
+    """Cierra (o reabre) un mes YYYY-MM: congela sus totales y bloquea los cambios."""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.cursor()
+        if reabrir:
+            ok = reabrir_mes(cur, mes)
+            conn.commit()
+            print(f"Mes {mes} reabierto." if ok else f"El mes {mes} no estaba cerrado.")
+            if ok:
+                emitir_escritura("cierre", {mes})
+            return
+        try:
+            cierre = cerrar_mes(cur, mes)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        conn.commit()
+    finally:
+        conn.close()
+    emitir_escritura("cierre", {mes})
+    print(f"Mes {mes} cerrado: {cierre['n_pagos']} pagos, {cierre['n_gastos']} gastos, "
+          f"monto {cierre['monto']:.2f}, gastos {cierre['gastos']:.2f}.")
+
+
+# ---------------------------
+# EVENTOS DE ESCRITURA
+# ---------------------------
+
+_oyentes_escritura = []
+
+
+def al_escribir(funcion):
+    """
+    Registra funcion(tipo, meses) para que se llame después de cada commit que
+    modifica entregas, pagos, gastos o revendedores. meses es el conjunto de
+    'YYYY-MM' afectados, o None si no se sabe (invalida todo).
+    """
+    _oyentes_escritura.append(funcion)
+    return funcion
+
+
+def emitir_escritura(tipo, meses=None):
+    for oyente in list(_oyentes_escritura):
+        try:
+            oyente(tipo, set(meses) if meses is not None else None)
+        except Exception:
+            app.logger.exception("Error en oyente de escritura (%s)", tipo)
+
+
+def meses_afectados(cur, tabla, ids):
+    """
+    Meses ('YYYY-MM') de las filas indicadas de entregas, pagos o gastos.
+    Se consulta antes de modificar/borrar para saber qué meses invalidar.
+    """
+    columna = "substr(fecha, 1, 7)" if tabla == "entregas" else "mes_clave"
+    meses = set()
+    for lote in _en_lotes(ids):
+        placeholders = ",".join("?" for _ in lote)
+        cur.execute(f"SELECT DISTINCT {columna} FROM {tabla} WHERE id IN ({placeholders})", lote)
+        meses.update(f[0] for f in cur.fetchall() if f[0])
+    return meses
+
+
+# ---------------------------
+# CACHE DEL DASHBOARD
+# ---------------------------
+
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", "300"))
+
+
+class CacheDashboard:
+    """
+    KPIs del dashboard por mes, invalidados por eventos de escritura.
+    El TTL cubre los cambios que no pasan por la app (CLI, edición manual de la base).
+    """
+
+    def __init__(self, ttl=DASHBOARD_CACHE_TTL):
+        self.ttl = ttl
+        self._datos = {}
+        self._lock = threading.Lock()
+        self._generacion = 0
+        self._stats = {"hits": 0, "misses": 0, "expirados": 0, "invalidaciones": 0}
+
+    def obtener(self, mes_clave):
+        """
+        Devuelve (kpis, generacion). kpis es None si no hay entrada vigente;
+        la generación se pasa luego a guardar() para no guardar datos viejos.
+        """
+        with self._lock:
+            entrada = self._datos.get(mes_clave)
+            if entrada is not None:
+                guardado_en, kpis = entrada
+                if time.monotonic() - guardado_en <= self.ttl:
+                    self._stats["hits"] += 1
+                    return kpis, self._generacion
+                del self._datos[mes_clave]
+                self._stats["expirados"] += 1
+            self._stats["misses"] += 1
+            return None, self._generacion
+
+    def guardar(self, mes_clave, kpis, generacion):
+        with self._lock:
+            # Si hubo una escritura mientras se calculaba, no se cachea.
+            if generacion == self._generacion:
+                self._datos[mes_clave] = (time.monotonic(), kpis)
+
+    def invalidar(self, meses=None):
+        with self._lock:
+            self._generacion += 1
+            self._stats["invalidaciones"] += 1
+            if meses is None:
+                self._datos.clear()
+            else:
+                for mes in meses:
+                    self._datos.pop(mes, None)
+
+    def estadisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entradas"] = len(self._datos)
+            stats["ttl"] = self.ttl
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / total) if total else 0.0
+        return stats
+
+
+cache_dashboard = CacheDashboard()
+
+
+@al_escribir
+def _invalidar_dashboard(tipo, meses):
+    # El "revendedor top" muestra el nombre: un cambio de revendedor afecta a todos los meses.
+    cache_dashboard.invalidar(None if tipo == "revendedor" else meses)
+
+
+def obtener_productos():
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            id,
+            nombre,
+            tipo_pieza,
+            subtipo,
+            stock,
+            precio,
+            precio_revendedor,
+            notas
+        FROM productos
+        WHERE activo = 1
+        ORDER BY nombre;
+    """)
+    filas = cur.fetchall()
+    conn.close()
+    return [dict(f) for f in filas]
+
+
+def obtener_revendedores():
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            id,
+            nombre,
+            contacto,
+            notas,
+            saldo_inicial,
+            created_at,
+            updated_at
+        FROM revendedores
+        WHERE activo = 1
+        ORDER BY nombre;
+    """)
+    filas = cur.fetchall()
+    conn.close()
+    return [dict(f) for f in filas]
+
+
+# ---------------------------
+# MOVIMIENTOS DE STOCK (journal + snapshots)
+# ---------------------------
+
+STOCK_SNAPSHOT_HORAS = float(os.environ.get("STOCK_SNAPSHOT_HORAS", "24"))
+
+# Delta real que aplica "stock = MAX(0, stock + cambio)" sobre el stock actual.
+_SQL_DELTA_STOCK = "MAX(0, IFNULL(stock, 0) + ?) - IFNULL(stock, 0)"
+
+
+def mover_stock(cur, cambios, motivo, entrega_id=None):
+    """
+    Aplica cambios relativos de stock [(producto_id, delta), ...] sin bajar de 0 y
+    deja cada cambio efectivo en stock_movimientos, dentro de la transacción de `cur`.
+    El journal se escribe antes del UPDATE porque el delta real depende del stock previo.
+    """
+    cambios = [(int(pid), int(delta)) for pid, delta in cambios if pid and delta]
+    if not cambios:
+        return
+
+    cur.executemany(f"""
+        INSERT INTO stock_movimientos (producto_id, delta, motivo, entrega_id)
+        SELECT id, {_SQL_DELTA_STOCK}, ?, ?
+        FROM productos
+        WHERE id = ? AND {_SQL_DELTA_STOCK} != 0
+    """, [(delta, motivo, entrega_id, pid, delta) for pid, delta in cambios])
+
+    cur.executemany("""
+        UPDATE productos
+        SET stock = MAX(0, IFNULL(stock, 0) + ?), updated_at = datetime('now')
+        WHERE id = ?
+    """, [(delta, pid) for pid, delta in cambios])
+
+
+def fijar_stock(cur, producto_id, stock, motivo="ajuste"):
+    """Registra en el journal la diferencia entre el stock actual y `stock` (valor absoluto)."""
+    cur.execute("""
+        INSERT INTO stock_movimientos (producto_id, delta, motivo)
+        SELECT id, ? - IFNULL(stock, 0), ?
+        FROM productos
+        WHERE id = ? AND IFNULL(stock, 0) != ?
+    """, (stock, motivo, producto_id, stock))
+
+
+def tomar_snapshot_stock(cur):
+    """
+    Guarda el stock de todos los productos junto con el último movimiento incluido.
+    Devuelve el id del snapshot.
+    """
+    cur.execute("SELECT IFNULL(MAX(id), 0) FROM stock_movimientos")
+    ultimo = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO stock_snapshots (fecha, ultimo_movimiento_id)
+        VALUES (datetime('now', 'localtime'), ?)
+    """, (ultimo,))
+    snapshot_id = cur.lastrowid
+    cur.execute("""
+        INSERT INTO stock_snapshot_items (snapshot_id, producto_id, stock)
+        SELECT ?, id, IFNULL(stock, 0)
+        FROM productos
+        WHERE IFNULL(stock, 0) != 0
+    """, (snapshot_id,))
+    return snapshot_id
+
+
+def stock_a_fecha(cur, fecha, producto_id=None):
+    """
+    Stock de cada producto al final de `fecha` ('YYYY-MM-DD' o 'YYYY-MM-DD HH:MM:SS'):
+    último snapshot anterior + replay de los movimientos posteriores hasta esa fecha.
+    Devuelve (filas, snapshot) donde snapshot es la fila usada o None.
+    """
+    limite = fecha if len(fecha) > 10 else f"{fecha} 23:59:59"
+
+    cur.execute("""
+        SELECT id, fecha, ultimo_movimiento_id
+        FROM stock_snapshots
+        WHERE fecha <= ?
+        ORDER BY fecha DESC, id DESC
+        LIMIT 1
+    """, (limite,))
+    snapshot = cur.fetchone()
+    snapshot_id = snapshot["id"] if snapshot else 0
+    desde_mov = snapshot["ultimo_movimiento_id"] if snapshot else 0
+
+    filtro = "AND producto_id = ?" if producto_id is not None else ""
+    extra = (producto_id,) if producto_id is not None else ()
+
+    cur.execute(f"""
+        WITH base AS (
+            SELECT producto_id, stock AS cantidad
+            FROM stock_snapshot_items
+            WHERE snapshot_id = ? {filtro}
+            UNION ALL
+            SELECT producto_id, delta
+            FROM stock_movimientos
+            WHERE id > ? AND fecha <= ? {filtro}
+        )
+        SELECT b.producto_id, p.nombre, SUM(b.cantidad) AS stock
+        FROM base b
+        LEFT JOIN productos p ON p.id = b.producto_id
+        GROUP BY b.producto_id
+        ORDER BY p.nombre
+    """, (snapshot_id, *extra, desde_mov, limite, *extra))
+    return cur.fetchall(), snapshot
+
+
+_ultimo_snapshot_stock = {"ts": None}
+_snapshot_lock = threading.Lock()
+
+
+@al_escribir
+def _snapshot_stock_periodico(tipo, meses):
+    # Un snapshot cada STOCK_SNAPSHOT_HORAS como máximo, disparado por escrituras de stock.
+    if tipo not in ("entrega", "stock") or STOCK_SNAPSHOT_HORAS <= 0:
+        return
+    ahora = time.time()
+    with _snapshot_lock:
+        ts = _ultimo_snapshot_stock["ts"]
+        if ts is not None and ahora - ts < STOCK_SNAPSHOT_HORAS * 3600:
+            return
+        _ultimo_snapshot_stock["ts"] = ahora
+
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("""
+            SELECT fecha > datetime('now', 'localtime', ?)
+            FROM stock_snapshots
+            ORDER BY id DESC
+            LIMIT 1
+        """, (f"-{STOCK_SNAPSHOT_HORAS * 3600:.0f} seconds",))
+        reciente = cur.fetchone()
+        if not (reciente and reciente[0]):
+            tomar_snapshot_stock(cur)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@app.cli.command("snapshot-stock")
+def cli_snapshot_stock():
+    """Guarda un snapshot del stock actual (para correr desde cron)."""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        snapshot_id = tomar_snapshot_stock(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Snapshot de stock #{snapshot_id} guardado")
+
+
+# ---------------------------
+# HISTORIAL DE ENTREGAS (paginado por cursor)
+# ---------------------------
+
+RE_FECHA = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _codificar_cursor(*partes):
+    texto = "|".join(str(p) for p in partes)
+    return base64.urlsafe_b64encode(texto.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decodificar_cursor(cursor, cantidad):
     """
-    Asegura columnas extra para distinguir entrega/devolución.
+    Devuelve la lista de partes del cursor, o None si no es válido.
     """
     try:
-        cur.execute("ALTER TABLE entregas ADD COLUMN tipo_movimiento TEXT NOT NULL DEFAULT 'entrega'")
-        conn.commit()
-    except sqlite3.OperationalError:
-        pass
-
-    try:
-        cur.execute("ALTER TABLE entregas ADD COLUMN descripcion TEXT")
-        conn.commit()
-    except sqlite3.OperationalError:
-        pass
+        relleno = "=" * (-len(cursor) % 4)
+        partes = base64.urlsafe_b64decode(cursor + relleno).decode("utf-8").split("|")
+    except Exception:
+        return None
+    return partes if len(partes) == cantidad else None
 
 
-def obtener_productos():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+def listar_entregas(cur, limite=25, cursor=None, revendedor_id=None,
+                    desde=None, hasta=None, tipo_movimiento=None):
+    """
+    Página del historial de entregas/devoluciones, de la más nueva a la más vieja.
+    Paginación por keyset sobre (fecha, id): cada página cuesta lo mismo sin importar
+    cuánta historia haya detrás. cursor es (fecha, id) de la última fila ya vista.
+    Devuelve (filas, hay_mas).
+    """
+    condiciones = []
+    params = []
+
+    if revendedor_id is not None:
+        condiciones.append("revendedor_id = ?")
+        params.append(revendedor_id)
+    if desde:
+        condiciones.append("fecha >= ?")
+        params.append(desde)
+    if hasta:
+        condiciones.append("fecha <= ?")
+        params.append(hasta)
+    if tipo_movimiento:
+        condiciones.append("IFNULL(tipo_movimiento, 'entrega') = ?")
+        params.append(tipo_movimiento)
+    if cursor is not None:
+        condiciones.append("(fecha, id) < (?, ?)")
+        params.extend(cursor)
+
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+
+    cur.execute(f"""
         SELECT
             id,
-            nombre,
-            tipo_pieza,
-            subtipo,
-            stock,
-            precio,
-            precio_revendedor,
-            notas
-        FROM productos
-        WHERE activo = 1
-        ORDER BY nombre;
-    """)
-    filas = cur.fetchall()
-    conn.close()
-    return [dict(f) for f in filas]
+            fecha,
+            tipo_cliente,
+            cliente_nombre,
+            revendedor_id,
+            cantidad_total,
+            total,
+            IFNULL(tipo_movimiento, 'entrega') AS tipo_movimiento,
+            descripcion
+        FROM entregas
+        {where}
+        ORDER BY fecha DESC, id DESC
+        LIMIT ?
+    """, [*params, limite + 1])
+    filas = [dict(f) for f in cur.fetchall()]
 
+    return filas[:limite], len(filas) > limite
 
-def obtener_revendedores():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT
-            id,
-            nombre,
-            contacto,
-            notas,
-            saldo_inicial,
-            created_at,
-            updated_at
-        FROM revendedores
-        WHERE activo = 1
-        ORDER BY nombre;
-    """)
-    filas = cur.fetchall()
-    conn.close()
-    return [dict(f) for f in filas]
+
+def items_de_entregas(cur, entrega_ids):
+    """
+    Items de varias entregas con una consulta por lote. {entrega_id: [items]}
+    """
+    items = {eid: [] for eid in entrega_ids}
+    for lote in _en_lotes(entrega_ids):
+        placeholders = ",".join("?" for _ in lote)
+        cur.execute(f"""
+            SELECT
+                id,
+                entrega_id,
+                producto_id,
+                nombre_pieza,
+                cantidad,
+                precio_unitario,
+                total
+            FROM entrega_items
+            WHERE entrega_id IN ({placeholders})
+            ORDER BY entrega_id, id
+        """, lote)
+        for f in cur.fetchall():
+            items[f["entrega_id"]].append(dict(f))
+    return items
 
 
 # ---------------------------
 # UTILIDAD: PDF DE ENTREGA
 # ---------------------------
 
+# Copia en disco de cada PDF descargado (opcional; por defecto solo en memoria).
+PDFS_EN_DISCO = os.environ.get("PDFS_EN_DISCO", "0") == "1"
+PDFS_DIR = Path(os.environ.get("PDFS_DIR", "pdfs"))
+
+
+PDF_CACHE_DIR = Path(os.environ.get("PDF_CACHE_DIR", "pdf_cache"))
+PDF_CACHE_MAX_MB = float(os.environ.get("PDF_CACHE_MAX_MB", "200"))
+
+
+class CachePdf:
+    """
+    PDFs ya generados, en disco, direccionados por contenido:
+    entrega_<id>_<hash>.pdf, con hash de (cliente, fecha, items, versión de la
+    plantilla, mtime del logo). Si cambia algo de eso cambia el nombre, así que
+    nunca se sirve un PDF viejo. Tamaño acotado con desalojo LRU (por mtime,
+    que se actualiza en cada hit). Un render que termina después de invalidar()
+    no se guarda (contador de generación, como en CacheDashboard).
+    """
+
+    def __init__(self, directorio, max_bytes):
+        # Absoluta: send_file resuelve las rutas relativas contra app.root_path.
+        self.directorio = Path(directorio).absolute()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None  # bytes en disco; se calcula al primer uso
+        self._generacion = 0
+        self._stats = {"hits": 0, "misses": 0, "desalojados": 0, "invalidados": 0}
+
+    @staticmethod
+    def clave(cliente, fecha, items):
+        try:
+            logo_mtime = ruta_logo().stat().st_mtime_ns
+        except OSError:
+            logo_mtime = 0
+        contenido = json.dumps([cliente, fecha, items, PLANTILLA_VERSION, logo_mtime],
+                               sort_keys=True, default=str)
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+    def _ruta(self, entrega_id, clave):
+        return self.directorio / f"entrega_{int(entrega_id)}_{clave}.pdf"
+
+    def _archivos(self, patron="entrega_*.pdf"):
+        return list(self.directorio.glob(patron)) if self.directorio.is_dir() else []
+
+    def _asegurar_total(self):
+        if self._total is None:
+            self._total = sum(p.stat().st_size for p in self._archivos())
+
+    def obtener(self, entrega_id, clave):
+        """
+        Devuelve (pdf_bytes o None, generación); la generación se pasa luego a guardar().
+        Se devuelven los bytes y no la ruta: el archivo puede desalojarse o invalidarse
+        antes de que el request llegue a mandarlo.
+        """
+        ruta = self._ruta(entrega_id, clave)
+        with self._lock:
+            generacion = self._generacion
+        try:
+            pdf_bytes = ruta.read_bytes()
+            os.utime(ruta)  # marca de uso para el LRU
+        except OSError:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None, generacion
+        with self._lock:
+            self._stats["hits"] += 1
+        return pdf_bytes, generacion
+
+    def guardar(self, entrega_id, clave, pdf_bytes, generacion):
+        """Guarda el PDF si no hubo invalidaciones mientras se generaba (si no, None)."""
+        ruta = self._ruta(entrega_id, clave)
+        with self._lock:
+            if generacion != self._generacion:
+                return None
+            self._asegurar_total()
+            existia = ruta.exists()
+            guardar_pdf(pdf_bytes, ruta)
+            if not existia:
+                self._total += len(pdf_bytes)
+            # Versiones anteriores de la misma entrega ya no se van a pedir.
+            for vieja in self._archivos(f"entrega_{int(entrega_id)}_*.pdf"):
+                if vieja != ruta:
+                    self._borrar(vieja)
+            if self._total > self.max_bytes:
+                self._desalojar(conservar=ruta)
+        return ruta
+
+    def _borrar(self, ruta):
+        try:
+            tamano = ruta.stat().st_size
+            ruta.unlink()
+        except OSError:
+            return False
+        self._total = max(0, (self._total or 0) - tamano)
+        return True
+
+    def _desalojar(self, conservar):
+        archivos = []
+        for p in self._archivos():
+            try:
+                archivos.append((p.stat().st_mtime, p))
+            except OSError:
+                pass
+        for _, p in sorted(archivos):
+            if self._total <= self.max_bytes:
+                break
+            if p != conservar and self._borrar(p):
+                self._stats["desalojados"] += 1
+
+    def invalidar(self, entrega_ids):
+        with self._lock:
+            self._generacion += 1
+            self._asegurar_total()
+            for eid in entrega_ids:
+                for p in self._archivos(f"entrega_{int(eid)}_*.pdf"):
+                    if self._borrar(p):
+                        self._stats["invalidados"] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            self._asegurar_total()
+            stats = dict(self._stats)
+            stats["bytes"] = self._total
+            stats["max_bytes"] = self.max_bytes
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / total) if total else 0.0
+        return stats
+
+
+cache_pdfs = CachePdf(PDF_CACHE_DIR, int(PDF_CACHE_MAX_MB * 1024 * 1024))
+
+
+def _limpiar_nombre_cliente(raw_cliente):
+    # "12 - Juan" -> "Juan" (los clientes a veces se cargan con número adelante)
+    cliente_limpio = re.sub(r'^\s*\d+\s*[-–.)_]*\s*', '', raw_cliente or "").strip()
+    cliente_limpio = re.sub(r'^\.+', '', cliente_limpio).strip()
+    return re.sub(r'^[^\wÁÉÍÓÚáéíóúñÑ]+', '', cliente_limpio).strip()
+
+
+def datos_pdf_entregas(cur, entrega_ids):
+    """
+    Datos para los PDFs de varias entregas (cabeceras + items en una consulta por lote):
+    lista de dicts con id, cliente (limpio), fecha, items y tipo_movimiento, en el
+    orden de entrega_ids. Las que no existen se omiten.
+    """
+    ids = list(dict.fromkeys(int(i) for i in entrega_ids))
+    cabeceras = {}
+    for lote in _en_lotes(ids):
+        placeholders = ",".join("?" for _ in lote)
+        cur.execute(f"""
+            SELECT
+                id,
+                fecha,
+                cliente_nombre,
+                IFNULL(tipo_movimiento, 'entrega') AS tipo_movimiento
+            FROM entregas
+            WHERE id IN ({placeholders})
+        """, lote)
+        cabeceras.update((f["id"], f) for f in cur.fetchall())
+
+    items = items_de_entregas(cur, list(cabeceras))
+    return [
+        {
+            "id": eid,
+            "cliente": _limpiar_nombre_cliente(cabeceras[eid]["cliente_nombre"]),
+            "fecha": cabeceras[eid]["fecha"],
+            "items": [
+                {
+                    "pieza": it["nombre_pieza"],
+                    "cantidad": it["cantidad"],
+                    "precio": it["precio_unitario"],
+                    "total": it["total"],
+                }
+                for it in items[eid]
+            ],
+            "tipo_movimiento": cabeceras[eid]["tipo_movimiento"] or "entrega",
+        }
+        for eid in ids
+        if eid in cabeceras
+    ]
+
+
+def datos_pdf_entrega(cur, entrega_id):
+    """Datos para el PDF de una entrega (ver datos_pdf_entregas), o None si no existe."""
+    datos = datos_pdf_entregas(cur, [entrega_id])
+    return datos[0] if datos else None
+
+
+def pdf_entrega_cacheado(datos):
+    """
+    PDF de la entrega desde la cache, generándolo si no estaba.
+    Devuelve (pdf_bytes, clave, hit).
+    """
+    clave = cache_pdfs.clave(datos["cliente"], datos["fecha"], datos["items"])
+    pdf_bytes, generacion = cache_pdfs.obtener(datos["id"], clave)
+    if pdf_bytes is not None:
+        return pdf_bytes, clave, True
+
+    pdf_bytes = render_entrega_pdf(cliente=datos["cliente"], fecha_iso=datos["fecha"],
+                                   items=datos["items"]).getvalue()
+    cache_pdfs.guardar(datos["id"], clave, pdf_bytes, generacion)
+    if PDFS_EN_DISCO:
+        guardar_pdf(pdf_bytes, PDFS_DIR / f"entrega_{datos['id']}.pdf")
+    return pdf_bytes, clave, False
+
+
+@app.cli.command("bench-pdf")
+@click.option("--n", "repeticiones", type=int, default=3, help="PDFs por medición.")
+@click.option("--items", "cantidades", type=int, multiple=True, default=(10, 100, 2000),
+              help="Items por entrega (se puede repetir: --items 10 --items 2000).")
+def cli_bench_pdf(repeticiones, cantidades):
+    """Micro-benchmark: ms por PDF con recursos en frío (sin caches) y en caliente."""
+    for cantidad_items in cantidades:
+        items = [
+            {"pieza": f"Pieza de prueba {i}", "cantidad": i, "precio": 1500.0 * i, "total": 1500.0 * i * i}
+            for i in range(1, cantidad_items + 1)
+        ]
+
+        def medir(en_frio):
+            inicio = time.perf_counter()
+            for _ in range(repeticiones):
+                if en_frio:
+                    pdfrecursos.limpiar_caches()
+                pdf = render_entrega_pdf("Cliente de prueba", "2025-01-31", items)
+            return (time.perf_counter() - inicio) / repeticiones * 1000.0, pdf.getbuffer().nbytes
+
+        render_entrega_pdf("Cliente de prueba", "2025-01-31", items)  # imports y fuentes
+        frio, _ = medir(True)
+        caliente, peso = medir(False)
+        print(f"{cantidad_items} items, {repeticiones} PDFs: "
+              f"en frío {frio:.1f} ms/pdf, en caliente {caliente:.1f} ms/pdf, {peso // 1024} KB")
+
+
 def _formatear_fecha_ddmmyyyy(fecha_raw: str) -> str:
     """
     Convierte 'YYYY-MM-DD' en 'DD-MM-YYYY'.
@@ -106,51 +1657,21 @@ def _formatear_fecha_ddmmyyyy(fecha_raw: str) -> str:
 # RUTAS FRONTEND
 # ---------------------------
 
-@app.route("/")
-def dashboard():
-    conn = get_conn()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    try:
-        asegurar_columnas_entregas(cur, conn)
-    except Exception:
-        pass
-
-    # -------- rango mes actual --------
-    hoy = datetime.now().date()
-    inicio_mes = hoy.replace(day=1)
-    if inicio_mes.month == 12:
-        fin_mes = inicio_mes.replace(year=inicio_mes.year + 1, month=1)
-    else:
-        fin_mes = inicio_mes.replace(month=inicio_mes.month + 1)
-
-    mes_clave_actual = inicio_mes.strftime("%Y-%m")
-
-    # -------- PAGOS DEL MES --------
+def _calcular_kpis_dashboard(cur, mes_clave_actual, inicio_mes, fin_mes):
+    """
+    KPIs del dashboard para el mes indicado (lo que se guarda en cache_dashboard).
+    """
+    # -------- PAGOS Y GASTOS DEL MES (resumen mensual) --------
     cur.execute("""
-        SELECT monto, costo
-        FROM pagos
+        SELECT monto, costo, gastos
+        FROM resumen_mensual
         WHERE mes_clave = ?
     """, (mes_clave_actual,))
-    pagos = cur.fetchall()
+    row_m = cur.fetchone()
 
-    total_montos = sum(p["monto"] for p in pagos) if pagos else 0.0
-    total_costos = sum(p["costo"] for p in pagos) if pagos else 0.0
-
-    # -------- GASTOS DEL MES (sin filamento) --------
-    try:
-        cur.execute("""
-            SELECT COALESCE(SUM(monto), 0) AS total_gastos
-            FROM gastos
-            WHERE mes_clave = ?
-              AND tipo = 'gasto'
-              AND IFNULL(es_filamento, 0) = 0
-        """, (mes_clave_actual,))
-        row_g = cur.fetchone()
-        total_gastos = float(row_g["total_gastos"]) if row_g else 0.0
-    except sqlite3.OperationalError:
-        total_gastos = 0.0
+    total_montos = float(row_m["monto"] or 0) if row_m else 0.0
+    total_costos = float(row_m["costo"] or 0) if row_m else 0.0
+    total_gastos = float(row_m["gastos"] or 0) if row_m else 0.0
 
     # 1) GANANCIA DEL MES (BRUTA REAL)
     ganancia_mes = total_montos - total_costos - total_gastos
@@ -187,15 +1708,36 @@ def dashboard():
     row = cur.fetchone()
     revendedor_top = row["revendedor"] if row else None
 
-    conn.close()
+    return {
+        "ganancia_mes": ganancia_mes,
+        "ganancia_individual_mes": ganancia_individual_mes,
+        "pieza_mas_vendida": pieza_mas_vendida,
+        "revendedor_top": revendedor_top,
+    }
 
-    return render_template(
-        "dashboard.html",
-        ganancia_mes=ganancia_mes,
-        ganancia_individual_mes=ganancia_individual_mes,
-        pieza_mas_vendida=pieza_mas_vendida,
-        revendedor_top=revendedor_top,
-    )
+
+@app.route("/")
+def dashboard():
+    # -------- rango mes actual --------
+    hoy = datetime.now().date()
+    inicio_mes = hoy.replace(day=1)
+    if inicio_mes.month == 12:
+        fin_mes = inicio_mes.replace(year=inicio_mes.year + 1, month=1)
+    else:
+        fin_mes = inicio_mes.replace(month=inicio_mes.month + 1)
+
+    mes_clave_actual = inicio_mes.strftime("%Y-%m")
+
+    kpis, generacion = cache_dashboard.obtener(mes_clave_actual)
+    if kpis is None:
+        conn = get_conn()
+        try:
+            kpis = _calcular_kpis_dashboard(conn.cursor(), mes_clave_actual, inicio_mes, fin_mes)
+        finally:
+            conn.close()
+        cache_dashboard.guardar(mes_clave_actual, kpis, generacion)
+
+    return render_template("dashboard.html", **kpis)
 
 
 @app.route("/stock")
@@ -225,11 +1767,6 @@ def api_borrar_revendedor_completo():
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
-    try:
-        asegurar_columnas_entregas(cur, conn)
-    except Exception:
-        pass
-
     # Verificar entregas asociadas
     cur.execute("SELECT COUNT(*) AS c FROM entregas WHERE revendedor_id = ?", (rev_id,))
     tiene_entregas = cur.fetchone()["c"]
@@ -238,67 +1775,407 @@ def api_borrar_revendedor_completo():
     cur.execute("SELECT COUNT(*) AS c FROM pagos WHERE revendedor_id = ?", (rev_id,))
     tiene_pagos = cur.fetchone()["c"]
 
-    if tiene_entregas > 0 or tiene_pagos > 0:
-        conn.close()
-        return jsonify(ok=False, error="No se puede borrar: tiene entregas o pagos asociados."), 200
+    if tiene_entregas > 0 or tiene_pagos > 0:
+        conn.close()
+        return jsonify(ok=False, error="No se puede borrar: tiene entregas o pagos asociados."), 200
+
+    # Borrado lógico
+    cur.execute("""
+        UPDATE revendedores
+        SET activo = 0, updated_at = datetime('now')
+        WHERE id = ?
+    """, (rev_id,))
+
+    conn.commit()
+    filas = cur.rowcount
+    conn.close()
+
+    if filas == 0:
+        return jsonify(ok=False, error="Revendedor no encontrado"), 200
+
+    return jsonify(ok=True), 200
+
+
+@app.route("/entregas")
+def pagina_entregas():
+    revendedores = obtener_revendedores()
+    productos = obtener_productos()
+
+    conn = get_conn()
+    cur = conn.cursor()
+
+    try:
+        historial_entregas, _ = listar_entregas(cur, limite=25)
+    except sqlite3.OperationalError:
+        historial_entregas = []
+    finally:
+        conn.close()
+
+    return render_template(
+        "entregas.html",
+        revendedores=revendedores,
+        productos=productos,
+        piezas_en_stock=productos,
+        historial_entregas=historial_entregas
+    )
+
+
+# ---------------------------
+# RESUMEN DE CUENTAS
+# ---------------------------
+
+@dataclass(frozen=True)
+class ResumenCuentas:
+    """
+    Cifras de /cuentas para un mes y una fecha de corte (hoy).
+    Los acumulados "global" cuentan hasta hoy inclusive; los "pendientes", después de hoy.
+    """
+    # Mes seleccionado
+    monto_mes: float = 0.0
+    costo_mes: float = 0.0
+    gi_bruta_mes: float = 0.0
+    gastos_mes: float = 0.0
+    filamento_mes: float = 0.0
+    pagado_ayudante_mes: float = 0.0
+    # Acumulados hasta hoy
+    gi_bruta_global: float = 0.0
+    costos_global: float = 0.0
+    gastos_global: float = 0.0
+    filamento_global: float = 0.0
+    pagos_ayudante_global: float = 0.0
+    # Con fecha futura
+    pendiente_ingresar: float = 0.0
+    gastos_pendientes: float = 0.0
+    filamento_pendiente: float = 0.0
+
+    @property
+    def gi_neta_mes(self):
+        return self.gi_bruta_mes - (self.gastos_mes / 2.0)
+
+    @property
+    def gi_neta_global(self):
+        return self.gi_bruta_global - (self.gastos_global / 2.0)
+
+    @property
+    def ayudante_pendiente_global(self):
+        return self.gi_neta_global - self.pagos_ayudante_global
+
+    @property
+    def para_filamento_restante(self):
+        return self.costos_global - self.filamento_global
+
+
+def calcular_resumen_cuentas(cur, mes_clave, hoy_str):
+    """
+    Calcula todas las cifras de /cuentas.
+    El mes seleccionado y los meses anteriores al actual salen de los totales
+    congelados (meses cerrados) y de resumen_mensual (el resto);
+    sólo el mes actual y los futuros (los únicos con fechas posteriores a hoy)
+    se leen de pagos/gastos, con una pasada de agregación condicional por tabla.
+    """
+    mes_hoy = hoy_str[:7]
+    params = {"mes": mes_clave, "mes_hoy": mes_hoy, "hoy": hoy_str}
+
+    cur.execute(f"""
+        SELECT
+            COALESCE(SUM(CASE WHEN mes_clave = :mes THEN monto END), 0) AS monto_mes,
+            COALESCE(SUM(CASE WHEN mes_clave = :mes THEN costo END), 0) AS costo_mes,
+            COALESCE(SUM(CASE WHEN mes_clave = :mes THEN ganancia_individual END), 0) AS gi_bruta_mes,
+            COALESCE(SUM(CASE WHEN mes_clave = :mes THEN gastos END), 0) AS gastos_mes,
+            COALESCE(SUM(CASE WHEN mes_clave = :mes THEN filamento END), 0) AS filamento_mes,
+            COALESCE(SUM(CASE WHEN mes_clave = :mes THEN pagos_ayudante END), 0) AS pagado_ayudante_mes,
+            COALESCE(SUM(CASE WHEN mes_clave < :mes_hoy THEN ganancia_individual END), 0) AS gi_bruta_global,
+            COALESCE(SUM(CASE WHEN mes_clave < :mes_hoy THEN costo END), 0) AS costos_global,
+            COALESCE(SUM(CASE WHEN mes_clave < :mes_hoy THEN gastos END), 0) AS gastos_global,
+            COALESCE(SUM(CASE WHEN mes_clave < :mes_hoy THEN filamento END), 0) AS filamento_global,
+            COALESCE(SUM(CASE WHEN mes_clave < :mes_hoy THEN pagos_ayudante END), 0) AS pagos_ayudante_global
+        FROM ({_SQL_RESUMEN_CON_CIERRES})
+    """, params)
+    cifras = {k: float(v or 0) for k, v in dict(cur.fetchone()).items()}
+
+    cur.execute("""
+        SELECT
+            COALESCE(SUM(CASE WHEN fecha <= :hoy THEN ganancia_individual END), 0) AS gi_bruta_global,
+            COALESCE(SUM(CASE WHEN fecha <= :hoy THEN costo END), 0) AS costos_global,
+            COALESCE(SUM(CASE WHEN fecha > :hoy THEN monto END), 0) AS pendiente_ingresar
+        FROM pagos
+        WHERE mes_clave >= :mes_hoy
+    """, params)
+    vivos = dict(cur.fetchone())
+
+    cur.execute("""
+        SELECT
+            COALESCE(SUM(CASE WHEN fecha <= :hoy AND tipo = 'gasto'
+                               AND IFNULL(es_filamento, 0) = 0 THEN monto END), 0) AS gastos_global,
+            COALESCE(SUM(CASE WHEN fecha <= :hoy AND tipo = 'gasto'
+                               AND IFNULL(es_filamento, 0) = 1 THEN monto END), 0) AS filamento_global,
+            COALESCE(SUM(CASE WHEN fecha <= :hoy AND tipo = 'pago_ayudante'
+                               THEN monto END), 0) AS pagos_ayudante_global,
+            COALESCE(SUM(CASE WHEN fecha > :hoy AND tipo = 'gasto'
+                               AND IFNULL(es_filamento, 0) = 0 THEN monto END), 0) AS gastos_pendientes,
+            COALESCE(SUM(CASE WHEN fecha > :hoy AND tipo = 'gasto'
+                               AND IFNULL(es_filamento, 0) = 1 THEN monto END), 0) AS filamento_pendiente
+        FROM gastos
+        WHERE mes_clave >= :mes_hoy
+    """, params)
+    vivos.update(dict(cur.fetchone()))
+
+    for clave, valor in vivos.items():
+        cifras[clave] = cifras.get(clave, 0.0) + float(valor or 0)
+
+    return ResumenCuentas(**cifras)
+
+
+def agrupar_pagos_mes(cur, mes_clave):
+    """
+    Pagos del mes agrupados como se muestran en /cuentas: una fila por
+    (fecha, cliente, descripción) con el detalle de cada división.
+    Devuelve (items, totales), items del más nuevo al más viejo.
+    """
+    cur.execute("""
+        SELECT
+            p.*,
+            r.nombre AS revendedor_nombre
+        FROM pagos p
+        LEFT JOIN revendedores r ON p.revendedor_id = r.id
+        WHERE p.mes_clave = ?
+        ORDER BY p.fecha DESC, p.id DESC
+    """, (mes_clave,))
+    rows = cur.fetchall()
+
+    grupos = {}
+    totales = {
+        "monto": 0.0,
+        "costo": 0.0,
+        "ganancia": 0.0,
+        "ganancia_individual": 0.0,
+    }
+
+    for row in rows:
+        row = dict(row)
+        clave = (
+            row["fecha"],
+            row["tipo_cliente"],
+            row["revendedor_id"],
+            row["nombre_particular"],
+            row["descripcion"],
+        )
+
+        if clave not in grupos:
+            grupos[clave] = {
+                "ids": [row["id"]],
+                "fecha": row["fecha"],
+                "tipo_cliente": row["tipo_cliente"],
+                "revendedor_id": row["revendedor_id"],
+                "revendedor_nombre": row.get("revendedor_nombre"),
+                "nombre_particular": row.get("nombre_particular"),
+                "descripcion": row.get("descripcion"),
+                "monto": float(row["monto"] or 0),
+                "costo": float(row["costo"] or 0),
+                "ganancia": float(row["ganancia"] or 0),
+                "ganancia_individual": float(row["ganancia_individual"] or 0),
+                "detalles": [
+                    {
+                        "monto": float(row["monto"] or 0),
+                        "division": int(row["division"] or 1),
+                        "categoria_precio": row["categoria_precio"],
+                    }
+                ],
+            }
+        else:
+            g = grupos[clave]
+            g["ids"].append(row["id"])
+            g["monto"] += float(row["monto"] or 0)
+            g["costo"] += float(row["costo"] or 0)
+            g["ganancia"] += float(row["ganancia"] or 0)
+            g["ganancia_individual"] += float(row["ganancia_individual"] or 0)
+            g["detalles"].append(
+                {
+                    "monto": float(row["monto"] or 0),
+                    "division": int(row["division"] or 1),
+                    "categoria_precio": row["categoria_precio"],
+                }
+            )
+
+        totales["monto"] += float(row["monto"] or 0)
+        totales["costo"] += float(row["costo"] or 0)
+        totales["ganancia"] += float(row["ganancia"] or 0)
+        totales["ganancia_individual"] += float(row["ganancia_individual"] or 0)
+
+    items = list(grupos.values())
+    items.sort(key=lambda g: (g["fecha"], max(g["ids"])), reverse=True)
+    return items, totales
+
+
+def gastos_del_mes(cur, mes_clave):
+    """Gastos y pagos al ayudante del mes (del más nuevo al más viejo)."""
+    cur.execute("""
+        SELECT id, fecha, descripcion, tipo, monto, es_filamento
+        FROM gastos
+        WHERE mes_clave = ? AND tipo = 'gasto'
+        ORDER BY fecha DESC, id DESC
+    """, (mes_clave,))
+    gastos_mes_list = [dict(r) for r in cur.fetchall()]
+
+    cur.execute("""
+        SELECT id, fecha, descripcion, monto
+        FROM gastos
+        WHERE mes_clave = ? AND tipo = 'pago_ayudante'
+        ORDER BY fecha DESC, id DESC
+    """, (mes_clave,))
+    pagos_ayudante_list = [dict(r) for r in cur.fetchall()]
+
+    return gastos_mes_list, pagos_ayudante_list
+
+
+def resumen_de_mes(cur, mes_clave):
+    """
+    Sólo las cifras propias del mes (sin los acumulados globales, que dependen
+    del día): la fila congelada si el mes está cerrado, si no la de resumen_mensual.
+    """
+    cur.execute(f"""
+        SELECT monto, costo, ganancia_individual, gastos, filamento, pagos_ayudante
+        FROM ({_SQL_RESUMEN_CON_CIERRES})
+        WHERE mes_clave = ?
+    """, (mes_clave,))
+    row = cur.fetchone()
+    if not row:
+        return ResumenCuentas()
+    return ResumenCuentas(
+        monto_mes=float(row[0] or 0),
+        costo_mes=float(row[1] or 0),
+        gi_bruta_mes=float(row[2] or 0),
+        gastos_mes=float(row[3] or 0),
+        filamento_mes=float(row[4] or 0),
+        pagado_ayudante_mes=float(row[5] or 0),
+    )
+
+
+# ---------------------------
+# REGISTROS (validación compartida por formularios, API e importación)
+# ---------------------------
+
+def preparar_registro(fecha_str, tipo_cliente, revendedor_id, nombre_particular,
+                      descripcion, monto_unit, division_unit, categoria_unit):
+    """
+    Fila lista para INSERT INTO pagos (mismo orden de columnas) con costo y ganancias
+    calculados, o None si el monto no es positivo.
+    """
+    if not monto_unit or monto_unit <= 0:
+        return None
+    costo = monto_unit / division_unit
+    ganancia = monto_unit - costo
+    ganancia_individual = ganancia / 2.0
+    return (
+        fecha_str,
+        tipo_cliente,
+        int(revendedor_id) if (tipo_cliente == "revendedor" and revendedor_id) else None,
+        nombre_particular if tipo_cliente == "particular" else None,
+        descripcion,
+        categoria_unit,
+        monto_unit,
+        division_unit,
+        costo,
+        ganancia,
+        ganancia_individual,
+        fecha_str[:7],
+    )
+
 
-    # Borrado lógico
-    cur.execute("""
-        UPDATE revendedores
-        SET activo = 0, updated_at = datetime('now')
-        WHERE id = ?
-    """, (rev_id,))
+def preparar_gasto(fecha_str, tipo, descripcion, monto, es_filamento):
+    """
+    Fila lista para INSERT INTO gastos (fecha, tipo, descripcion, monto, mes_clave,
+    es_filamento), o None si el monto no es positivo.
+    """
+    if not monto or monto <= 0:
+        return None
+    return (fecha_str, tipo, descripcion, monto, fecha_str[:7], 1 if es_filamento else 0)
 
-    conn.commit()
-    filas = cur.rowcount
-    conn.close()
 
-    if filas == 0:
-        return jsonify(ok=False, error="Revendedor no encontrado"), 200
+def preparar_entrega(data):
+    """
+    Valida el cuerpo de una entrega (mismo formato que POST /api/entregas).
+    Devuelve (cabecera, lineas, descuentos):
+      cabecera   = (fecha, tipo_cliente, revendedor_id, cliente_nombre, cantidad_total, total)
+      lineas     = [(producto_id, nombre_pieza, cantidad, precio_unitario, total), ...]
+      descuentos = {producto_id: cantidad} a descontar del stock
+    Lanza ValueError con el mensaje para el usuario.
+    """
+    tipo_cliente = (data.get("tipo_cliente") or "").strip()
+    revendedor_id = data.get("revendedor_id")
+    cliente_nombre = (data.get("cliente_nombre") or "").strip()
+    fecha = (data.get("fecha") or "").strip()
+    piezas = data.get("piezas") or []
 
-    return jsonify(ok=True), 200
+    if tipo_cliente not in ("revendedor", "particular"):
+        raise ValueError("Tipo de cliente inválido")
+    if not cliente_nombre:
+        raise ValueError("Falta nombre del cliente")
+    if not fecha:
+        raise ValueError("Falta la fecha de entrega")
+    if not piezas:
+        raise ValueError("La entrega no tiene piezas")
 
+    try:
+        revendedor_id = int(revendedor_id) if revendedor_id not in (None, "") else None
+        cantidad_total = int(data.get("cantidad_total") or 0)
+        total = float(data.get("total") or 0)
+    except (TypeError, ValueError):
+        raise ValueError("Revendedor, cantidad total o total inválidos")
+
+    # Líneas válidas y descuento total por producto (varias líneas pueden ser del mismo)
+    lineas = []
+    descuentos = {}
+    for n, item in enumerate(piezas, start=1):
+        try:
+            producto_id = int(item.get("producto_id")) if item.get("producto_id") not in (None, "") else None
+            nombre_pieza = item.get("nombre_pieza")
+            cantidad = int(item.get("cantidad") or 0)
+            precio_unit = float(item.get("precio_unitario") or 0)
+            total_item = float(item.get("total") or (cantidad * precio_unit))
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError(f"Pieza {n}: producto, cantidad o precio inválidos")
 
-@app.route("/entregas")
-def pagina_entregas():
-    revendedores = obtener_revendedores()
-    productos = obtener_productos()
+        if not nombre_pieza or cantidad <= 0:
+            continue
 
-    conn = get_conn()
-    cur = conn.cursor()
+        lineas.append((producto_id, nombre_pieza, cantidad, precio_unit, total_item))
+        if producto_id:
+            descuentos[producto_id] = descuentos.get(producto_id, 0) + cantidad
 
-    try:
-        asegurar_columnas_entregas(cur, conn)
+    cabecera = (fecha, tipo_cliente, revendedor_id, cliente_nombre, cantidad_total, total)
+    return cabecera, lineas, descuentos
 
-        cur.execute("""
-            SELECT
-                id,
-                fecha,
-                tipo_cliente,
-                cliente_nombre,
-                revendedor_id,
-                cantidad_total,
-                total,
-                IFNULL(tipo_movimiento, 'entrega') AS tipo_movimiento,
-                descripcion
-            FROM entregas
-            ORDER BY fecha DESC, id DESC
-            LIMIT 25;
-        """)
-        filas = cur.fetchall()
-        historial_entregas = [dict(f) for f in filas]
-    except sqlite3.OperationalError:
-        historial_entregas = []
-    finally:
-        conn.close()
 
-    return render_template(
-        "entregas.html",
-        revendedores=revendedores,
-        productos=productos,
-        piezas_en_stock=productos,
-        historial_entregas=historial_entregas
+_SQL_INSERTAR_PAGO = """
+    INSERT INTO pagos (
+        fecha, tipo_cliente, revendedor_id, nombre_particular,
+        descripcion, categoria_precio, monto, division,
+        costo, ganancia, ganancia_individual, mes_clave
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERTAR_GASTO = """
+    INSERT INTO gastos (fecha, tipo, descripcion, monto, mes_clave, es_filamento)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERTAR_ENTREGA = """
+    INSERT INTO entregas (
+        fecha, tipo_cliente, revendedor_id, cliente_nombre,
+        cantidad_total, total, tipo_movimiento, descripcion
+    )
+    VALUES (?, ?, ?, ?, ?, ?, 'entrega', NULL)
+"""
+
+_SQL_INSERTAR_ENTREGA_ITEM = """
+    INSERT INTO entrega_items (
+        entrega_id, producto_id, nombre_pieza,
+        cantidad, precio_unitario, total
     )
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
 
 
 # ---------------------------
@@ -311,46 +2188,15 @@ def cuentas():
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
-    # --- aseguramos tablas necesarias ---
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS pagos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha DATE NOT NULL,
-            tipo_cliente TEXT NOT NULL,
-            revendedor_id INTEGER,
-            nombre_particular TEXT,
-            descripcion TEXT,
-            categoria_precio TEXT NOT NULL,
-            monto REAL NOT NULL,
-            division INTEGER NOT NULL,
-            costo REAL NOT NULL,
-            ganancia REAL NOT NULL,
-            ganancia_individual REAL NOT NULL,
-            mes_clave TEXT NOT NULL
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS gastos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha DATE NOT NULL,
-            tipo TEXT NOT NULL,
-            descripcion TEXT,
-            monto REAL NOT NULL,
-            mes_clave TEXT NOT NULL
-        );
-    """)
-
-    try:
-        cur.execute("ALTER TABLE gastos ADD COLUMN es_filamento INTEGER DEFAULT 0")
-        conn.commit()
-    except sqlite3.OperationalError:
-        pass
-
     # ------------------ POST ------------------
     if request.method == "POST":
         form_type = request.form.get("form_type", "pago")
         redirect_mes = None
+        meses_tocados = set()
+
+        # Los meses cerrados no admiten altas ni ediciones: el chequeo y la escritura
+        # van en la misma transacción
+        cur.execute("BEGIN IMMEDIATE")
 
         # ------------- NUEVO PAGO -------------
         if form_type == "pago":
@@ -371,26 +2217,14 @@ def cuentas():
             dividir = request.form.get("dividir")
             mes_clave = fecha_str[:7]
 
-            def preparar_registro(monto_unit, division_unit, categoria_unit):
-                if not monto_unit or monto_unit <= 0:
-                    return None
-                costo = monto_unit / division_unit
-                ganancia = monto_unit - costo
-                ganancia_individual = ganancia / 2.0
-                return (
-                    fecha_str,
-                    tipo_cliente,
-                    int(revendedor_id) if (tipo_cliente == "revendedor" and revendedor_id) else None,
-                    nombre_particular if tipo_cliente == "particular" else None,
-                    descripcion,
-                    categoria_unit,
-                    monto_unit,
-                    division_unit,
-                    costo,
-                    ganancia,
-                    ganancia_individual,
-                    mes_clave,
-                )
+            def registro(monto_unit, division_unit, categoria_unit):
+                return preparar_registro(fecha_str, tipo_cliente, revendedor_id, nombre_particular,
+                                         descripcion, monto_unit, division_unit, categoria_unit)
+
+            error = error_mes_cerrado(cur, {mes_clave})
+            if error:
+                conn.close()
+                return redirect(url_for('cuentas', mes=mes_clave, error=error))
 
             registros = []
 
@@ -403,28 +2237,27 @@ def cuentas():
                 division2 = int(request.form.get("division2") or division_default)
                 categoria2 = request.form.get("categoria2") or categoria_default
 
-                reg1 = preparar_registro(monto1, division1, categoria1)
-                reg2 = preparar_registro(monto2, division2, categoria2)
+                reg1 = registro(monto1, division1, categoria1)
+                reg2 = registro(monto2, division2, categoria2)
                 if reg1:
                     registros.append(reg1)
                 if reg2:
                     registros.append(reg2)
             else:
-                reg = preparar_registro(monto_total, division_default, categoria_default)
+                reg = registro(monto_total, division_default, categoria_default)
                 if reg:
                     registros.append(reg)
 
+            nuevos_ids = []
             for r in registros:
-                cur.execute("""
-                    INSERT INTO pagos (
-                        fecha, tipo_cliente, revendedor_id, nombre_particular,
-                        descripcion, categoria_precio, monto, division,
-                        costo, ganancia, ganancia_individual, mes_clave
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, r)
+                cur.execute(_SQL_INSERTAR_PAGO, r)
+                nuevos_ids.append(cur.lastrowid)
+            acumular_saldos(cur, "pagos", nuevos_ids, 1)
+            acumular_resumen_mensual(cur, "pagos", nuevos_ids, 1)
             conn.commit()
             redirect_mes = mes_clave
+            if nuevos_ids:
+                meses_tocados.add(mes_clave)
 
         # ------------- NUEVO GASTO O PAGO AYUDANTE -------------
         elif form_type == "gasto":
@@ -435,13 +2268,18 @@ def cuentas():
             mes_clave_g = fecha_g[:7]
             es_filamento = 1 if request.form.get("es_filamento") in ("1", "on") else 0
 
-            if monto_g > 0:
-                cur.execute("""
-                    INSERT INTO gastos (fecha, tipo, descripcion, monto, mes_clave, es_filamento)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (fecha_g, tipo_g, descripcion_g, monto_g, mes_clave_g, es_filamento))
+            error = error_mes_cerrado(cur, {mes_clave_g})
+            if error:
+                conn.close()
+                return redirect(url_for('cuentas', mes=mes_clave_g, error=error))
+
+            reg_gasto = preparar_gasto(fecha_g, tipo_g, descripcion_g, monto_g, es_filamento)
+            if reg_gasto:
+                cur.execute(_SQL_INSERTAR_GASTO, reg_gasto)
+                acumular_resumen_mensual(cur, "gastos", [cur.lastrowid], 1)
                 conn.commit()
                 redirect_mes = mes_clave_g
+                meses_tocados.add(mes_clave_g)
 
         # ------------- EDITAR GASTO NORMAL -------------
         elif form_type == "gasto_edit":
@@ -453,13 +2291,21 @@ def cuentas():
             mes_clave_g = fecha_g[:7]
 
             if gasto_id and monto_g > 0:
+                meses_tocados.update(meses_afectados(cur, "gastos", [gasto_id]))
+                error = error_mes_cerrado(cur, meses_tocados | {mes_clave_g})
+                if error:
+                    conn.close()
+                    return redirect(url_for('cuentas', mes=mes_clave_g, error=error))
+                acumular_resumen_mensual(cur, "gastos", [gasto_id], -1)
                 cur.execute("""
                     UPDATE gastos
                     SET fecha = ?, descripcion = ?, monto = ?, mes_clave = ?, es_filamento = ?
                     WHERE id = ? AND tipo = 'gasto'
                 """, (fecha_g, descripcion_g, monto_g, mes_clave_g, es_filamento, gasto_id))
+                acumular_resumen_mensual(cur, "gastos", [gasto_id], 1)
                 conn.commit()
                 redirect_mes = mes_clave_g
+                meses_tocados.add(mes_clave_g)
 
         # ------------- EDITAR PAGO AYUDANTE -------------
         elif form_type == "pago_ayudante_edit":
@@ -470,24 +2316,34 @@ def cuentas():
             mes_clave_g = fecha_g[:7]
 
             if gasto_id and monto_g > 0:
+                meses_tocados.update(meses_afectados(cur, "gastos", [gasto_id]))
+                error = error_mes_cerrado(cur, meses_tocados | {mes_clave_g})
+                if error:
+                    conn.close()
+                    return redirect(url_for('cuentas', mes=mes_clave_g, error=error))
+                acumular_resumen_mensual(cur, "gastos", [gasto_id], -1)
                 cur.execute("""
                     UPDATE gastos
                     SET fecha = ?, descripcion = ?, monto = ?, mes_clave = ?
                     WHERE id = ? AND tipo = 'pago_ayudante'
                 """, (fecha_g, descripcion_g, monto_g, mes_clave_g, gasto_id))
+                acumular_resumen_mensual(cur, "gastos", [gasto_id], 1)
                 conn.commit()
                 redirect_mes = mes_clave_g
+                meses_tocados.add(mes_clave_g)
 
         conn.close()
+        if meses_tocados:
+            emitir_escritura("gasto" if form_type != "pago" else "pago", meses_tocados)
         if redirect_mes:
             return redirect(url_for('cuentas', mes=redirect_mes))
         return redirect(url_for('cuentas'))
 
     # ------------------ SELECTOR DE MESES ------------------
     cur.execute("""
-        SELECT mes_clave FROM pagos
-        UNION
-        SELECT mes_clave FROM gastos
+        SELECT mes_clave
+        FROM resumen_mensual
+        WHERE n_pagos > 0 OR n_gastos > 0
         ORDER BY mes_clave DESC
     """)
     filas_meses = cur.fetchall()
@@ -508,267 +2364,523 @@ def cuentas():
     meses = OrderedDict()
     hoy_str = datetime.now().strftime("%Y-%m-%d")
 
+    cierre = cierre_de_mes(cur, mes_seleccionado)
+
     # ------------------ PAGOS DEL MES ------------------
     if mes_seleccionado:
-        cur.execute("""
-            SELECT
-                p.*,
-                r.nombre AS revendedor_nombre
-            FROM pagos p
-            LEFT JOIN revendedores r ON p.revendedor_id = r.id
-            WHERE p.mes_clave = ?
-            ORDER BY p.fecha DESC, p.id DESC
-        """, (mes_seleccionado,))
-        rows = cur.fetchall()
-
-        grupos = {}
-        totales = {
-            "monto": 0.0,
-            "costo": 0.0,
-            "ganancia": 0.0,
-            "ganancia_individual": 0.0,
+        items, totales = agrupar_pagos_mes(cur, mes_seleccionado)
+        if cierre:
+            # Mes cerrado: los totales son los congelados al cerrarlo
+            totales = {c: float(cierre[c]) for c in ("monto", "costo", "ganancia", "ganancia_individual")}
+        meses[mes_seleccionado] = {
+            "items": items,
+            "totales": totales,
         }
 
-        for row in rows:
-            row = dict(row)
-            clave = (
-                row["fecha"],
-                row["tipo_cliente"],
-                row["revendedor_id"],
-                row["nombre_particular"],
-                row["descripcion"],
-            )
+    # ------------------ GASTOS + RESUMEN ------------------
+    resumen = calcular_resumen_cuentas(cur, mes_seleccionado, hoy_str)
 
-            if clave not in grupos:
-                grupos[clave] = {
-                    "ids": [row["id"]],
-                    "fecha": row["fecha"],
-                    "tipo_cliente": row["tipo_cliente"],
-                    "revendedor_id": row["revendedor_id"],
-                    "revendedor_nombre": row.get("revendedor_nombre"),
-                    "nombre_particular": row.get("nombre_particular"),
-                    "descripcion": row.get("descripcion"),
-                    "monto": float(row["monto"] or 0),
-                    "costo": float(row["costo"] or 0),
-                    "ganancia": float(row["ganancia"] or 0),
-                    "ganancia_individual": float(row["ganancia_individual"] or 0),
-                    "detalles": [
-                        {
-                            "monto": float(row["monto"] or 0),
-                            "division": int(row["division"] or 1),
-                            "categoria_precio": row["categoria_precio"],
-                        }
-                    ],
-                }
-            else:
-                g = grupos[clave]
-                g["ids"].append(row["id"])
-                g["monto"] += float(row["monto"] or 0)
-                g["costo"] += float(row["costo"] or 0)
-                g["ganancia"] += float(row["ganancia"] or 0)
-                g["ganancia_individual"] += float(row["ganancia_individual"] or 0)
-                g["detalles"].append(
-                    {
-                        "monto": float(row["monto"] or 0),
-                        "division": int(row["division"] or 1),
-                        "categoria_precio": row["categoria_precio"],
-                    }
-                )
+    resumen_mes = {
+        "gastos_mes": resumen.gastos_mes,
+        "pagado_ayudante": resumen.pagado_ayudante_mes,
+        "gi_bruta": resumen.gi_bruta_mes,
+        "gi_neta": resumen.gi_neta_mes,
+        "ayudante": resumen.ayudante_pendiente_global,
+    }
 
-            totales["monto"] += float(row["monto"] or 0)
-            totales["costo"] += float(row["costo"] or 0)
-            totales["ganancia"] += float(row["ganancia"] or 0)
-            totales["ganancia_individual"] += float(row["ganancia_individual"] or 0)
+    gastos_mes_list, pagos_ayudante_list = gastos_del_mes(cur, mes_seleccionado)
 
-        items = list(grupos.values())
-        items.sort(key=lambda g: (g["fecha"], max(g["ids"])), reverse=True)
+    cur.execute("SELECT id, nombre FROM revendedores WHERE activo = 1 ORDER BY nombre;")
+    revendedores = cur.fetchall()
 
-        meses[mes_seleccionado] = {
-            "items": items,
-            "totales": totales,
-        }
+    conn.close()
 
-    # ------------------ GASTOS + RESUMEN ------------------
-    resumen_mes = None
-    gastos_mes_list = []
-    pagos_ayudante_list = []
+    return render_template(
+        "cuentas.html",
+        meses=meses,
+        revendedores=revendedores,
+        meses_disponibles=meses_disponibles,
+        mes_seleccionado=mes_seleccionado,
+        resumen_mes=resumen_mes,
+        gastos_mes_list=gastos_mes_list,
+        pagos_ayudante_list=pagos_ayudante_list,
+        hoy=hoy_str,
+        para_filamento_mes=resumen.costo_mes,
+        filamento_gastado_mes=resumen.filamento_mes,
+        para_filamento_restante=resumen.para_filamento_restante,
+        dinero_pendiente_ingresar=resumen.pendiente_ingresar,
+        gastos_pendientes=resumen.gastos_pendientes,
+        gastos_pendientes_filamento=resumen.filamento_pendiente,
+        mes_cerrado=cierre,
+        mes_cerrable=cierre is None and mes_seleccionado < mes_hoy,
+        error=request.args.get("error"),
+    )
 
-    if mes_seleccionado:
-        cur.execute("""
-            SELECT
-              COALESCE(SUM(CASE
-                             WHEN tipo = 'gasto'
-                              AND IFNULL(es_filamento, 0) = 0
-                             THEN monto
-                             ELSE 0
-                           END), 0) AS total_gastos,
-              COALESCE(SUM(CASE
-                             WHEN tipo = 'pago_ayudante'
-                             THEN monto
-                             ELSE 0
-                           END), 0) AS total_pagos_ayudante
-            FROM gastos
-            WHERE mes_clave = ?
-        """, (mes_seleccionado,))
-        row_g = cur.fetchone()
-        total_gastos = float(row_g["total_gastos"] or 0) if row_g else 0.0
-        total_pagos_ayudante = float(row_g["total_pagos_ayudante"] or 0) if row_g else 0.0
-
-        # ------------------ GANANCIA INDIVIDUAL DEL MES ------------------
-        if mes_seleccionado in meses:
-            gi_bruta_mes = float(meses[mes_seleccionado]["totales"]["ganancia_individual"] or 0)
+
+# ---------------------------
+# REPORTE MENSUAL DE CUENTAS (PDF / CSV)
+# ---------------------------
+
+REPORTES_CACHE_DIR = Path(os.environ.get("REPORTES_CACHE_DIR", "reportes_cache"))
+# Subir cuando cambie el contenido del reporte: invalida los archivos cacheados.
+REPORTE_VERSION = "1"
+
+# Columnas del CSV (las secciones usan un subconjunto, en este orden)
+_COLUMNAS_REPORTE = ["fecha", "cliente", "descripcion", "detalle",
+                     "monto", "costo", "ganancia", "ganancia_individual"]
+
+
+def secciones_reporte_cuentas(cur, mes_clave):
+    """
+    Contenido del reporte del mes, con la misma agrupación de pagos que /cuentas.
+    Lista de secciones {"clave", "titulo", "columnas", "filas", "total"}; la usan
+    tanto el PDF como el CSV. Todo en orden cronológico.
+    """
+    items, totales = agrupar_pagos_mes(cur, mes_clave)
+    gastos, pagos_ayudante = gastos_del_mes(cur, mes_clave)
+    resumen = resumen_de_mes(cur, mes_clave)
+
+    def concepto(descripcion, monto):
+        return {"descripcion": descripcion, "monto": monto}
+
+    pagos = []
+    for g in reversed(items):
+        detalle = "; ".join(
+            f"{d['monto']:.2f} / {d['division']}" + (f" ({d['categoria_precio']})" if d["categoria_precio"] else "")
+            for d in reversed(g["detalles"])
+        )
+        pagos.append({
+            "fecha": g["fecha"],
+            "cliente": g["revendedor_nombre"] or g["nombre_particular"] or g["tipo_cliente"],
+            "descripcion": g["descripcion"] or "",
+            "detalle": detalle,
+            "monto": g["monto"],
+            "costo": g["costo"],
+            "ganancia": g["ganancia"],
+            "ganancia_individual": g["ganancia_individual"],
+        })
+
+    return [
+        {
+            "clave": "resumen",
+            "titulo": "Resumen del mes",
+            "columnas": [("descripcion", "Concepto", "texto"), ("monto", "Importe", "importe")],
+            "filas": [
+                concepto("Ingresos (pagos)", resumen.monto_mes),
+                concepto("Costos (para filamento)", resumen.costo_mes),
+                concepto("Ganancia individual bruta", resumen.gi_bruta_mes),
+                concepto("Gastos (sin filamento)", resumen.gastos_mes),
+                concepto("Ganancia individual neta", resumen.gi_neta_mes),
+                concepto("Filamento gastado", resumen.filamento_mes),
+                concepto("Pagado al ayudante", resumen.pagado_ayudante_mes),
+            ],
+            "total": None,
+        },
+        {
+            "clave": "pagos",
+            "titulo": "Pagos",
+            "columnas": [("fecha", "Fecha", "fecha"), ("cliente", "Cliente", "texto"),
+                         ("descripcion", "Descripción", "texto"), ("monto", "Monto", "importe"),
+                         ("costo", "Costo", "importe"), ("ganancia_individual", "G. indiv.", "importe")],
+            "filas": pagos,
+            "total": dict(totales, descripcion="TOTAL"),
+        },
+        {
+            "clave": "gastos",
+            "titulo": "Gastos",
+            "columnas": [("fecha", "Fecha", "fecha"), ("descripcion", "Descripción", "texto"),
+                         ("detalle", "Tipo", "texto"), ("monto", "Monto", "importe")],
+            "filas": [{"fecha": r["fecha"], "descripcion": r["descripcion"] or "",
+                       "detalle": "Filamento" if r["es_filamento"] else "Gasto",
+                       "monto": float(r["monto"] or 0)} for r in reversed(gastos)],
+            "total": {"descripcion": "TOTAL",
+                      "monto": sum((float(r["monto"] or 0) for r in gastos), 0.0)},
+        },
+        {
+            "clave": "pagos_ayudante",
+            "titulo": "Pagos al ayudante",
+            "columnas": [("fecha", "Fecha", "fecha"), ("descripcion", "Descripción", "texto"),
+                         ("monto", "Monto", "importe")],
+            "filas": [{"fecha": r["fecha"], "descripcion": r["descripcion"] or "",
+                       "monto": float(r["monto"] or 0)} for r in reversed(pagos_ayudante)],
+            "total": {"descripcion": "TOTAL",
+                      "monto": sum((float(r["monto"] or 0) for r in pagos_ayudante), 0.0)},
+        },
+    ]
+
+
+def _csv_reporte_cuentas(secciones):
+    """Un solo CSV plano: columna "seccion" + _COLUMNAS_REPORTE (los totales como total_<sección>)."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(["seccion"] + _COLUMNAS_REPORTE)
+
+    def fila(seccion, valores):
+        salida = [seccion]
+        for col in _COLUMNAS_REPORTE:
+            valor = valores.get(col)
+            salida.append(f"{valor:.2f}" if isinstance(valor, float) else ("" if valor is None else valor))
+        return salida
+
+    for s in secciones:
+        escritor.writerows(fila(s["clave"], f) for f in s["filas"])
+        if s["total"] is not None:
+            escritor.writerow(fila(f"total_{s['clave']}", s["total"]))
+    return buffer.getvalue().encode("utf-8")
+
+
+class CacheReportes:
+    """
+    Reportes ya generados de meses cerrados, en disco: cuentas_<mes>_<huella>.<formato>.
+    La huella sale de la fila de resumen_mensual del mes (cambia si cambian los importes o
+    la cantidad de registros); las ediciones que no tocan importes (fecha, descripción,
+    nombre de un revendedor) llegan por los eventos de escritura.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = Path(directorio).absolute()
+        self._lock = threading.Lock()
+        self._generacion = 0
+        self._stats = {"hits": 0, "misses": 0, "invalidados": 0}
+
+    @staticmethod
+    def huella(cur, mes_clave):
+        cur.execute("SELECT * FROM resumen_mensual WHERE mes_clave = ?", (mes_clave,))
+        row = cur.fetchone()
+        contenido = json.dumps([REPORTE_VERSION, PLANTILLA_VERSION, tuple(row) if row else None])
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()[:32]
+
+    def _ruta(self, mes_clave, formato, huella):
+        return self.directorio / f"cuentas_{mes_clave}_{huella}.{formato}"
+
+    def _archivos(self, patron):
+        return list(self.directorio.glob(patron)) if self.directorio.is_dir() else []
+
+    def obtener(self, mes_clave, formato, huella):
+        """
+        Devuelve (contenido o None, generación); la generación se pasa luego a guardar().
+        El archivo se lee bajo el lock: un invalidar() concurrente no lo borra a mitad.
+        """
+        ruta = self._ruta(mes_clave, formato, huella)
+        with self._lock:
+            try:
+                contenido = ruta.read_bytes()
+            except OSError:
+                self._stats["misses"] += 1
+                return None, self._generacion
+            self._stats["hits"] += 1
+            return contenido, self._generacion
+
+    def guardar(self, mes_clave, formato, huella, contenido, generacion):
+        """Guarda el archivo si no hubo escrituras mientras se generaba."""
+        with self._lock:
+            if generacion != self._generacion:
+                return False
+            ruta = guardar_archivo(contenido, self._ruta(mes_clave, formato, huella))
+            for vieja in self._archivos(f"cuentas_{mes_clave}_*.{formato}"):
+                if vieja != ruta:
+                    vieja.unlink(missing_ok=True)
+            return True
+
+    def invalidar(self, meses=None):
+        with self._lock:
+            self._generacion += 1
+            patrones = ["cuentas_*"] if meses is None else [f"cuentas_{m}_*" for m in meses]
+            for patron in patrones:
+                for p in self._archivos(patron):
+                    p.unlink(missing_ok=True)
+                    self._stats["invalidados"] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["archivos"] = len(self._archivos("cuentas_*"))
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / total) if total else 0.0
+        return stats
+
+
+cache_reportes = CacheReportes(REPORTES_CACHE_DIR)
+
+
+@al_escribir
+def _invalidar_reportes(tipo, meses):
+    # El reporte muestra el nombre del revendedor en cada pago.
+    if tipo == "revendedor":
+        cache_reportes.invalidar(None)
+    elif tipo in ("pago", "gasto", "cierre"):
+        cache_reportes.invalidar(meses)
+
+
+_TIPOS_REPORTE = {"pdf": "application/pdf", "csv": "text/csv"}
+
+
+@app.route("/cuentas/<mes>/reporte.<formato>", methods=["GET"])
+def reporte_cuentas_mes(mes, formato):
+    """
+    Reporte del mes (YYYY-MM) en PDF o CSV: resumen, pagos agrupados, gastos y pagos
+    al ayudante. Los meses ya cerrados (anteriores al actual) se sirven desde disco
+    hasta que una escritura los invalide; el mes en curso se arma siempre.
+    """
+    if formato not in _TIPOS_REPORTE:
+        return jsonify({"ok": False, "error": "Formato inválido (pdf o csv)"}), 400
+    if not re.match(r"^\d{4}-\d{2}$", mes):
+        return jsonify({"ok": False, "error": "El mes debe ser YYYY-MM"}), 400
+
+    cerrado = mes < datetime.now().strftime("%Y-%m")
+    nombre = f"CUENTAS_{mes}.{formato}"
+
+    conn = get_conn()
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("BEGIN")  # huella y datos de la misma foto de la base
+    try:
+        huella = generacion = contenido = None
+        if cerrado:
+            huella = CacheReportes.huella(cur, mes)
+            contenido, generacion = cache_reportes.obtener(mes, formato, huella)
+        if contenido is None:
+            secciones = secciones_reporte_cuentas(cur, mes)
+    finally:
+        conn.rollback()
+        conn.close()
+
+    if contenido is None:
+        if formato == "pdf":
+            contenido = build_reporte_cuentas_pdf(mes, secciones).getvalue()
         else:
-            gi_bruta_mes = 0.0
+            contenido = _csv_reporte_cuentas(secciones)
+        if cerrado:
+            cache_reportes.guardar(mes, formato, huella, contenido, generacion)
 
-        gi_neta_mes = gi_bruta_mes - (total_gastos / 2.0)
+    # ETag del contenido: la huella no cubre nombres ni descripciones editados.
+    return send_file(io.BytesIO(contenido), mimetype=_TIPOS_REPORTE[formato],
+                     as_attachment=True, download_name=nombre,
+                     etag=hashlib.sha256(contenido).hexdigest()[:32], conditional=True)
 
-        # ------------------ AYUDANTE PENDIENTE (GLOBAL REAL - HASTA HOY) ------------------
-        cur.execute("""
-            SELECT COALESCE(SUM(ganancia_individual), 0) AS total
-            FROM pagos
-            WHERE fecha <= ?
-        """, (hoy_str,))
-        row_gi = cur.fetchone()
-        gi_bruta_global = float(row_gi["total"] or 0) if row_gi else 0.0
 
-        cur.execute("""
-            SELECT COALESCE(SUM(monto), 0) AS total
-            FROM gastos
-            WHERE tipo = 'gasto'
-              AND IFNULL(es_filamento, 0) = 0
-              AND fecha <= ?
-        """, (hoy_str,))
-        row_gg = cur.fetchone()
-        total_gastos_global = float(row_gg["total"] or 0) if row_gg else 0.0
+@app.route("/api/cuentas/cierres", methods=["GET"])
+def api_meses_cerrados():
+    """Meses cerrados con sus totales congelados (del más nuevo al más viejo)."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT mes_clave, cerrado_en, {", ".join(_COLUMNAS_CIERRE)}
+        FROM meses_cerrados
+        ORDER BY mes_clave DESC
+    """)
+    columnas = ["mes_clave", "cerrado_en"] + _COLUMNAS_CIERRE
+    cierres = [dict(zip(columnas, tuple(f))) for f in cur.fetchall()]
+    conn.close()
+    return jsonify({"ok": True, "cierres": cierres})
 
-        cur.execute("""
-            SELECT COALESCE(SUM(monto), 0) AS total
-            FROM gastos
-            WHERE tipo = 'pago_ayudante'
-              AND fecha <= ?
-        """, (hoy_str,))
-        row_pa = cur.fetchone()
-        total_pagos_ayudante_global = float(row_pa["total"] or 0) if row_pa else 0.0
-
-        gi_neta_global = gi_bruta_global - (total_gastos_global / 2.0)
-        ayudante_pendiente_global = gi_neta_global - total_pagos_ayudante_global
-
-        resumen_mes = {
-            "gastos_mes": total_gastos,
-            "pagado_ayudante": total_pagos_ayudante,
-            "gi_bruta": gi_bruta_mes,
-            "gi_neta": gi_neta_mes,
-            "ayudante": ayudante_pendiente_global,
-        }
 
-        cur.execute("""
-            SELECT id, fecha, descripcion, tipo, monto, es_filamento
-            FROM gastos
-            WHERE mes_clave = ? AND tipo = 'gasto'
-            ORDER BY fecha DESC, id DESC
-        """, (mes_seleccionado,))
-        gastos_mes_list = [dict(r) for r in cur.fetchall()]
+@app.route("/api/cuentas/<mes>/cerrar", methods=["POST"])
+def api_cerrar_mes(mes):
+    """
+    Cierra un mes ya terminado: congela sus totales de pagos y gastos y desde ese
+    momento rechaza altas, ediciones y borrados con fecha en ese mes.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cierre = cerrar_mes(cur, mes)
+    except ValueError as e:
+        conn.close()
+        return jsonify({"ok": False, "error": str(e)}), 200
+    conn.commit()
+    conn.close()
+
+    emitir_escritura("cierre", {mes})
+    return jsonify({"ok": True, "cierre": cierre})
+
+
+@app.route("/api/cuentas/<mes>/reabrir", methods=["POST"])
+def api_reabrir_mes(mes):
+    """Reabre un mes cerrado (para corregir algo); se puede volver a cerrar después."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    reabierto = reabrir_mes(cur, mes)
+    conn.commit()
+    conn.close()
+
+    if not reabierto:
+        return jsonify({"ok": False, "error": f"El mes {mes} no está cerrado"}), 404
+    emitir_escritura("cierre", {mes})
+    return jsonify({"ok": True})
+
+
+# ---------------------------
+# IDEMPOTENCIA (Idempotency-Key)
+# ---------------------------
+
+IDEMPOTENCIA_TTL = float(os.environ.get("IDEMPOTENCIA_TTL_HORAS", "24")) * 3600
+_IDEMPOTENCIA_PURGA_CADA = 60
+_ultima_purga_idempotencia = {"ts": 0.0}
+
+
+def _purgar_idempotencia(cur, ahora):
+    # Barato pero no gratis: como mucho una vez por minuto por proceso.
+    if ahora - _ultima_purga_idempotencia["ts"] < _IDEMPOTENCIA_PURGA_CADA:
+        return
+    _ultima_purga_idempotencia["ts"] = ahora
+    cur.execute("DELETE FROM idempotencia WHERE creado < ?", (ahora - IDEMPOTENCIA_TTL,))
+
+
+def idempotente(vista):
+    """
+    Si el request trae Idempotency-Key, la primera respuesta (< 500) queda guardada
+    y los reintentos con la misma clave la reciben tal cual, sin volver a escribir.
+    La clave se reserva antes de ejecutar la vista: un reintento concurrente recibe 409.
+    Misma clave con otro body -> 422.
+    """
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        clave = (request.headers.get("Idempotency-Key") or "").strip()
+        if not clave:
+            return vista(*args, **kwargs)
+
+        if len(clave) > 255:
+            return jsonify({"ok": False, "error": "Idempotency-Key demasiado larga"}), 200
 
+        ruta = request.path
+        huella = hashlib.sha256(request.get_data()).hexdigest()
+        ahora = time.time()
+
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        _purgar_idempotencia(cur, ahora)
         cur.execute("""
-            SELECT id, fecha, descripcion, monto
-            FROM gastos
-            WHERE mes_clave = ? AND tipo = 'pago_ayudante'
-            ORDER BY fecha DESC, id DESC
-        """, (mes_seleccionado,))
-        pagos_ayudante_list = [dict(r) for r in cur.fetchall()]
+            INSERT OR IGNORE INTO idempotencia (ruta, clave, huella, creado)
+            VALUES (?, ?, ?, ?)
+        """, (ruta, clave, huella, ahora))
+        reservada = cur.rowcount == 1
+        if not reservada:
+            cur.execute("""
+                SELECT huella, estado, respuesta
+                FROM idempotencia
+                WHERE ruta = ? AND clave = ?
+            """, (ruta, clave))
+            previa = cur.fetchone()
+        conn.commit()
+        conn.close()
 
-    cur.execute("SELECT id, nombre FROM revendedores WHERE activo = 1 ORDER BY nombre;")
-    revendedores = cur.fetchall()
+        if not reservada:
+            if previa["huella"] != huella:
+                return jsonify({"ok": False, "error": "Idempotency-Key ya usada con otros datos"}), 422
+            if previa["estado"] is None:
+                return jsonify({"ok": False, "error": "La operación con esta Idempotency-Key sigue en curso"}), 409
+            resp = app.response_class(previa["respuesta"], status=previa["estado"],
+                                      mimetype="application/json")
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
 
-    # ------------------ PARA FILAMENTO (GLOBAL REAL - HASTA HOY) ------------------
-    cur.execute("""
-        SELECT COALESCE(SUM(costo), 0) as total
-        FROM pagos
-        WHERE fecha <= ?
-    """, (hoy_str,))
-    row = cur.fetchone()
-    total_costos_acumulados = float(row["total"] or 0)
+        try:
+            resp = app.make_response(vista(*args, **kwargs))
+        except Exception:
+            _liberar_idempotencia(ruta, clave)
+            raise
+
+        if resp.status_code >= 500:
+            # Error transitorio: se permite reintentar con la misma clave.
+            _liberar_idempotencia(ruta, clave)
+            return resp
+
+        conn = get_conn()
+        conn.execute("""
+            UPDATE idempotencia
+            SET estado = ?, respuesta = ?
+            WHERE ruta = ? AND clave = ?
+        """, (resp.status_code, resp.get_data(as_text=True), ruta, clave))
+        conn.commit()
+        conn.close()
+        return resp
+
+    return envoltura
+
+
+def _liberar_idempotencia(ruta, clave):
+    conn = get_conn()
+    conn.execute("DELETE FROM idempotencia WHERE ruta = ? AND clave = ?", (ruta, clave))
+    conn.commit()
+    conn.close()
+
+
+# ---------------------------
+# API ENTREGAS (JSON + creación)
+# ---------------------------
+
+@app.route("/api/entregas", methods=["GET"])
+def api_listar_entregas():
+    """
+    Historial paginado de entregas y devoluciones.
+    Query params: limit, cursor, revendedor_id, desde, hasta, tipo_movimiento, items=1.
+    La respuesta trae "siguiente": el cursor para pedir la página siguiente (o null).
+    """
+    args = request.args
+
+    try:
+        limite = int(args.get("limit") or 25)
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit inválido"}), 200
+    limite = max(1, min(limite, 200))
+
+    revendedor_id = None
+    if args.get("revendedor_id"):
+        try:
+            revendedor_id = int(args["revendedor_id"])
+        except ValueError:
+            return jsonify({"ok": False, "error": "revendedor_id inválido"}), 200
 
-    cur.execute("""
-        SELECT COALESCE(SUM(monto), 0) as total
-        FROM gastos
-        WHERE tipo = 'gasto'
-          AND IFNULL(es_filamento, 0) = 1
-          AND fecha <= ?
-    """, (hoy_str,))
-    row = cur.fetchone()
-    total_filamento_acumulado = float(row["total"] or 0)
+    desde = (args.get("desde") or "").strip() or None
+    hasta = (args.get("hasta") or "").strip() or None
+    for valor in (desde, hasta):
+        if valor and not RE_FECHA.match(valor):
+            return jsonify({"ok": False, "error": "Las fechas deben ser YYYY-MM-DD"}), 200
 
-    para_filamento_restante = total_costos_acumulados - total_filamento_acumulado
+    tipo_movimiento = (args.get("tipo_movimiento") or "").strip() or None
+    if tipo_movimiento not in (None, "entrega", "devolucion"):
+        return jsonify({"ok": False, "error": "tipo_movimiento inválido"}), 200
 
-    # ------------------ NUEVOS BLOQUES GLOBALES PENDIENTES (HASTA QUE LLEGUE LA FECHA) ------------------
-    cur.execute("""
-        SELECT COALESCE(SUM(monto), 0) AS total
-        FROM pagos
-        WHERE fecha > ?
-    """, (hoy_str,))
-    row = cur.fetchone()
-    dinero_pendiente_ingresar = float(row["total"] or 0) if row else 0.0
+    cursor = None
+    if args.get("cursor"):
+        partes = _decodificar_cursor(args["cursor"], 2)
+        if not partes or not partes[1].isdigit():
+            return jsonify({"ok": False, "error": "cursor inválido"}), 200
+        cursor = (partes[0], int(partes[1]))
 
-    cur.execute("""
-        SELECT COALESCE(SUM(monto), 0) AS total
-        FROM gastos
-        WHERE tipo = 'gasto'
-          AND IFNULL(es_filamento, 0) = 0
-          AND fecha > ?
-    """, (hoy_str,))
-    row = cur.fetchone()
-    gastos_pendientes = float(row["total"] or 0) if row else 0.0
+    incluir_items = args.get("items") in ("1", "true", "on")
 
-    cur.execute("""
-        SELECT COALESCE(SUM(monto), 0) AS total
-        FROM gastos
-        WHERE tipo = 'gasto'
-          AND IFNULL(es_filamento, 0) = 1
-          AND fecha > ?
-    """, (hoy_str,))
-    row = cur.fetchone()
-    gastos_pendientes_filamento = float(row["total"] or 0) if row else 0.0
+    conn = get_conn()
+    cur = conn.cursor()
 
-    # ------------------ DATOS DEL MES (solo informativos) ------------------
-    para_filamento_mes = 0.0
-    if mes_seleccionado and mes_seleccionado in meses:
-        para_filamento_mes = float(meses[mes_seleccionado]["totales"]["costo"] or 0)
+    entregas, hay_mas = listar_entregas(
+        cur,
+        limite=limite,
+        cursor=cursor,
+        revendedor_id=revendedor_id,
+        desde=desde,
+        hasta=hasta,
+        tipo_movimiento=tipo_movimiento,
+    )
 
-    filamento_gastado_mes = 0.0
-    try:
-        filamento_gastado_mes = sum(
-            float(g.get("monto") or 0)
-            for g in (gastos_mes_list or [])
-            if int(g.get("es_filamento") or 0) == 1
-        )
-    except Exception:
-        filamento_gastado_mes = 0.0
+    if incluir_items and entregas:
+        items = items_de_entregas(cur, [e["id"] for e in entregas])
+        for e in entregas:
+            e["items"] = items[e["id"]]
 
     conn.close()
 
-    return render_template(
-        "cuentas.html",
-        meses=meses,
-        revendedores=revendedores,
-        meses_disponibles=meses_disponibles,
-        mes_seleccionado=mes_seleccionado,
-        resumen_mes=resumen_mes,
-        gastos_mes_list=gastos_mes_list,
-        pagos_ayudante_list=pagos_ayudante_list,
-        hoy=hoy_str,
-        para_filamento_mes=para_filamento_mes,
-        filamento_gastado_mes=filamento_gastado_mes,
-        para_filamento_restante=para_filamento_restante,
-        dinero_pendiente_ingresar=dinero_pendiente_ingresar,
-        gastos_pendientes=gastos_pendientes,
-        gastos_pendientes_filamento=gastos_pendientes_filamento,
-    )
+    siguiente = None
+    if hay_mas:
+        ultima = entregas[-1]
+        siguiente = _codificar_cursor(ultima["fecha"], ultima["id"])
 
+    return jsonify({"ok": True, "entregas": entregas, "siguiente": siguiente})
 
-# ---------------------------
-# API ENTREGAS (JSON + creación)
-# ---------------------------
 
 @app.route("/api/entregas/<int:entrega_id>", methods=["GET"])
 def api_entrega_detalle(entrega_id):
@@ -779,11 +2891,6 @@ def api_entrega_detalle(entrega_id):
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
-    try:
-        asegurar_columnas_entregas(cur, conn)
-    except Exception:
-        pass
-
     cur.execute("""
         SELECT
             id,
@@ -826,74 +2933,33 @@ def api_entrega_detalle(entrega_id):
 
 
 @app.route("/api/entregas", methods=["POST"])
+@idempotente
 def api_crear_entrega():
     data = request.get_json(force=True) or {}
 
-    tipo_cliente = (data.get("tipo_cliente") or "").strip()
-    revendedor_id = data.get("revendedor_id")
-    cliente_nombre = (data.get("cliente_nombre") or "").strip()
-    fecha = (data.get("fecha") or "").strip()
-    piezas = data.get("piezas") or []
-    cantidad_total = int(data.get("cantidad_total") or 0)
-    total = float(data.get("total") or 0)
-
-    if tipo_cliente not in ("revendedor", "particular"):
-        return jsonify({"error": "Tipo de cliente inválido"}), 400
-    if not cliente_nombre:
-        return jsonify({"error": "Falta nombre del cliente"}), 400
-    if not fecha:
-        return jsonify({"error": "Falta la fecha de entrega"}), 400
-    if not piezas:
-        return jsonify({"error": "La entrega no tiene piezas"}), 400
+    try:
+        cabecera, lineas, descuentos = preparar_entrega(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     conn = get_conn()
     cur = conn.cursor()
 
     try:
-        asegurar_columnas_entregas(cur, conn)
+        # Lock de escritura desde el principio: nadie más toca el stock hasta el commit.
+        cur.execute("BEGIN IMMEDIATE")
 
         # CABECERA
-        cur.execute("""
-            INSERT INTO entregas (
-                fecha, tipo_cliente, revendedor_id, cliente_nombre,
-                cantidad_total, total, tipo_movimiento, descripcion
-            )
-            VALUES (?, ?, ?, ?, ?, ?, 'entrega', ?)
-        """,
-            (fecha, tipo_cliente, revendedor_id, cliente_nombre, cantidad_total, total, None))
-
+        cur.execute(_SQL_INSERTAR_ENTREGA, cabecera)
         entrega_id = cur.lastrowid
+        acumular_saldos(cur, "entregas", [entrega_id], 1)
 
-        # ITEMS + descuento de stock
-        for item in piezas:
-            producto_id = item.get("producto_id")
-            nombre_pieza = item.get("nombre_pieza")
-            cantidad = int(item.get("cantidad") or 0)
-            precio_unit = float(item.get("precio_unitario") or 0)
-            total_item = float(item.get("total") or (cantidad * precio_unit))
-
-            if not nombre_pieza or cantidad <= 0:
-                continue
+        # ITEMS
+        cur.executemany(_SQL_INSERTAR_ENTREGA_ITEM, [(entrega_id, *linea) for linea in lineas])
 
-            cur.execute("""
-                INSERT INTO entrega_items (
-                    entrega_id, producto_id, nombre_pieza,
-                    cantidad, precio_unitario, total
-                )
-                VALUES (?, ?, ?, ?, ?, ?)
-            """,
-                (entrega_id, producto_id, nombre_pieza, cantidad, precio_unit, total_item))
-
-            if producto_id:
-                cur.execute("SELECT stock FROM productos WHERE id = ?", (producto_id,))
-                fila = cur.fetchone()
-                if fila:
-                    nuevo_stock = max(0, (fila["stock"] or 0) - cantidad)
-                    cur.execute("""
-                        UPDATE productos
-                        SET stock = ?, updated_at = datetime('now')
-                        WHERE id = ?
-                    """, (nuevo_stock, producto_id))
+        # Descuento de stock atómico (sin leer antes), nunca por debajo de 0, con journal
+        mover_stock(cur, [(producto_id, -cantidad) for producto_id, cantidad in descuentos.items()],
+                    "entrega", entrega_id)
 
         conn.commit()
 
@@ -903,10 +2969,13 @@ def api_crear_entrega():
     finally:
         conn.close()
 
+    emitir_escritura("entrega", {cabecera[0][:7]})
+    prerenderizar_pdf_entrega(entrega_id)
     return jsonify({"ok": True, "entrega_id": entrega_id})
 
 
 @app.route("/api/devoluciones", methods=["POST"])
+@idempotente
 def api_crear_devolucion():
     """
     Registra una devolución monetaria para un revendedor.
@@ -938,8 +3007,6 @@ def api_crear_devolucion():
     cur = conn.cursor()
 
     try:
-        asegurar_columnas_entregas(cur, conn)
-
         cur.execute("""
             SELECT id, nombre
             FROM revendedores
@@ -972,16 +3039,19 @@ def api_crear_devolucion():
             -abs(monto),
             descripcion
         ))
+        devolucion_id = cur.lastrowid
+        acumular_saldos(cur, "entregas", [devolucion_id], 1)
 
         conn.commit()
-        devolucion_id = cur.lastrowid
 
     except Exception as e:
         conn.rollback()
         conn.close()
-        return jsonify({"ok": False, "error": f"No se pudo guardar la devolución: {e}"}), 200
+        # 5xx: el fallo es transitorio y @idempotente libera la clave para reintentar
+        return jsonify({"ok": False, "error": f"No se pudo guardar la devolución: {e}"}), 500
 
     conn.close()
+    emitir_escritura("entrega", {fecha[:7]})
     return jsonify({"ok": True, "devolucion_id": devolucion_id}), 200
 
 
@@ -1032,10 +3102,17 @@ def api_crear_producto():
         VALUES (?, ?, ?, ?, ?, ?, ?, 1, datetime('now'), datetime('now'))
     """,
         (nombre, tipo_pieza, subtipo, stock, precio, precio_rev, notas))
+    nuevo_id = cur.lastrowid
+
+    if stock:
+        cur.execute("""
+            INSERT INTO stock_movimientos (producto_id, delta, motivo)
+            VALUES (?, ?, 'alta')
+        """, (nuevo_id, stock))
 
     conn.commit()
-    nuevo_id = cur.lastrowid
     conn.close()
+    emitir_escritura("stock", set())
 
     return jsonify({"ok": True, "id": nuevo_id})
 
@@ -1059,6 +3136,8 @@ def api_actualizar_producto(producto_id):
 
     conn = get_conn()
     cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    fijar_stock(cur, producto_id, stock)
     cur.execute("""
         UPDATE productos
         SET nombre = ?, tipo_pieza = ?, subtipo = ?, stock = ?,
@@ -1069,17 +3148,73 @@ def api_actualizar_producto(producto_id):
             data["nombre"], data["tipo_pieza"], data["subtipo"], stock,
             precio, precio_rev, data["notas"], producto_id
         ))
+    filas_afectadas = cur.rowcount
 
     conn.commit()
-    filas_afectadas = cur.rowcount
     conn.close()
 
     if filas_afectadas == 0:
         return jsonify({"error": "Producto no encontrado"}), 404
 
+    emitir_escritura("stock", set())
     return jsonify({"ok": True})
 
 
+@app.route("/api/productos/<int:producto_id>/movimientos", methods=["GET"])
+def api_movimientos_stock_producto(producto_id):
+    """Journal de stock de un producto, más reciente primero. ?limit= (máx 500)."""
+    try:
+        limite = min(max(int(request.args.get("limit", 100)), 1), 500)
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit inválido"}), 200
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, fecha, delta, motivo, entrega_id
+        FROM stock_movimientos
+        WHERE producto_id = ?
+        ORDER BY id DESC
+        LIMIT ?
+    """, (producto_id, limite))
+    filas = [dict(f) for f in cur.fetchall()]
+    conn.close()
+
+    return jsonify({"ok": True, "movimientos": filas})
+
+
+@app.route("/api/stock/historico", methods=["GET"])
+def api_stock_historico():
+    """
+    Stock reconstruido a una fecha: ?fecha=YYYY-MM-DD[ HH:MM:SS]&producto_id=
+    Usa el último snapshot anterior a la fecha + los movimientos posteriores.
+    """
+    fecha = (request.args.get("fecha") or "").strip()
+    if not RE_FECHA.match(fecha[:10]) or len(fecha) not in (10, 19):
+        return jsonify({"ok": False, "error": "fecha inválida (YYYY-MM-DD[ HH:MM:SS])"}), 200
+
+    producto_id = request.args.get("producto_id")
+    try:
+        producto_id = int(producto_id) if producto_id else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "producto_id inválido"}), 200
+
+    conn = get_conn()
+    cur = conn.cursor()
+    filas, snapshot = stock_a_fecha(cur, fecha, producto_id)
+    cur.execute("SELECT MIN(fecha) FROM stock_movimientos")
+    historial_desde = cur.fetchone()[0]
+    conn.close()
+
+    return jsonify({
+        "ok": True,
+        "fecha": fecha,
+        "snapshot": dict(snapshot) if snapshot else None,
+        "historial_desde": historial_desde,
+        "productos": [dict(f) for f in filas],
+    })
+
+
 @app.route("/api/productos/<int:producto_id>", methods=["DELETE"])
 def api_borrar_producto(producto_id):
     conn = get_conn()
@@ -1114,56 +3249,35 @@ def api_revendedores():
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
-    try:
-        asegurar_columnas_entregas(cur, conn)
-    except Exception:
-        pass
-
     # ------------------- GET: LISTAR -------------------
     if request.method == "GET":
+        # Saldos materializados: una fila por revendedor, sin recorrer el historial.
         cur.execute("""
             SELECT
-                id,
-                nombre,
-                contacto,
-                notas,
-                saldo_inicial,
-                created_at,
-                updated_at
-            FROM revendedores
-            WHERE activo = 1
-            ORDER BY nombre;
+                r.id,
+                r.nombre,
+                r.contacto,
+                r.notas,
+                r.saldo_inicial,
+                r.created_at,
+                r.updated_at,
+                COALESCE(s.total_entregas, 0) AS suma_entregas,
+                COALESCE(s.total_pagos, 0) AS suma_pagos
+            FROM revendedores r
+            LEFT JOIN revendedor_saldos s ON s.revendedor_id = r.id
+            WHERE r.activo = 1
+            ORDER BY r.nombre;
         """)
         filas = cur.fetchall()
 
         resultado = []
 
         for r in filas:
-            rev_id = r["id"]
-            saldo_base = float(r["saldo_inicial"] or 0)
-
-            cur.execute("""
-                SELECT COALESCE(SUM(total), 0) AS suma_entregas
-                FROM entregas
-                WHERE tipo_cliente = 'revendedor'
-                  AND revendedor_id = ?
-            """, (rev_id,))
-            row_ent = cur.fetchone()
-            suma_entregas = float(row_ent["suma_entregas"] or 0) if row_ent else 0.0
-
-            cur.execute("""
-                SELECT COALESCE(SUM(monto), 0) AS suma_pagos
-                FROM pagos
-                WHERE tipo_cliente = 'revendedor'
-                  AND revendedor_id = ?
-            """, (rev_id,))
-            row_pag = cur.fetchone()
-            suma_pagos = float(row_pag["suma_pagos"] or 0) if row_pag else 0.0
-
-            saldo_actual = saldo_base + suma_entregas - suma_pagos
-
             d = dict(r)
-            d["saldo_actual"] = saldo_actual
+            saldo_base = float(d["saldo_inicial"] or 0)
+            suma_entregas = float(d.pop("suma_entregas") or 0)
+            suma_pagos = float(d.pop("suma_pagos") or 0)
+            d["saldo_actual"] = saldo_base + suma_entregas - suma_pagos
             resultado.append(d)
 
         conn.close()
@@ -1246,6 +3360,8 @@ def api_actualizar_revendedor(rev_id):
     if filas == 0:
         return jsonify({"error": "Revendedor no encontrado"}), 404
 
+    emitir_escritura("revendedor")
+
     return jsonify({"ok": True})
 
 
@@ -1263,218 +3379,680 @@ def api_borrar_revendedor(rev_id):
     filas = cur.rowcount
     conn.close()
 
-    if filas == 0:
-        return jsonify({"error": "Revendedor no encontrado"}), 404
+    if filas == 0:
+        return jsonify({"error": "Revendedor no encontrado"}), 404
+
+    return jsonify({"ok": True})
+
+
+# Libro mayor de un revendedor: entregas y devoluciones suman al saldo (te debe),
+# pagos restan con su signo (la misma regla que revendedor_saldos).
+# Orden cronológico: fecha, luego entrega < devolución < pago, luego id.
+_SQL_ORDEN_ENTREGA = """
+    CASE COALESCE(NULLIF(tipo_movimiento, ''), 'entrega')
+        WHEN 'entrega' THEN 0
+        WHEN 'devolucion' THEN 1
+        ELSE 2
+    END"""
+
+# Cada tabla aporta solo sus primeras :limite filas en el orden pedido: con los índices
+# por (revendedor_id, fecha) se lee la página y no toda la historia del revendedor.
+_SQL_LEDGER_REVENDEDOR = """
+    SELECT * FROM (
+        SELECT
+            id,
+            fecha,
+            {orden_entrega} AS orden,
+            COALESCE(NULLIF(tipo_movimiento, ''), 'entrega') AS tipo,
+            CASE
+                WHEN tipo_movimiento = 'devolucion'
+                THEN COALESCE(NULLIF(descripcion, ''), 'Devolución #' || id)
+                ELSE 'Entrega #' || id || ' · ' || IFNULL(cantidad_total, 0) || ' piezas'
+            END AS descripcion,
+            COALESCE(total, 0) AS monto
+        FROM entregas
+        WHERE tipo_cliente = 'revendedor'
+          AND revendedor_id = :rev_id
+          {filtro_entregas}
+        ORDER BY fecha {direccion}, orden {direccion}, id {direccion}
+        LIMIT :limite
+    )
+    UNION ALL
+    SELECT * FROM (
+        SELECT
+            id,
+            fecha,
+            2 AS orden,
+            'pago' AS tipo,
+            COALESCE(NULLIF(descripcion, ''), 'Pago recibido #' || id) AS descripcion,
+            -COALESCE(monto, 0) AS monto
+        FROM pagos
+        WHERE tipo_cliente = 'revendedor'
+          AND revendedor_id = :rev_id
+          {filtro_pagos}
+        ORDER BY fecha {direccion}, id {direccion}
+        LIMIT :limite
+    )
+"""
+
+
+def _filtro_ledger(condiciones, orden):
+    # Las condiciones usan {orden}: la expresión de orden de cada tabla.
+    return "".join(f" AND ({c.format(orden=orden)})" for c in condiciones)
+
+
+def _suma_ledger(cur, rev_id, condicion, params):
+    """Suma del libro mayor del revendedor (entregas - pagos) en las filas que cumplen `condicion`."""
+    cur.execute(f"""
+        SELECT
+            (SELECT COALESCE(SUM(total), 0)
+             FROM entregas
+             WHERE tipo_cliente = 'revendedor'
+               AND revendedor_id = :rev_id
+               {_filtro_ledger([condicion], _SQL_ORDEN_ENTREGA)})
+          - (SELECT COALESCE(SUM(monto), 0)
+             FROM pagos
+             WHERE tipo_cliente = 'revendedor'
+               AND revendedor_id = :rev_id
+               {_filtro_ledger([condicion], "2")})
+    """, dict(params, rev_id=rev_id))
+    return float(cur.fetchone()[0] or 0)
+
+
+def saldo_actual_revendedor(cur, rev_id, saldo_inicial):
+    """Saldo de hoy: saldo inicial + revendedor_saldos, sin recorrer el historial."""
+    cur.execute("""
+        SELECT total_entregas - total_pagos
+        FROM revendedor_saldos
+        WHERE revendedor_id = ?
+    """, (rev_id,))
+    row = cur.fetchone()
+    return float(saldo_inicial or 0) + (float(row[0] or 0) if row else 0.0)
+
+
+def consultar_movimientos(cur, rev_id, saldo_inicial, desde=None, hasta=None,
+                          cursor=None, limite=None, descendente=True):
+    """
+    Ejecuta una página del libro mayor del revendedor y deja el cursor SQLite listo
+    para leer. El SUM() OVER corre solo sobre la página; el saldo con el que arranca
+    sale de un agregado indexado: hacia atrás, el saldo materializado menos lo que es
+    más nuevo que la página; hacia adelante, el saldo inicial más lo anterior.
+    cursor es (fecha, orden, id) de la última fila ya vista.
+    """
+    condiciones = []
+    params = {"rev_id": rev_id, "limite": -1 if limite is None else limite}
+
+    if desde:
+        condiciones.append("fecha >= :desde")
+        params["desde"] = desde
+    if hasta:
+        condiciones.append("fecha <= :hasta")
+        params["hasta"] = hasta
+    if cursor is not None:
+        operador = "<" if descendente else ">"
+        condiciones.append(f"fecha {operador}= :c_fecha AND "
+                           f"(fecha, {{orden}}, id) {operador} (:c_fecha, :c_orden, :c_id)")
+        params.update(c_fecha=cursor[0], c_orden=cursor[1], c_id=cursor[2])
+
+    if descendente:
+        # Saldo después de la fila más nueva de la página
+        base = saldo_actual_revendedor(cur, rev_id, saldo_inicial)
+        if cursor is not None:
+            base -= _suma_ledger(cur, rev_id, "fecha >= :c_fecha AND "
+                                 "(fecha, {orden}, id) >= (:c_fecha, :c_orden, :c_id)", params)
+        elif hasta:
+            base -= _suma_ledger(cur, rev_id, "fecha > :hasta", params)
+        acumulado = ":base + monto - SUM(monto)"
+    else:
+        # Saldo antes de la fila más vieja de la página
+        base = float(saldo_inicial or 0)
+        if cursor is not None:
+            base += _suma_ledger(cur, rev_id, "fecha <= :c_fecha AND "
+                                 "(fecha, {orden}, id) <= (:c_fecha, :c_orden, :c_id)", params)
+        elif desde:
+            base += _suma_ledger(cur, rev_id, "fecha < :desde", params)
+        acumulado = ":base + SUM(monto)"
+    params["base"] = base
+
+    direccion = "DESC" if descendente else "ASC"
+    ledger = _SQL_LEDGER_REVENDEDOR.format(
+        orden_entrega=_SQL_ORDEN_ENTREGA,
+        filtro_entregas=_filtro_ledger(condiciones, _SQL_ORDEN_ENTREGA),
+        filtro_pagos=_filtro_ledger(condiciones, "2"),
+        direccion=direccion,
+    )
+    cur.execute(f"""
+        WITH pagina AS ({ledger})
+        SELECT
+            id, fecha, tipo, orden, descripcion, monto,
+            {acumulado} OVER (
+                ORDER BY fecha {direccion}, orden {direccion}, id {direccion}
+                ROWS UNBOUNDED PRECEDING
+            ) AS saldo_posterior
+        FROM pagina
+        ORDER BY fecha {direccion}, orden {direccion}, id {direccion}
+        LIMIT :limite
+    """, params)
+    return cur
+
+
+def _movimiento_visible(fila):
+    """
+    Fila del libro mayor -> formato del popup.
+    Visible: entrega en negativo, devolución en positivo y pago con el signo con que
+    se cargó (en el libro mayor resta, así que es -monto).
+    """
+    tipo = fila["tipo"]
+    monto = float(fila["monto"] or 0)
+
+    if tipo == "entrega":
+        total_visible = -abs(monto)
+    elif tipo == "pago":
+        total_visible = -monto
+    else:
+        total_visible = abs(monto)
+
+    return {
+        "entrega_id": fila["id"] if tipo != "pago" else None,
+        "fecha": fila["fecha"],
+        "descripcion": fila["descripcion"],
+        "total": total_visible,
+        "saldo_posterior": float(fila["saldo_posterior"] or 0),
+        "tipo": tipo,
+    }
+
+
+@app.route("/api/revendedores/<int:rev_id>/movimientos", methods=["GET"])
+def api_movimientos_revendedor(rev_id):
+    """
+    Movimientos (entregas + devoluciones + pagos) de un revendedor, con saldo acumulado,
+    del más nuevo al más viejo.
+    Entregas suman al saldo (te debe).
+    Devoluciones restan al saldo.
+    Pagos restan al saldo.
+    Query params: limit (def. 50), cursor, desde, hasta.
+    """
+    args = request.args
+
+    try:
+        limite = int(args.get("limit") or 50)
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit inválido"}), 200
+    limite = max(1, min(limite, 500))
+
+    desde = (args.get("desde") or "").strip() or None
+    hasta = (args.get("hasta") or "").strip() or None
+    for valor in (desde, hasta):
+        if valor and not RE_FECHA.match(valor):
+            return jsonify({"ok": False, "error": "Las fechas deben ser YYYY-MM-DD"}), 200
+
+    cursor = None
+    if args.get("cursor"):
+        partes = _decodificar_cursor(args["cursor"], 3)
+        if not partes or not partes[1].isdigit() or not partes[2].isdigit():
+            return jsonify({"ok": False, "error": "cursor inválido"}), 200
+        cursor = (partes[0], int(partes[1]), int(partes[2]))
+
+    conn = get_conn()
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+
+    cur.execute("SELECT saldo_inicial FROM revendedores WHERE id = ?", (rev_id,))
+    row_rev = cur.fetchone()
+    if not row_rev:
+        conn.close()
+        return jsonify({"error": "Revendedor no encontrado"}), 404
+
+    consultar_movimientos(
+        cur, rev_id, row_rev["saldo_inicial"],
+        desde=desde, hasta=hasta, cursor=cursor, limite=limite + 1,
+    )
+    filas = cur.fetchall()
+    conn.close()
+
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    movimientos = [_movimiento_visible(f) for f in filas]
+
+    siguiente = None
+    if hay_mas:
+        ultima = filas[-1]
+        siguiente = _codificar_cursor(ultima["fecha"], ultima["orden"], ultima["id"])
+
+    return jsonify({"ok": True, "movimientos": movimientos, "siguiente": siguiente})
+
+
+@app.route("/api/revendedores/<int:rev_id>/saldo", methods=["GET"])
+def api_saldo_revendedor(rev_id):
+    """
+    Saldo de un revendedor al cierre de una fecha (?fecha=YYYY-MM-DD, por defecto hoy).
+    """
+    fecha = (request.args.get("fecha") or "").strip() or datetime.now().strftime("%Y-%m-%d")
+    if not RE_FECHA.match(fecha):
+        return jsonify({"ok": False, "error": "La fecha debe ser YYYY-MM-DD"}), 200
+
+    conn = get_conn()
+    cur = conn.cursor()
+
+    cur.execute("SELECT saldo_inicial FROM revendedores WHERE id = ?", (rev_id,))
+    row_rev = cur.fetchone()
+    if not row_rev:
+        conn.close()
+        return jsonify({"ok": False, "error": "Revendedor no encontrado"}), 404
+
+    saldo = saldo_revendedor_a_fecha(cur, rev_id, row_rev[0], fecha)
+    conn.close()
+
+    return jsonify({"ok": True, "fecha": fecha, "saldo": saldo})
+
+
+def saldo_revendedor_a_fecha(cur, rev_id, saldo_inicial, fecha, incluir_fecha=True):
+    """
+    Saldo del revendedor al cierre de `fecha` (o justo antes de ese día si
+    incluir_fecha=False): saldo inicial + entregas/devoluciones - pagos.
+    """
+    operador = "<=" if incluir_fecha else "<"
+    return float(saldo_inicial or 0) + _suma_ledger(cur, rev_id, f"fecha {operador} :fecha",
+                                                    {"fecha": fecha})
+
+
+# Hasta este tamaño el PDF del estado de cuenta queda en memoria; después pasa a disco.
+ESTADO_CUENTA_MEMORIA_MAX = 8 * 1024 * 1024
+
+
+@app.route("/revendedores/<int:rev_id>/estado.pdf", methods=["GET"])
+def descargar_estado_cuenta(rev_id):
+    """
+    Estado de cuenta del revendedor en PDF (?desde=&hasta=YYYY-MM-DD, opcionales):
+    movimientos en orden cronológico con el saldo después de cada uno.
+    El PDF se arma leyendo el libro mayor fila a fila desde el cursor y se escribe en
+    un archivo temporal que pasa a disco si crece, así miles de movimientos no
+    terminan en una lista ni en un buffer gigante en memoria.
+    """
+    desde = (request.args.get("desde") or "").strip() or None
+    hasta = (request.args.get("hasta") or "").strip() or None
+    for valor in (desde, hasta):
+        if valor and not RE_FECHA.match(valor):
+            return jsonify({"ok": False, "error": "Las fechas deben ser YYYY-MM-DD"}), 400
+    if desde and hasta and desde > hasta:
+        return jsonify({"ok": False, "error": "'desde' no puede ser posterior a 'hasta'"}), 400
+
+    conn = get_conn()
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+
+    cur.execute("SELECT nombre, saldo_inicial FROM revendedores WHERE id = ?", (rev_id,))
+    row_rev = cur.fetchone()
+    if not row_rev:
+        conn.close()
+        return jsonify({"ok": False, "error": "Revendedor no encontrado"}), 404
+
+    saldo_anterior = float(row_rev["saldo_inicial"] or 0)
+    if desde:
+        saldo_anterior = saldo_revendedor_a_fecha(
+            cur, rev_id, row_rev["saldo_inicial"], desde, incluir_fecha=False
+        )
+
+    # Cursor propio para el libro mayor: el PDF lo va consumiendo de a una página
+    cur_ledger = conn.cursor()
+    consultar_movimientos(cur_ledger, rev_id, row_rev["saldo_inicial"],
+                          desde=desde, hasta=hasta, descendente=False)
+    salida = tempfile.SpooledTemporaryFile(max_size=ESTADO_CUENTA_MEMORIA_MAX)
+    try:
+        build_estado_cuenta_pdf(
+            row_rev["nombre"] or f"Revendedor {rev_id}",
+            (_movimiento_visible(f) for f in cur_ledger),
+            desde=desde, hasta=hasta, saldo_anterior=saldo_anterior, destino=salida,
+        )
+    except Exception:
+        salida.close()
+        raise
+    finally:
+        conn.close()
+
+    nombre = _limpiar_nombre_cliente(row_rev["nombre"] or str(rev_id))
+    sufijo = "_".join(v for v in (desde, hasta) if v)
+    return send_file(
+        salida,
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=f"ESTADO_{nombre}{'_' + sufijo if sufijo else ''}.pdf",
+    )
+
+
+# ---------------------------
+# DESCARGA PDF DE ENTREGA
+# ---------------------------
+
+@app.route("/entregas/<int:entrega_id>/pdf", methods=["GET"])
+def descargar_pdf_entrega(entrega_id):
+    conn = get_conn()
+    datos = datos_pdf_entrega(conn.cursor(), entrega_id)
+    conn.close()
+
+    if not datos:
+        return "Entrega no encontrada", 404
+
+    if datos["tipo_movimiento"] == "devolucion":
+        return "Las devoluciones no generan PDF de entrega", 400
+
+    pdf_bytes, clave, _ = pdf_entrega_cacheado(datos)
+
+    return send_file(
+        io.BytesIO(pdf_bytes),
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=f"ENTREGA_{datos['cliente']}.pdf",
+        etag=clave,
+        conditional=True,
+    )
+
+
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_BATCH_MAX = int(os.environ.get("PDF_BATCH_MAX", "200"))
+
+_pool_pdf = None
+_pool_pdf_lock = threading.Lock()
+
+
+def obtener_pool_pdf():
+    """Pool de procesos para renderizar PDFs en paralelo (None si PDF_WORKERS <= 1)."""
+    global _pool_pdf
+    if PDF_WORKERS <= 1:
+        return None
+    with _pool_pdf_lock:
+        if _pool_pdf is None:
+            # Sin fork: el server tiene hilos (y locks tomados) que un fork copiaría a medias.
+            # Los procesos arrancan limpios e importan la app; el logo lo cargan al iniciar.
+            metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool_pdf = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                            mp_context=multiprocessing.get_context(metodo),
+                                            initializer=_calentar_recursos_pdf)
+        return _pool_pdf
+
+
+def _calentar_recursos_pdf():
+    with app.app_context():
+        pdfrecursos.estilos()
+        pdfrecursos.logo(ruta_logo(), LOGO_MM)
+
+
+def _render_pdf_en_proceso(cliente, fecha, items):
+    # Corre en un proceso del pool: necesita su propio contexto de app (ruta del logo).
+    with app.app_context():
+        return render_entrega_pdf(cliente=cliente, fecha_iso=fecha, items=items).getvalue()
+
+
+def _pdfs_de_entregas(datos_con_clave):
+    """
+    Genera (datos, pdf_bytes) por entrega a medida que están listos: las que ya
+    están en la cache se leen de disco y el resto se renderiza en el pool de procesos
+    (y queda guardado en la cache para la próxima).
+    datos_con_clave: [(datos, clave de cache)], la clave se calcula en el request.
+    """
+    pendientes = []
+    for d, clave in datos_con_clave:
+        pdf, generacion = cache_pdfs.obtener(d["id"], clave)
+        if pdf is not None:
+            yield d, pdf
+            continue
+        pendientes.append((d, clave, generacion))
+
+    pool = obtener_pool_pdf()
+    if pool is None:
+        for d, clave, generacion in pendientes:
+            pdf = _render_pdf_en_proceso(d["cliente"], d["fecha"], d["items"])
+            cache_pdfs.guardar(d["id"], clave, pdf, generacion)
+            yield d, pdf
+        return
+
+    futuros = {
+        pool.submit(_render_pdf_en_proceso, d["cliente"], d["fecha"], d["items"]): (d, clave, generacion)
+        for d, clave, generacion in pendientes
+    }
+    try:
+        for futuro in as_completed(futuros):
+            d, clave, generacion = futuros[futuro]
+            pdf = futuro.result()
+            cache_pdfs.guardar(d["id"], clave, pdf, generacion)
+            yield d, pdf
+    finally:
+        for futuro in futuros:
+            futuro.cancel()
+
 
-    return jsonify({"ok": True})
+def _nombre_pdf(d):
+    cliente = re.sub(r"[^\wÁÉÍÓÚáéíóúñÑ-]+", "_", d["cliente"]).strip("_") or "cliente"
+    return f"ENTREGA_{d['id']}_{cliente}_{d['fecha']}.pdf"
 
 
-@app.route("/api/revendedores/<int:rev_id>/movimientos", methods=["GET"])
-def api_movimientos_revendedor(rev_id):
+def _zip_de_pdfs(pdfs):
+    salida = io.BytesIO()
+    with zipfile.ZipFile(salida, "w", compression=zipfile.ZIP_STORED) as zf:
+        for d, pdf in pdfs:
+            zf.writestr(_nombre_pdf(d), pdf)  # los PDF ya vienen comprimidos
+    salida.seek(0)
+    return salida
+
+
+@app.route("/api/entregas/pdf-batch", methods=["POST"])
+def api_pdf_batch():
     """
-    Movimientos (entregas + devoluciones + pagos) de un revendedor, con saldo acumulado.
-    Entregas suman al saldo (te debe).
-    Devoluciones restan al saldo.
-    Pagos restan al saldo.
+    PDFs de muchas entregas en una sola descarga.
+    Body: {"ids": [...]} o {"revendedor_id": N, "desde": "YYYY-MM-DD", "hasta": "YYYY-MM-DD"},
+    más "formato": "zip" (default, un PDF por entrega) o "pdf" (un único PDF con todas).
+    Las devoluciones se ignoran (no tienen PDF). El ZIP se renderiza en paralelo en el
+    pool de procesos; el PDF único es un solo build de ReportLab y corre en el request.
     """
+    data = request.get_json(silent=True) or {}
+    formato = (data.get("formato") or "zip").lower()
+    if formato not in ("zip", "pdf"):
+        return jsonify({"ok": False, "error": "formato debe ser zip o pdf"}), 200
+
     conn = get_conn()
-    conn.row_factory = sqlite3.Row
     cur = conn.cursor()
-
     try:
-        asegurar_columnas_entregas(cur, conn)
-    except Exception:
-        pass
+        if data.get("ids"):
+            try:
+                ids = [int(i) for i in data["ids"]]
+            except (TypeError, ValueError):
+                return jsonify({"ok": False, "error": "Hay IDs de entrega inválidos"}), 200
+        elif data.get("revendedor_id"):
+            desde = (data.get("desde") or "").strip() or None
+            hasta = (data.get("hasta") or "").strip() or None
+            if any(f and not RE_FECHA.match(f) for f in (desde, hasta)):
+                return jsonify({"ok": False, "error": "Fecha inválida (YYYY-MM-DD)"}), 200
+            try:
+                revendedor_id = int(data["revendedor_id"])
+            except (TypeError, ValueError):
+                return jsonify({"ok": False, "error": "revendedor_id inválido"}), 200
+            cur.execute("""
+                SELECT id
+                FROM entregas
+                WHERE revendedor_id = ?
+                  AND tipo_cliente = 'revendedor'
+                  AND (? IS NULL OR fecha >= ?)
+                  AND (? IS NULL OR fecha <= ?)
+                  AND IFNULL(tipo_movimiento, 'entrega') = 'entrega'
+                ORDER BY fecha, id
+            """, (revendedor_id, desde, desde, hasta, hasta))
+            ids = [f["id"] for f in cur.fetchall()]
+        else:
+            return jsonify({"ok": False, "error": "Falta ids o revendedor_id"}), 200
 
-    cur.execute("SELECT saldo_inicial FROM revendedores WHERE id = ?", (rev_id,))
-    row_rev = cur.fetchone()
-    if not row_rev:
+        if len(ids) > PDF_BATCH_MAX:
+            return jsonify({"ok": False, "error": f"Máximo {PDF_BATCH_MAX} entregas por descarga"}), 200
+
+        datos = [d for d in datos_pdf_entregas(cur, ids) if d["tipo_movimiento"] == "entrega"]
+    finally:
         conn.close()
-        return jsonify({"error": "Revendedor no encontrado"}), 404
 
-    saldo = float(row_rev["saldo_inicial"] or 0)
+    if not datos:
+        return jsonify({"ok": False, "error": "No hay entregas para exportar"}), 404
 
-    # Entregas / devoluciones
-    cur.execute("""
-        SELECT
-            e.id,
-            e.fecha,
-            e.cantidad_total,
-            e.total,
-            IFNULL(e.tipo_movimiento, 'entrega') AS tipo_movimiento,
-            e.descripcion
-        FROM entregas e
-        WHERE e.tipo_cliente = 'revendedor'
-          AND e.revendedor_id = ?
-        ORDER BY e.fecha ASC, e.id ASC
-    """, (rev_id,))
-    entregas = cur.fetchall()
+    sello = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    # Pagos
-    cur.execute("""
-        SELECT
-            p.id,
-            p.fecha,
-            p.descripcion,
-            p.monto
-        FROM pagos p
-        WHERE p.tipo_cliente = 'revendedor'
-          AND p.revendedor_id = ?
-        ORDER BY p.fecha ASC, p.id ASC
-    """, (rev_id,))
-    pagos = cur.fetchall()
+    if formato == "pdf":
+        # Un solo documento: se arma en un único build (sin librería de merge), así que
+        # no se reparte entre procesos.
+        buffer = render_entregas_pdf(datos, titulo=f"Entregas ({len(datos)})")
+        return send_file(buffer, mimetype="application/pdf", as_attachment=True,
+                         download_name=f"ENTREGAS_{sello}.pdf")
 
-    conn.close()
+    con_clave = [(d, cache_pdfs.clave(d["cliente"], d["fecha"], d["items"])) for d in datos]
+    # Todo se renderiza antes de responder: si un worker falla, el cliente recibe un
+    # error y no un ZIP a medias con status 200.
+    try:
+        pdfs = {d["id"]: pdf for d, pdf in _pdfs_de_entregas(con_clave)}
+    except Exception as e:
+        app.logger.exception("Error renderizando el lote de %s PDFs", len(datos))
+        return jsonify({"ok": False, "error": f"No se pudieron generar los PDFs: {e}"}), 500
 
-    eventos = []
+    return send_file(_zip_de_pdfs((d, pdfs[d["id"]]) for d in datos), mimetype="application/zip",
+                     as_attachment=True, download_name=f"ENTREGAS_{sello}.zip")
 
-    for e in entregas:
-        tipo_mov = e["tipo_movimiento"] or "entrega"
-        monto_real = float(e["total"] or 0)
 
-        if tipo_mov == "devolucion":
-            desc = e["descripcion"] or f"Devolución #{e['id']}"
-        else:
-            desc = f"Entrega #{e['id']} · {e['cantidad_total']} piezas"
-
-        eventos.append({
-            "id": e["id"],
-            "tipo": tipo_mov,
-            "fecha": e["fecha"],
-            "descripcion": desc,
-            "monto": monto_real,
-        })
+PDF_PRERENDER = os.environ.get("PDF_PRERENDER", "1") == "1"
+PDF_JOBS_TTL = 3600
+PDF_JOBS_MAX = 1000
 
-    for p in pagos:
-        monto_pago = float(p["monto"] or 0)
-        eventos.append({
-            "id": p["id"],
-            "tipo": "pago",
-            "fecha": p["fecha"],
-            "descripcion": (p["descripcion"] or f"Pago recibido #{p['id']}"),
-            "monto": -abs(monto_pago),
-        })
 
-    def orden_tipo(t):
-        if t == "entrega":
-            return 0
-        if t == "devolucion":
-            return 1
-        return 2  # pago
-
-    eventos.sort(key=lambda ev: (ev["fecha"], orden_tipo(ev["tipo"]), ev["id"]))
-
-    movimientos = []
-    for ev in eventos:
-        saldo += ev["monto"]
-
-        # visible:
-        # entrega -> negativo
-        # devolucion -> positivo
-        # pago -> positivo
-        if ev["tipo"] == "entrega":
-            total_visible = -abs(ev["monto"])
-            entrega_id = ev["id"]
-        elif ev["tipo"] == "devolucion":
-            total_visible = abs(ev["monto"])
-            entrega_id = ev["id"]
-        else:
-            total_visible = abs(ev["monto"])
-            entrega_id = None
-
-        movimientos.append({
-            "entrega_id": entrega_id,
-            "fecha": ev["fecha"],
-            "descripcion": ev["descripcion"],
-            "total": total_visible,
-            "saldo_posterior": saldo,
-            "tipo": ev["tipo"],
-        })
+class ColaPdf:
+    """
+    Trabajos de renderizado de PDFs en segundo plano (solo local, en memoria).
+    Usa el pool de procesos de PDFs (o un hilo si PDF_WORKERS <= 1); el resultado
+    queda en cache_pdfs y se descarga por la ruta normal /entregas/<id>/pdf.
+    Estados: pendiente -> listo | error.
+    """
 
-    movimientos.reverse()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trabajos = OrderedDict()
+        self._en_curso = {}  # (entrega_id, clave) -> job_id, para no duplicar trabajos
+        self._hilo = None
+
+    def _ejecutor(self):
+        pool = obtener_pool_pdf()
+        if pool is not None:
+            return pool
+        if self._hilo is None:
+            self._hilo = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-jobs")
+        return self._hilo
+
+    def _podar(self, ahora):
+        # Se olvidan los trabajos terminados viejos; nunca más de PDF_JOBS_MAX.
+        for job_id in list(self._trabajos):
+            trabajo = self._trabajos[job_id]
+            viejo = ahora - trabajo["creado"] > PDF_JOBS_TTL
+            if trabajo["estado"] != "pendiente" and (viejo or len(self._trabajos) > PDF_JOBS_MAX):
+                del self._trabajos[job_id]
+
+    def encolar(self, datos):
+        """Encola el PDF de la entrega (dict de datos_pdf_entrega) y devuelve el trabajo."""
+        clave = cache_pdfs.clave(datos["cliente"], datos["fecha"], datos["items"])
+        ahora = time.time()
+
+        with self._lock:
+            self._podar(ahora)
+            job_id = self._en_curso.get((datos["id"], clave))
+            if job_id is not None:
+                return dict(self._trabajos[job_id])
+
+            job_id = uuid.uuid4().hex
+            trabajo = {"job_id": job_id, "entrega_id": datos["id"], "estado": "pendiente",
+                       "error": None, "creado": ahora, "terminado": None}
+            self._trabajos[job_id] = trabajo
+
+            pdf, generacion = cache_pdfs.obtener(datos["id"], clave)
+            if pdf is not None:
+                trabajo.update(estado="listo", terminado=ahora)
+                return dict(trabajo)
+
+            self._en_curso[(datos["id"], clave)] = job_id
+            futuro = self._ejecutor().submit(
+                _render_pdf_en_proceso, datos["cliente"], datos["fecha"], datos["items"])
+
+        futuro.add_done_callback(
+            lambda f: self._terminar(job_id, datos["id"], clave, generacion, f))
+        return dict(trabajo)
+
+    def _terminar(self, job_id, entrega_id, clave, generacion, futuro):
+        try:
+            cache_pdfs.guardar(entrega_id, clave, futuro.result(), generacion)
+            cambios = {"estado": "listo", "error": None}
+        except Exception as e:
+            app.logger.exception("Error renderizando PDF de la entrega %s", entrega_id)
+            cambios = {"estado": "error", "error": str(e)}
 
-    return jsonify({"ok": True, "movimientos": movimientos})
+        with self._lock:
+            self._en_curso.pop((entrega_id, clave), None)
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is not None:
+                trabajo.update(cambios, terminado=time.time())
 
+    def estado(self, job_id):
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            return dict(trabajo) if trabajo is not None else None
 
-# ---------------------------
-# DESCARGA PDF DE ENTREGA
-# ---------------------------
 
-@app.route("/entregas/<int:entrega_id>/pdf", methods=["GET"])
-def descargar_pdf_entrega(entrega_id):
-    conn = get_conn()
-    cur = conn.cursor()
+cola_pdf = ColaPdf()
 
+
+def prerenderizar_pdf_entrega(entrega_id):
+    """Encola el PDF de una entrega recién creada para que la descarga sea inmediata."""
+    if not PDF_PRERENDER:
+        return
     try:
-        asegurar_columnas_entregas(cur, conn)
+        conn = get_conn()
+        try:
+            datos = datos_pdf_entrega(conn.cursor(), entrega_id)
+        finally:
+            conn.close()
+        if datos and datos["tipo_movimiento"] == "entrega":
+            cola_pdf.encolar(datos)
     except Exception:
-        pass
-
-    cur.execute("""
-        SELECT
-            id,
-            fecha,
-            tipo_cliente,
-            cliente_nombre,
-            cantidad_total,
-            total,
-            IFNULL(tipo_movimiento, 'entrega') AS tipo_movimiento,
-            descripcion
-        FROM entregas
-        WHERE id = ?
-    """, (entrega_id,))
-    entrega = cur.fetchone()
-    if not entrega:
-        conn.close()
-        return "Entrega no encontrada", 404
+        # El pre-render es solo una optimización: nunca rompe la creación de la entrega.
+        app.logger.exception("No se pudo encolar el PDF de la entrega %s", entrega_id)
 
-    if (entrega["tipo_movimiento"] or "entrega") == "devolucion":
-        conn.close()
-        return "Las devoluciones no generan PDF de entrega", 400
 
-    cur.execute("""
-        SELECT
-            nombre_pieza,
-            cantidad,
-            precio_unitario,
-            total
-        FROM entrega_items
-        WHERE entrega_id = ?
-        ORDER BY id
-    """, (entrega_id,))
-    raw_items = cur.fetchall()
+def _respuesta_trabajo(trabajo):
+    return {
+        "ok": True,
+        "job_id": trabajo["job_id"],
+        "entrega_id": trabajo["entrega_id"],
+        "estado": trabajo["estado"],
+        "error": trabajo["error"],
+        "url_estado": url_for("api_estado_pdf_job", entrega_id=trabajo["entrega_id"],
+                              job_id=trabajo["job_id"]),
+        "url_pdf": url_for("descargar_pdf_entrega", entrega_id=trabajo["entrega_id"])
+        if trabajo["estado"] == "listo" else None,
+    }
+
+
+@app.route("/api/entregas/<int:entrega_id>/pdf-jobs", methods=["POST"])
+def api_encolar_pdf_job(entrega_id):
+    """Encola el renderizado del PDF de la entrega. Responde 202 con el job_id."""
+    conn = get_conn()
+    datos = datos_pdf_entrega(conn.cursor(), entrega_id)
     conn.close()
 
-    items = []
-    for it in raw_items:
-        items.append({
-            "pieza": it["nombre_pieza"],
-            "cantidad": it["cantidad"],
-            "precio": it["precio_unitario"],
-            "total": it["total"],
-        })
-
-    raw_cliente = entrega["cliente_nombre"] or ""
-    cliente_limpio = re.sub(r'^\s*\d+\s*[-–.)_]*\s*', '', raw_cliente).strip()
-    cliente_limpio = re.sub(r'^\.+', '', cliente_limpio).strip()
-    cliente_limpio = re.sub(r'^[^\wÁÉÍÓÚáéíóúñÑ]+', '', cliente_limpio).strip()
+    if not datos:
+        return jsonify({"ok": False, "error": "Entrega no encontrada"}), 404
+    if datos["tipo_movimiento"] == "devolucion":
+        return jsonify({"ok": False, "error": "Las devoluciones no generan PDF de entrega"}), 200
 
-    output_dir = Path("pdfs")
-    output_file = output_dir / f"entrega_{entrega_id}.pdf"
+    trabajo = cola_pdf.encolar(datos)
+    return jsonify(_respuesta_trabajo(trabajo)), 202
 
-    pdf_bytes, pdf_path_str = build_entrega_pdf(
-        cliente=cliente_limpio,
-        fecha_iso=entrega["fecha"],
-        items=items,
-        out_path=output_file
-    )
 
-    return send_file(
-        io.BytesIO(pdf_bytes),
-        mimetype="application/pdf",
-        as_attachment=True,
-        download_name=f"ENTREGA_{cliente_limpio}.pdf"
-    )
+@app.route("/api/entregas/<int:entrega_id>/pdf-jobs/<job_id>", methods=["GET"])
+def api_estado_pdf_job(entrega_id, job_id):
+    """Estado de un trabajo de PDF; cuando está 'listo', url_pdf se sirve desde la cache."""
+    trabajo = cola_pdf.estado(job_id)
+    if trabajo is None or trabajo["entrega_id"] != entrega_id:
+        return jsonify({"ok": False, "error": "Trabajo no encontrado"}), 404
+    return jsonify(_respuesta_trabajo(trabajo))
 
 
 # ---------------------------
@@ -1535,6 +4113,16 @@ def api_pago_detalle_o_editar(pago_id):
     ganancia = monto - costo
     ganancia_individual = ganancia / 2.0
 
+    cur.execute("BEGIN IMMEDIATE")
+    meses = meses_afectados(cur, "pagos", [pago_id]) | {mes_clave}
+    error = error_mes_cerrado(cur, meses)
+    if error:
+        conn.close()
+        return jsonify({"ok": False, "error": error}), 200
+
+    acumular_saldos(cur, "pagos", [pago_id], -1)
+    acumular_resumen_mensual(cur, "pagos", [pago_id], -1)
+
     cur.execute(
         """
         UPDATE pagos
@@ -1568,17 +4156,73 @@ def api_pago_detalle_o_editar(pago_id):
             pago_id,
         ),
     )
+    filas = cur.rowcount
+
+    acumular_saldos(cur, "pagos", [pago_id], 1)
+    acumular_resumen_mensual(cur, "pagos", [pago_id], 1)
 
     conn.commit()
-    filas = cur.rowcount
     conn.close()
 
     if filas == 0:
         return jsonify({"ok": False, "error": "Pago no encontrado"}), 200
 
+    emitir_escritura("pago", meses)
     return jsonify({"ok": True})
 
 
+def borrar_entregas(cur, entrega_ids):
+    """
+    Borra entregas/devoluciones dentro de la transacción abierta en `cur`.
+    Restaura el stock de las entregas reales con un UPDATE agregado por producto
+    (las devoluciones no tocan stock) y lo deja en el journal, ajusta saldos y
+    elimina items + cabeceras.
+    Devuelve (borradas, meses_afectados).
+    """
+    ids = sorted({int(i) for i in entrega_ids})
+    if not ids:
+        return 0, set()
+
+    acumular_saldos(cur, "entregas", ids, -1)
+    meses = meses_afectados(cur, "entregas", ids)
+
+    borradas = 0
+    for lote in _en_lotes(ids):
+        placeholders = ",".join("?" for _ in lote)
+        cur.execute(f"""
+            INSERT INTO stock_movimientos (producto_id, delta, motivo, entrega_id)
+            SELECT ei.producto_id, SUM(IFNULL(ei.cantidad, 0)), 'borrado_entrega', ei.entrega_id
+            FROM entrega_items ei
+            JOIN entregas e ON e.id = ei.entrega_id
+            JOIN productos p ON p.id = ei.producto_id
+            WHERE ei.entrega_id IN ({placeholders})
+              AND IFNULL(e.tipo_movimiento, 'entrega') = 'entrega'
+            GROUP BY ei.entrega_id, ei.producto_id
+            HAVING SUM(IFNULL(ei.cantidad, 0)) != 0
+        """, lote)
+        cur.execute(f"""
+            UPDATE productos
+            SET stock = IFNULL(productos.stock, 0) + dev.cantidad,
+                updated_at = datetime('now')
+            FROM (
+                SELECT ei.producto_id, SUM(IFNULL(ei.cantidad, 0)) AS cantidad
+                FROM entrega_items ei
+                JOIN entregas e ON e.id = ei.entrega_id
+                WHERE ei.entrega_id IN ({placeholders})
+                  AND ei.producto_id IS NOT NULL
+                  AND IFNULL(e.tipo_movimiento, 'entrega') = 'entrega'
+                GROUP BY ei.producto_id
+            ) AS dev
+            WHERE productos.id = dev.producto_id
+        """, lote)
+
+        cur.execute(f"DELETE FROM entrega_items WHERE entrega_id IN ({placeholders})", lote)
+        cur.execute(f"DELETE FROM entregas WHERE id IN ({placeholders})", lote)
+        borradas += cur.rowcount
+
+    return borradas, meses
+
+
 @app.route("/api/entregas/borrar", methods=["POST"])
 def api_borrar_entrega():
     """
@@ -1600,71 +4244,55 @@ def api_borrar_entrega():
             return jsonify({"ok": False, "error": "ID de entrega inválido."}), 200
 
         conn = get_conn()
-        conn.row_factory = sqlite3.Row
         cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        borradas, meses = borrar_entregas(cur, [eid_int])
+        conn.commit()
+        conn.close()
+        cache_pdfs.invalidar([eid_int])
 
-        try:
-            asegurar_columnas_entregas(cur, conn)
-        except Exception:
-            pass
-
-        cur.execute("""
-            SELECT IFNULL(tipo_movimiento, 'entrega') AS tipo_movimiento
-            FROM entregas
-            WHERE id = ?
-        """, (eid_int,))
-        cab = cur.fetchone()
-
-        if not cab:
-            conn.close()
+        if borradas == 0:
             return jsonify({"ok": False, "error": "No se encontró entrega con ese ID."}), 200
 
-        tipo_mov = cab["tipo_movimiento"] or "entrega"
-
-        # Solo restaurar stock si era entrega real
-        if tipo_mov == "entrega":
-            cur.execute("""
-                SELECT producto_id, cantidad
-                FROM entrega_items
-                WHERE entrega_id = ?
-            """, (eid_int,))
-            items = cur.fetchall()
-
-            for it in items:
-                prod_id = it["producto_id"]
-                cant = it["cantidad"] or 0
+        emitir_escritura("entrega", meses)
+        return jsonify({"ok": True, "borradas": borradas}), 200
 
-                if prod_id is None:
-                    continue
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error SQLite: {e}"}), 200
 
-                cur.execute("SELECT stock FROM productos WHERE id = ?", (prod_id,))
-                fila = cur.fetchone()
-                if not fila:
-                    continue
 
-                stock_actual = fila["stock"] or 0
-                nuevo_stock = stock_actual + cant
+@app.route("/api/entregas/borrar-lote", methods=["POST"])
+def api_borrar_entregas_lote():
+    """
+    Borra varias entregas/devoluciones en una sola transacción.
+    Body: {"ids": [1, 2, 3]}. Si algo falla no se borra ninguna.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
 
-                cur.execute("""
-                    UPDATE productos
-                    SET stock = ?, updated_at = datetime('now')
-                    WHERE id = ?
-                """, (nuevo_stock, prod_id))
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"ok": False, "error": "Falta la lista de IDs."}), 200
 
-        cur.execute("DELETE FROM entrega_items WHERE entrega_id = ?", (eid_int,))
-        cur.execute("DELETE FROM entregas WHERE id = ?", (eid_int,))
-        borradas = cur.rowcount
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "Hay IDs de entrega inválidos."}), 200
 
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        borradas, meses = borrar_entregas(cur, ids)
         conn.commit()
-        conn.close()
-
-        if borradas == 0:
-            return jsonify({"ok": False, "error": "No se encontró entrega con ese ID."}), 200
-
-        return jsonify({"ok": True, "borradas": borradas}), 200
-
     except Exception as e:
+        conn.rollback()
         return jsonify({"ok": False, "error": f"Error SQLite: {e}"}), 200
+    finally:
+        conn.close()
+
+    cache_pdfs.invalidar(ids)
+    emitir_escritura("entrega", meses)
+    return jsonify({"ok": True, "borradas": borradas, "solicitadas": len(set(ids))}), 200
 
 
 # ---------------------------
@@ -1694,10 +4322,20 @@ def api_borrar_gasto():
 
         conn = get_conn()
         cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        meses = meses_afectados(cur, "gastos", [gid_int])
+        error = error_mes_cerrado(cur, meses)
+        if error:
+            conn.close()
+            if not request.is_json:
+                return redirect(url_for("cuentas", mes=min(meses), error=error))
+            return jsonify({"ok": False, "error": error}), 200
+        acumular_resumen_mensual(cur, "gastos", [gid_int], -1)
         cur.execute("DELETE FROM gastos WHERE id = ?", (gid_int,))
         conn.commit()
         borrados = cur.rowcount
         conn.close()
+        emitir_escritura("gasto", meses)
 
         if borrados == 0:
             if not request.is_json:
@@ -1735,10 +4373,19 @@ def api_borrar_pagos():
 
         conn = get_conn()
         cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        meses = meses_afectados(cur, "pagos", ids)
+        error = error_mes_cerrado(cur, meses)
+        if error:
+            conn.close()
+            return jsonify({"ok": False, "error": error}), 200
+        acumular_saldos(cur, "pagos", ids, -1)
+        acumular_resumen_mensual(cur, "pagos", ids, -1)
         cur.execute(f"DELETE FROM pagos WHERE id IN ({placeholders})", ids)
         conn.commit()
         borrados = cur.rowcount
         conn.close()
+        emitir_escritura("pago", meses)
 
         if borrados == 0:
             return jsonify({
@@ -1778,6 +4425,18 @@ def api_borrar_pago_ayudante():
 
         conn = get_conn()
         cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+
+        cur.execute("SELECT id FROM gastos WHERE id = ? AND tipo = 'pago_ayudante'", (gid_int,))
+        ids_ayudante = [f["id"] for f in cur.fetchall()]
+        meses = meses_afectados(cur, "gastos", ids_ayudante)
+        error = error_mes_cerrado(cur, meses)
+        if error:
+            conn.close()
+            if not request.is_json:
+                return redirect(url_for("cuentas", mes=min(meses), error=error))
+            return jsonify({"ok": False, "error": error}), 200
+        acumular_resumen_mensual(cur, "gastos", ids_ayudante, -1)
 
         cur.execute("""
             DELETE FROM gastos
@@ -1787,6 +4446,7 @@ def api_borrar_pago_ayudante():
         conn.commit()
         borrados = cur.rowcount
         conn.close()
+        emitir_escritura("gasto", meses)
 
         if borrados == 0:
             if not request.is_json:
@@ -1801,10 +4461,548 @@ def api_borrar_pago_ayudante():
     except Exception as e:
         return jsonify({"ok": False, "error": f"Error SQLite: {e}"}), 200
         
+# ---------------------------
+# API SISTEMA
+# ---------------------------
+
+@app.route("/api/sistema/pool", methods=["GET"])
+def api_estadisticas_pool():
+    """
+    Estadísticas del pool de conexiones (hits, misses y tiempos de espera).
+    """
+    return jsonify({"ok": True, "pool": obtener_pool().estadisticas()})
+
+
+@app.route("/api/sistema/cache", methods=["GET"])
+def api_estadisticas_cache():
+    """
+    Estadísticas de la cache del dashboard, de los PDFs y de los reportes mensuales.
+    """
+    return jsonify({
+        "ok": True,
+        "dashboard": cache_dashboard.estadisticas(),
+        "pdfs": cache_pdfs.estadisticas(),
+        "reportes": cache_reportes.estadisticas(),
+    })
+
+
+# ---------------------------
+# EXPORTACIÓN (CSV / NDJSON en streaming)
+# ---------------------------
+
+EXPORT_LOTE = int(os.environ.get("EXPORT_LOTE", "1000"))
+
+# tabla -> (SELECT sin filtro, columna de fecha, orden). Siempre por índice de fecha.
+_CONSULTAS_EXPORT = {
+    "pagos": ("SELECT * FROM pagos", "fecha", "fecha, id"),
+    "gastos": ("SELECT * FROM gastos", "fecha", "fecha, id"),
+    "entregas": ("SELECT * FROM entregas", "fecha", "fecha, id"),
+    "entrega_items": (
+        "SELECT ei.*, e.fecha FROM entrega_items ei JOIN entregas e ON e.id = ei.entrega_id",
+        "e.fecha",
+        "e.fecha, ei.entrega_id, ei.id",
+    ),
+}
+TIPOS_EXPORT = (*_CONSULTAS_EXPORT, "movimientos")
+
+_COLUMNAS_MOVIMIENTOS = ("revendedor_id", "revendedor", "id", "fecha", "tipo",
+                         "descripcion", "monto", "saldo_posterior")
+
+
+def _lotes_export(cur, tipo, desde=None, hasta=None, revendedor_id=None):
+    """
+    Genera (columnas, filas) en lotes de EXPORT_LOTE con fetchmany: la consulta
+    se recorre con el cursor abierto, nunca se materializa entera.
+    """
+    if tipo != "movimientos":
+        sql, columna_fecha, orden = _CONSULTAS_EXPORT[tipo]
+        condiciones, params = [], []
+        if desde:
+            condiciones.append(f"{columna_fecha} >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append(f"{columna_fecha} <= ?")
+            params.append(hasta)
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        cur.execute(f"{sql} ORDER BY {orden}", params)
+        columnas = [d[0] for d in cur.description]
+        yield columnas, []  # el encabezado sale aunque no haya filas
+        while True:
+            filas = cur.fetchmany(EXPORT_LOTE)
+            if not filas:
+                return
+            yield columnas, filas
+
+    # Libro mayor de cada revendedor (mismo SQL que el popup), uno tras otro.
+    yield _COLUMNAS_MOVIMIENTOS, []
+    cur.execute("""
+        SELECT id, nombre, IFNULL(saldo_inicial, 0) AS saldo_inicial
+        FROM revendedores
+        WHERE (? IS NULL OR id = ?)
+        ORDER BY id
+    """, (revendedor_id, revendedor_id))
+    for rev in cur.fetchall():
+        ledger = consultar_movimientos(cur.connection.cursor(), rev["id"], rev["saldo_inicial"],
+                                       desde=desde, hasta=hasta, descendente=False)
+        while True:
+            filas = ledger.fetchmany(EXPORT_LOTE)
+            if not filas:
+                break
+            yield _COLUMNAS_MOVIMIENTOS, [
+                (rev["id"], rev["nombre"], f["id"], f["fecha"], f["tipo"],
+                 f["descripcion"], f["monto"], f["saldo_posterior"])
+                for f in filas
+            ]
+
+
+def _serializar_export(lotes, formato):
+    """Convierte los lotes en texto CSV (con encabezado) o NDJSON, un bloque por lote."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    encabezado = None
+
+    for columnas, filas in lotes:
+        if formato == "ndjson":
+            for fila in filas:
+                buffer.write(json.dumps(dict(zip(columnas, tuple(fila))), ensure_ascii=False))
+                buffer.write("\n")
+        else:
+            if encabezado is None:
+                encabezado = list(columnas)
+                escritor.writerow(encabezado)
+            escritor.writerows(filas)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _comprimir(bloques):
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = formato gzip
+    for bloque in bloques:
+        salida = compresor.compress(bloque)
+        if salida:
+            yield salida
+    yield compresor.flush()
+
+
+@app.route("/api/export/<tipo>", methods=["GET"])
+def api_exportar(tipo):
+    """
+    Exporta pagos, gastos, entregas, entrega_items o movimientos (libro mayor de
+    revendedores con saldo) en streaming.
+    Query: desde, hasta (YYYY-MM-DD), formato=csv|ndjson, revendedor_id (movimientos),
+    gzip=0 para no comprimir aunque el cliente acepte gzip.
+    """
+    if tipo not in TIPOS_EXPORT:
+        return jsonify({"ok": False, "error": f"Tipo inválido: {tipo}"}), 404
+
+    desde = (request.args.get("desde") or "").strip() or None
+    hasta = (request.args.get("hasta") or "").strip() or None
+    for valor in (desde, hasta):
+        if valor and not RE_FECHA.match(valor):
+            return jsonify({"ok": False, "error": "Fecha inválida (YYYY-MM-DD)"}), 200
+
+    formato = (request.args.get("formato") or "csv").lower()
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"ok": False, "error": "formato debe ser csv o ndjson"}), 200
+
+    try:
+        revendedor_id = int(request.args["revendedor_id"]) if request.args.get("revendedor_id") else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "revendedor_id inválido"}), 200
+
+    comprimir = (request.args.get("gzip") != "0"
+                 and "gzip" in (request.headers.get("Accept-Encoding") or "").lower())
+
+    def generar():
+        # El generador corre después de que termina el request: la conexión es
+        # propia (no la devuelve el teardown) y se libera al terminar o cortar.
+        conn = obtener_pool(migrar=True).obtener()
+        try:
+            conn.execute("BEGIN")  # snapshot consistente para toda la exportación
+            yield from _serializar_export(
+                _lotes_export(conn.cursor(), tipo, desde, hasta, revendedor_id), formato)
+        finally:
+            conn.close()
+
+    nombre = "_".join(p for p in (tipo, desde, hasta) if p) + (".ndjson" if formato == "ndjson" else ".csv")
+    cuerpo = _comprimir(generar()) if comprimir else generar()
+    resp = app.response_class(
+        cuerpo,
+        mimetype="application/x-ndjson" if formato == "ndjson" else "text/csv",
+    )
+    resp.headers["Content-Disposition"] = f'attachment; filename="{nombre}"'
+    if comprimir:
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+
+# ---------------------------
+# IMPORTACIÓN MASIVA (CSV / NDJSON)
+# ---------------------------
+
+IMPORTACION_LOTE = int(os.environ.get("IMPORTACION_LOTE", "5000"))
+IMPORTACION_MAX_ERRORES = 200
+TIPOS_IMPORTACION = ("pagos", "gastos", "entregas")
+
+_VERDADEROS = ("1", "on", "true", "si", "sí", "x")
+
+
+def leer_registros(lineas, formato):
+    """
+    Recorre un archivo CSV (con encabezado) o NDJSON línea a línea, sin cargarlo
+    entero. `lineas` es cualquier iterable de bytes o str (archivo, request.stream).
+    Genera (numero_fila, dict o None, error o None).
+    """
+    texto = (l.decode("utf-8-sig") if isinstance(l, bytes) else l for l in lineas)
+
+    if formato == "ndjson":
+        for n, linea in enumerate(texto, start=1):
+            if not linea.strip():
+                continue
+            try:
+                fila = json.loads(linea)
+            except ValueError as e:
+                yield n, None, f"JSON inválido: {e}"
+                continue
+            if not isinstance(fila, dict):
+                yield n, None, "Cada línea debe ser un objeto JSON"
+                continue
+            yield n, fila, None
+        return
+
+    for n, fila in enumerate(csv.DictReader(texto), start=1):
+        yield n, {k.strip(): v for k, v in fila.items() if k}, None
+
+
+def _agrupar_entregas_csv(registros):
+    """
+    En CSV cada fila es una pieza: las filas consecutivas con la misma `ref`
+    forman una entrega (sin `ref`, cada fila es una entrega). Los totales de la
+    cabecera se calculan con las piezas.
+    """
+    actual = None
+
+    def cerrar(grupo):
+        n, data = grupo
+        data["cantidad_total"] = sum(int(p.get("cantidad") or 0) for p in data["piezas"])
+        data["total"] = sum(float(p.get("total") or 0) or
+                            int(p.get("cantidad") or 0) * float(p.get("precio_unitario") or 0)
+                            for p in data["piezas"])
+        return n, data, None
+
+    for n, fila, error in registros:
+        if error:
+            yield n, None, error
+            continue
+        ref = (fila.get("ref") or "").strip()
+        pieza = {k: fila.get(k) for k in ("producto_id", "nombre_pieza", "cantidad", "precio_unitario", "total")}
+
+        if actual is not None and ref and actual[1].get("ref") == ref:
+            actual[1]["piezas"].append(pieza)
+            continue
+
+        if actual is not None:
+            try:
+                yield cerrar(actual)
+            except (TypeError, ValueError):
+                yield actual[0], None, "Cantidad o precio inválidos"
+        cabecera = {k: fila.get(k) for k in ("fecha", "tipo_cliente", "revendedor_id", "cliente_nombre")}
+        actual = (n, dict(cabecera, ref=ref, piezas=[pieza]))
+
+    if actual is not None:
+        try:
+            yield cerrar(actual)
+        except (TypeError, ValueError):
+            yield actual[0], None, "Cantidad o precio inválidos"
+
+
+def _texto(valor):
+    return str(valor).strip() if valor is not None else ""
+
+
+def _fecha_importacion(valor):
+    # Igual que los formularios: sin fecha se usa la de hoy.
+    fecha = _texto(valor)[:10] or datetime.now().strftime("%Y-%m-%d")
+    if not RE_FECHA.match(fecha):
+        raise ValueError(f"Fecha inválida: {valor!r}")
+    return fecha
+
+
+def _validar_pago(fila, revendedores):
+    fecha = _fecha_importacion(fila.get("fecha"))
+    revendedor_id = _texto(fila.get("revendedor_id"))
+    tipo_cliente = "revendedor" if revendedor_id else "particular"
+    if revendedor_id:
+        if not revendedor_id.isdigit() or int(revendedor_id) not in revendedores:
+            raise ValueError(f"Revendedor inexistente: {revendedor_id}")
+    categoria = _texto(fila.get("categoria_precio")) or ("revendedor" if revendedor_id else "normal")
+
+    try:
+        monto = float(_texto(fila.get("monto")) or 0)
+        division = int(_texto(fila.get("division")) or 1)
+    except ValueError:
+        raise ValueError("Monto o división inválidos")
+    if division <= 0:
+        raise ValueError("La división debe ser mayor a 0")
+
+    registro = preparar_registro(fecha, tipo_cliente, revendedor_id or None,
+                                 _texto(fila.get("nombre_particular")) or None,
+                                 _texto(fila.get("descripcion")), monto, division, categoria)
+    if registro is None:
+        raise ValueError("El monto debe ser mayor a 0")
+    return registro
+
+
+def _validar_gasto(fila, revendedores):
+    fecha = _fecha_importacion(fila.get("fecha"))
+    tipo = _texto(fila.get("tipo")) or "gasto"
+    if tipo not in ("gasto", "pago_ayudante"):
+        raise ValueError(f"Tipo de gasto inválido: {tipo}")
+    try:
+        monto = float(_texto(fila.get("monto")) or 0)
+    except ValueError:
+        raise ValueError("Monto inválido")
+    es_filamento = _texto(fila.get("es_filamento")).lower() in _VERDADEROS
+
+    registro = preparar_gasto(fecha, tipo, _texto(fila.get("descripcion")), monto, es_filamento)
+    if registro is None:
+        raise ValueError("El monto debe ser mayor a 0")
+    return registro
+
+
+def _validar_entrega(data, revendedores):
+    cabecera, lineas, descuentos = preparar_entrega(data)
+    fecha, tipo_cliente, revendedor_id = cabecera[:3]
+    if not RE_FECHA.match(fecha):
+        raise ValueError(f"Fecha inválida: {fecha!r}")
+    if tipo_cliente == "revendedor" and revendedor_id not in revendedores:
+        raise ValueError(f"Revendedor inexistente: {revendedor_id}")
+    if not lineas:
+        raise ValueError("La entrega no tiene piezas válidas")
+    return cabecera, lineas, descuentos
+
+
+_VALIDADORES_IMPORTACION = {
+    "pagos": _validar_pago,
+    "gastos": _validar_gasto,
+    "entregas": _validar_entrega,
+}
+
+
+def _ids_nuevos(cur, tabla, desde_id):
+    # Dentro de BEGIN IMMEDIATE nadie más inserta: los ids > desde_id son los del lote,
+    # en el mismo orden en que se pasaron a executemany.
+    cur.execute(f"SELECT id FROM {tabla} WHERE id > ? ORDER BY id", (desde_id,))
+    return [f[0] for f in cur.fetchall()]
+
+
+def _insertar_lote(cur, tipo, registros, descontar_stock):
+    """Inserta un lote ya validado y actualiza saldos/resumen/stock. Devuelve los meses tocados."""
+    cur.execute(f"SELECT IFNULL(MAX(id), 0) FROM {tipo}")
+    desde_id = cur.fetchone()[0]
+
+    if tipo == "pagos":
+        cur.executemany(_SQL_INSERTAR_PAGO, registros)
+        ids = _ids_nuevos(cur, "pagos", desde_id)
+        acumular_saldos(cur, "pagos", ids, 1)
+        acumular_resumen_mensual(cur, "pagos", ids, 1)
+        return {r[-1] for r in registros}
+
+    if tipo == "gastos":
+        cur.executemany(_SQL_INSERTAR_GASTO, registros)
+        ids = _ids_nuevos(cur, "gastos", desde_id)
+        acumular_resumen_mensual(cur, "gastos", ids, 1)
+        return {r[4] for r in registros}
+
+    cur.executemany(_SQL_INSERTAR_ENTREGA, [cabecera for cabecera, _, _ in registros])
+    ids = _ids_nuevos(cur, "entregas", desde_id)
+    cur.executemany(_SQL_INSERTAR_ENTREGA_ITEM, (
+        (entrega_id, *linea)
+        for entrega_id, (_, lineas, _) in zip(ids, registros)
+        for linea in lineas
+    ))
+    acumular_saldos(cur, "entregas", ids, 1)
+
+    if descontar_stock:
+        # Por entrega, como en la API: cada movimiento del journal queda con su entrega_id.
+        for entrega_id, (_, _, descuentos) in zip(ids, registros):
+            mover_stock(cur, [(pid, -cant) for pid, cant in descuentos.items()],
+                        "importacion", entrega_id)
+
+    return {cabecera[0][:7] for cabecera, _, _ in registros}
+
+
+def importar_registros(conn, tipo, lineas, formato, lote=None, simular=False, descontar_stock=True):
+    """
+    Lee `lineas` (CSV o NDJSON), valida cada registro con las mismas reglas que los
+    formularios/API e inserta en transacciones de `lote` filas con executemany.
+    Las filas con error se saltean y se informan; el resto se importa.
+    Con simular=True solo valida. Devuelve un resumen con los errores por fila.
+    Si un lote falla, los anteriores ya quedaron guardados: se corta ahí y el
+    resumen parcial sale con `error`.
+    """
+    lote = lote or IMPORTACION_LOTE
+    validar = _VALIDADORES_IMPORTACION[tipo]
+    registros = leer_registros(lineas, formato)
+    if tipo == "entregas" and formato == "csv":
+        registros = _agrupar_entregas_csv(registros)
+
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM revendedores")
+    revendedores = {f[0] for f in cur.fetchall()}
+
+    resumen = {"tipo": tipo, "leidas": 0, "validas": 0, "importadas": 0,
+               "errores_total": 0, "errores": []}
+    meses = set()
+    pendientes = []  # [(numero_fila, registro)]
+
+    def rechazar(n, error):
+        resumen["errores_total"] += 1
+        if len(resumen["errores"]) < IMPORTACION_MAX_ERRORES:
+            resumen["errores"].append({"fila": n, "error": error})
+
+    def volcar():
+        if not pendientes:
+            return
+        if not simular:
+            cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Pagos y gastos de meses cerrados se rechazan fila por fila, dentro de la
+            # transacción del lote: un cierre concurrente no se cuela antes del INSERT.
+            cerrados = set()
+            if tipo in ("pagos", "gastos"):
+                cerrados = meses_cerrados(cur, {registro[0][:7] for _, registro in pendientes})
+            validos = []
+            for n, registro in pendientes:
+                if registro[0][:7] in cerrados:
+                    rechazar(n, f"El mes {registro[0][:7]} está cerrado y no admite cambios.")
+                else:
+                    validos.append(registro)
+            if not simular:
+                if validos:
+                    meses.update(_insertar_lote(cur, tipo, validos, descontar_stock))
+                conn.commit()
+        except Exception:
+            if not simular:
+                conn.rollback()
+            raise
+        resumen["validas"] += len(validos)
+        if not simular:
+            resumen["importadas"] += len(validos)
+        pendientes.clear()
+
+    try:
+        for n, fila, error in registros:
+            resumen["leidas"] += 1
+            if error is None:
+                try:
+                    pendientes.append((n, validar(fila, revendedores)))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                rechazar(n, error)
+            if len(pendientes) >= lote:
+                volcar()
+        volcar()
+    except Exception as e:
+        app.logger.exception("Importación de %s cortada después de %s registros",
+                             tipo, resumen["importadas"])
+        resumen["error"] = f"Error importando: {e}"
+    finally:
+        # Los lotes ya confirmados se avisan aunque uno posterior haya fallado.
+        resumen["errores"].sort(key=lambda e: e["fila"])  # los de mes cerrado llegan por lote
+        resumen["meses"] = sorted(meses)
+        if meses:
+            emitir_escritura({"pagos": "pago", "gastos": "gasto", "entregas": "entrega"}[tipo], meses)
+    return resumen
+
+
+def _formato_importacion(nombre, mimetype, formato=None):
+    formato = (formato or "").lower()
+    if formato in ("csv", "ndjson"):
+        return formato
+    nombre = (nombre or "").lower()
+    if nombre.endswith((".ndjson", ".jsonl")) or (mimetype or "") in ("application/x-ndjson", "application/json"):
+        return "ndjson"
+    return "csv"
+
+
+@app.route("/api/importar/<tipo>", methods=["POST"])
+def api_importar(tipo):
+    """
+    Importación masiva de pagos, gastos o entregas.
+    Body: el archivo crudo (text/csv o application/x-ndjson) o multipart con `archivo`.
+    Query: formato=csv|ndjson, lote=N, simular=1, descontar_stock=0 (solo entregas).
+    """
+    if tipo not in TIPOS_IMPORTACION:
+        return jsonify({"ok": False, "error": f"Tipo inválido: {tipo}"}), 404
+
+    archivo = request.files.get("archivo") if request.mimetype == "multipart/form-data" else None
+    if archivo is not None:
+        lineas = archivo.stream
+        formato = _formato_importacion(archivo.filename, archivo.mimetype, request.args.get("formato"))
+    else:
+        lineas = request.stream
+        formato = _formato_importacion(None, request.mimetype, request.args.get("formato"))
+
+    try:
+        lote = int(request.args.get("lote") or IMPORTACION_LOTE)
+    except ValueError:
+        return jsonify({"ok": False, "error": "lote inválido"}), 200
+
+    conn = get_conn()
+    try:
+        resumen = importar_registros(
+            conn, tipo, lineas, formato, lote=max(lote, 1),
+            simular=request.args.get("simular") in _VERDADEROS,
+            descontar_stock=request.args.get("descontar_stock", "1") in _VERDADEROS,
+        )
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Error importando: {e}"}), 500
+    finally:
+        conn.close()
+
+    return jsonify({"ok": "error" not in resumen, **resumen})
+
+
+@app.cli.command("importar")
+@click.argument("tipo", type=click.Choice(TIPOS_IMPORTACION))
+@click.argument("archivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--formato", type=click.Choice(("csv", "ndjson")), default=None)
+@click.option("--lote", type=int, default=None, help="Filas por transacción.")
+@click.option("--simular", is_flag=True, help="Solo valida, no inserta.")
+@click.option("--sin-stock", is_flag=True, help="Entregas: no descontar stock.")
+def cli_importar(tipo, archivo, formato, lote, simular, sin_stock):
+    """Importa pagos, gastos o entregas desde un CSV o NDJSON."""
+    formato = _formato_importacion(archivo, None, formato)
+    inicio = time.perf_counter()
+    conn = get_conn()
+    try:
+        with open(archivo, "rb") as f:
+            resumen = importar_registros(conn, tipo, f, formato, lote=lote,
+                                         simular=simular, descontar_stock=not sin_stock)
+    finally:
+        conn.close()
+
+    for error in resumen["errores"]:
+        print(f"fila {error['fila']}: {error['error']}")
+    if "error" in resumen:
+        print(resumen["error"])
+    print(f"{resumen['importadas']} de {resumen['leidas']} registros importados "
+          f"({resumen['errores_total']} con error) en {time.perf_counter() - inicio:.1f}s"
+          + (" [simulación]" if simular else ""))
+    if resumen["errores_total"] or "error" in resumen:
+        raise SystemExit(1)
+
+
 # ---------------------------
 # MAIN
 # ---------------------------
 
 if __name__ == "__main__":
     print(f"Usando base de datos: {DB_PATH.resolve()}")
+    obtener_pool(migrar=True)
     app.run(host="0.0.0.0", port=5001, debug=False)
\ No newline at end of file
@@ -1,18 +1,33 @@
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from dataclasses import dataclass
+from typing import List, Dict, Tuple, Optional, BinaryIO, Iterable, Iterator
+import io
+import itertools
+import os
+import tempfile
 
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import mm
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Image, Flowable
+    SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Flowable, PageBreak
 )
-from reportlab.lib.enums import TA_LEFT, TA_RIGHT, TA_CENTER
-from reportlab.pdfbase.pdfmetrics import stringWidth  # ← para medir ancho de texto
 from flask import current_app
 
+from pdfrecursos import estilos, logo as logo_cacheado, ImagenCacheada, ancho_texto
+
+# Subir cuando cambie el diseño del PDF: invalida los PDFs cacheados.
+PLANTILLA_VERSION = "3"
+
+# Lado del logo en el encabezado (mm)
+LOGO_MM = 55
+
+
+def ruta_logo() -> Path:
+    return Path(current_app.root_path) / "static" / "logo.png"
+
+
 # --------------------------
 # Utilidades de formato
 # --------------------------
@@ -22,6 +37,25 @@ def _miles(n: float) -> str:
     s = f"{int(round(n, 0)):,}".replace(",", ".")
     return f"$ {s}"
 
+def _pesos(n: float) -> str:
+    """$ 12.345,67 (con centavos, para los reportes contables)"""
+    s = f"{float(n):,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+    return f"$ {s}"
+
+def _escapar(texto: str) -> str:
+    """Texto libre -> markup de Paragraph (los & y < de una descripción lo rompen)."""
+    return str(texto).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+MESES = ("ENERO", "FEBRERO", "MARZO", "ABRIL", "MAYO", "JUNIO", "JULIO",
+         "AGOSTO", "SEPTIEMBRE", "OCTUBRE", "NOVIEMBRE", "DICIEMBRE")
+
+def _nombre_mes(mes_clave: str) -> str:
+    """'2025-03' -> 'MARZO 2025'"""
+    try:
+        return f"{MESES[int(mes_clave[5:7]) - 1]} {mes_clave[:4]}"
+    except (ValueError, IndexError):
+        return mes_clave
+
 def _fecha_ddmmyyyy(iso: str) -> str:
     try:
         d = datetime.strptime(iso, "%Y-%m-%d")
@@ -50,31 +84,29 @@ class Underline(Flowable):
 # Bloques (encabezado, tabla)
 # --------------------------
 
-def _build_header(cliente: str, fecha_iso: str, page_width: float):
-    styles = getSampleStyleSheet()
-
-    # Estilos “grandes” como el ejemplo
-    st_label = ParagraphStyle("st_label", parent=styles["Normal"], fontSize=18, leading=22)
-    st_value = ParagraphStyle("st_value", parent=styles["Normal"], fontSize=24, leading=28, spaceAfter=6)
-    st_title = ParagraphStyle("st_title", parent=styles["Normal"], fontSize=36, leading=38, alignment=TA_LEFT)
+def _build_header(cliente: str, fecha_iso: str, page_width: float,
+                  titulo: Tuple[str, str] = ("ENTREGA DE", "MERCADERIA"),
+                  etiquetas: Tuple[str, str] = ("Nombre:", "Fecha:")):
+    # Estilos “grandes” como el ejemplo (armados una vez en pdfrecursos)
+    st = estilos()
+    st_label, st_value, st_title = st.label, st.value, st.title
 
     # Logo más grande
-    logo_path = Path(current_app.root_path) / "static" / "logo.png"
     # 55mm x 55mm, y damos un poco más de ancho a la primera columna para que no “apreté” el título
-    logo_w = logo_h = 55 * mm
+    logo_w = logo_h = LOGO_MM * mm
     col_logo = 58 * mm
 
-    logo = Image(str(logo_path), width=logo_w, height=logo_h)
+    logo = ImagenCacheada(logo_cacheado(ruta_logo(), LOGO_MM), width=logo_w, height=logo_h)
 
     # Título en 2 líneas con subrayado grueso
     title_block = []
-    title_block.append(Paragraph("<b>ENTREGA DE</b>", st_title))
+    title_block.append(Paragraph(f"<b>{titulo[0]}</b>", st_title))
     title_block.append(Underline(110*mm, thickness=1.6, color=colors.black, space=3))
-    title_block.append(Paragraph("<b>MERCADERIA</b>", st_title))
+    title_block.append(Paragraph(f"<b>{titulo[1]}</b>", st_title))
 
-    nombre = Paragraph('<font size="18"><b>Nombre:</b></font>', st_label)
-    nombre_val = Paragraph(f"<b>{cliente.upper()}</b>", st_value)
-    fecha = Paragraph('<font size="18"><b>Fecha:</b></font>', st_label)
+    nombre = Paragraph(f'<font size="18"><b>{etiquetas[0]}</b></font>', st_label)
+    nombre_val = Paragraph(f"<b>{_escapar(cliente.upper())}</b>", st_value)
+    fecha = Paragraph(f'<font size="18"><b>{etiquetas[1]}</b></font>', st_label)
     fecha_val = Paragraph(f"<b>{_fecha_ddmmyyyy(fecha_iso)}</b>", st_value)
 
     info_tbl = Table([[nombre, nombre_val],
@@ -104,101 +136,486 @@ def _build_header(cliente: str, fecha_iso: str, page_width: float):
     return header
 
 
-def _build_items_table(items: List[Dict], width: float) -> Table:
-    styles = getSampleStyleSheet()
+# Padding lateral de las celdas (6 pt a cada lado) y vertical (4 pt arriba y abajo)
+PADDING_PT = 12
+PADDING_V_PT = 8
 
-    # Encabezado grande y centrado (igual)
-    st_head = ParagraphStyle("st_head", parent=styles["Normal"], fontSize=20, leading=22, alignment=TA_CENTER)
+# Desde cuántos items la tabla se arma por página (sub-tablas con encabezado y subtotal
+# propios) en lugar de una sola tabla que ReportLab vuelve a partir en cada página.
+ITEMS_TABLA_UNICA = 20
 
-    # ▶ LETRA DEL ÍTEM MÁS GRANDE
-    st_cell = ParagraphStyle("st_cell", parent=styles["Normal"], fontSize=30, leading=30, alignment=TA_LEFT, spaceBefore=0, spaceAfter=0)
-    st_num  = ParagraphStyle("st_num",  parent=styles["Normal"], fontSize=18, leading=21, alignment=TA_RIGHT)
 
-    # Total row styles (igual que antes)
-    st_total_left  = ParagraphStyle("st_total_left",  parent=styles["Normal"], fontSize=22, leading=24, alignment=TA_CENTER)
-    st_total_right = ParagraphStyle("st_total_right", parent=styles["Normal"], fontSize=26, leading=28, alignment=TA_RIGHT)
+@dataclass
+class _ItemsPreparados:
+    filas: List[Tuple[str, int, float, float]]  # (pieza, cantidad, precio, total)
+    anchos: List[float]                          # Artículo, C, Precio, Total
+    total: float
 
-    # ---- Anchos DINÁMICOS para evitar wraps en encabezados y TOTAL ----
-    # Padding lateral de la tabla (6 pt a cada lado)
-    PADDING_PT = 12
-
-    # Cantidad: tomamos el más ancho (contenido y encabezado)
-    qty_texts = [str(int(it.get("cantidad", 0))) for it in items] or ["0"]
-    qty_texts.append("C")  # encabezado
-    qty_w_pt = max(stringWidth(t, "Helvetica", st_head.fontSize if t == "C" else st_num.fontSize) for t in qty_texts) + PADDING_PT
-    col_c = max(16 * mm, qty_w_pt)  # nunca menos de 16 mm
-
-    # Precio: máximo entre encabezado y valores
-    precio_texts = [ _miles(float(it.get("precio", 0))) for it in items ] or ["$ 0"]
-    precio_texts.append("Precio")
-    precio_w_pt = max(stringWidth(t, "Helvetica", st_head.fontSize if t == "Precio" else st_num.fontSize) for t in precio_texts) + PADDING_PT
-    col_precio = max(26 * mm, precio_w_pt)  # mínimo 26 mm para no partir "Precio"
-
-    # Total: considerar también el TOTAL FINAL en fuente 26
-    total_texts = [ _miles(float(it.get("total", float(it.get("cantidad",0))*float(it.get("precio",0))))) for it in items ] or ["$ 0"]
-    total_texts.append("Total")
-    total_w_rows = max(stringWidth(t, "Helvetica", st_head.fontSize if t == "Total" else st_num.fontSize) for t in total_texts) + PADDING_PT
-    total_w_grand = stringWidth(_miles(sum(float(it.get("total", float(it.get("cantidad",0))*float(it.get("precio",0)))) for it in items)), "Helvetica", st_total_right.fontSize) + PADDING_PT
-    col_total = max(28 * mm, total_w_rows, total_w_grand)  # mínimo 28 mm y que entre el "Total Final"
 
+def _preparar_items(items: List[Dict], width: float) -> _ItemsPreparados:
+    """
+    Una sola pasada por los items: normaliza cada fila, mide el texto más ancho de
+    cada columna y acumula el total (antes eran cuatro recorridos con sus conversiones).
+    """
+    st = estilos()
+    f_head, f_num = st.head.fontSize, st.num.fontSize
+
+    filas = []
+    total = positivos = 0.0
+    # Encabezados: nunca más angostos que "C", "Precio", "Total"
+    w_c = ancho_texto("C", "Helvetica", f_head)
+    w_precio = ancho_texto("Precio", "Helvetica", f_head)
+    w_total = ancho_texto("Total", "Helvetica", f_head)
+    for it in items:
+        pieza = str(it.get("pieza", "")).strip().replace("\n", "<br/>")
+        cant = int(it.get("cantidad", 0))
+        precio = float(it.get("precio") or 0)
+        tot = it.get("total")
+        tot = float(cant * precio if tot is None else tot)
+        filas.append((pieza, cant, precio, tot))
+        total += tot
+        if tot > 0:
+            positivos += tot
+        w_c = max(w_c, ancho_texto(str(cant), "Helvetica", f_num))
+        w_precio = max(w_precio, ancho_texto(_miles(precio), "Helvetica", f_num))
+        w_total = max(w_total, ancho_texto(_miles(tot), "Helvetica", f_num))
+    if not filas:
+        w_precio = max(w_precio, ancho_texto("$ 0", "Helvetica", f_num))
+        w_total = max(w_total, ancho_texto("$ 0", "Helvetica", f_num))
+
+    # ---- Anchos DINÁMICOS para evitar wraps en encabezados y TOTAL ----
+    col_c = max(16 * mm, w_c + PADDING_PT)                # nunca menos de 16 mm
+    col_precio = max(26 * mm, w_precio + PADDING_PT)      # no partir "Precio"
+    col_total = max(28 * mm, w_total + PADDING_PT,        # que entre el "Total Final"
+                    ancho_texto(_miles(total), "Helvetica", st.total_right.fontSize) + PADDING_PT,
+                    # y el subtotal más grande posible de una página
+                    ancho_texto(_miles(positivos), "Helvetica", st.subtotal_right.fontSize) + PADDING_PT)
     # El resto del ancho para "Artículo"
     col_art = max(60 * mm, width - (col_c + col_precio + col_total))
 
-    # ---- Datos ----
-    data = [
-        [Paragraph("<b>Artículo</b>", st_head),
-         Paragraph("<b>C</b>", st_head),
-         Paragraph("<b>Precio</b>", st_head),
-         Paragraph("<b>Total</b>", st_head)]
-    ]
+    return _ItemsPreparados(filas, [col_art, col_c, col_precio, col_total], total)
 
-    total_val = 0.0
-    for it in items:
-        pieza  = str(it.get("pieza", "")).strip().replace("\n", "<br/>")
-        cant   = int(it.get("cantidad", 0))
-        precio = float(it.get("precio", 0))
-        tot    = float(it.get("total", cant * precio))
-        total_val += tot
-        data.append([
-            Paragraph(pieza, st_cell),             # ▶ ÍTEM con letra 18
-            Paragraph(str(cant), st_head),         # centrado
-            Paragraph(_miles(precio), st_num),
-            Paragraph(_miles(tot), st_num),
-        ])
-
-    # Fila TOTAL (en una sola línea)
-    idx_total = len(data)
-    data.append([
-        Paragraph("<b>Total Final:</b>", st_total_left),
-        "", "",
-        Paragraph(f"<b>{_miles(total_val)}</b>", st_total_right),
-    ])
-
-    tbl = Table(data, colWidths=[col_art, col_c, col_precio, col_total], repeatRows=1)
-    tbl.setStyle(TableStyle([
+
+def _fila_encabezado() -> list:
+    st = estilos()
+    return [Paragraph("<b>Artículo</b>", st.head),
+            Paragraph("<b>C</b>", st.head),
+            Paragraph("<b>Precio</b>", st.head),
+            Paragraph("<b>Total</b>", st.head)]
+
+
+def _fila_item(fila: Tuple[str, int, float, float]) -> list:
+    st = estilos()
+    pieza, cant, precio, tot = fila
+    return [Paragraph(pieza, st.cell),              # ▶ ÍTEM con letra grande
+            Paragraph(str(cant), st.head),          # centrado
+            Paragraph(_miles(precio), st.num),
+            Paragraph(_miles(tot), st.num)]
+
+
+def _fila_total(monto: float) -> list:
+    st = estilos()
+    return [Paragraph("<b>Total Final:</b>", st.total_left), "", "",
+            Paragraph(f"<b>{_miles(monto)}</b>", st.total_right)]
+
+
+def _fila_subtotal(monto: float) -> list:
+    st = estilos()
+    return [Paragraph("<b>Subtotal:</b>", st.subtotal_left), "", "",
+            Paragraph(f"<b>{_miles(monto)}</b>", st.subtotal_right)]
+
+
+def _estilo_tabla(n_filas: int, pies: int) -> TableStyle:
+    """Bordes gruesos; las últimas `pies` filas (subtotal / total) van en una sola línea."""
+    comandos = [
         ("BOX", (0,0), (-1,-1), 1.4, colors.black),
-        ("INNERGRID", (0,0), (-1,-2), 0.9, colors.black),
+        ("INNERGRID", (0,0), (-1,-1-pies), 0.9, colors.black),
         ("BACKGROUND", (0,0), (-1,0), colors.white),
         ("LINEBELOW", (0,0), (-1,0), 1.4, colors.black),
         ("VALIGN", (0,0), (-1,-1), "MIDDLE"),
-        ("ALIGN",  (1,1), (1,-2), "CENTER"),
+        ("ALIGN",  (1,1), (1,-1-pies), "CENTER"),
         ("LEFTPADDING", (0,0), (-1,-1), 6),
         ("RIGHTPADDING", (0,0), (-1,-1), 6),
         ("TOPPADDING", (0,0), (-1,-1), 4),
         ("BOTTOMPADDING", (0,0), (-1,-1), 4),
-        ("SPAN", (0, idx_total), (2, idx_total)),
-        ("LINEABOVE", (0, idx_total), (-1, idx_total), 1.6, colors.black),
-        ("ALIGN", (0, idx_total), (2, idx_total), "CENTER"),
-        ("RIGHTPADDING", (3, idx_total), (3, idx_total), 6),
-    ]))
+    ]
+    for k in range(pies):
+        idx = n_filas - pies + k
+        comandos += [
+            ("SPAN", (0, idx), (2, idx)),
+            ("LINEABOVE", (0, idx), (-1, idx), 1.6 if k == 0 else 0.9, colors.black),
+            ("ALIGN", (0, idx), (2, idx), "CENTER"),
+        ]
+    return TableStyle(comandos)
+
+
+class TablaItemsPaginada(Flowable):
+    """
+    Tabla de items que se corta por página: en cada página una sub-tabla con su
+    encabezado y el subtotal de esa página; la última cierra con el Total Final.
+
+    Cada fila se arma y se mide una sola vez (las alturas quedan compartidas entre los
+    pedazos) y las sub-tablas reciben las alturas ya calculadas, así el costo crece
+    lineal con la cantidad de items en vez de re-medir el resto de la tabla en cada corte.
+    """
+
+    def __init__(self, prep: _ItemsPreparados, inicio: int = 0,
+                 celdas: Optional[list] = None, alturas: Optional[list] = None,
+                 fijas: Optional[Tuple[float, float, float]] = None):
+        super().__init__()
+        self.prep = prep
+        self.inicio = inicio
+        n = len(prep.filas)
+        self.celdas = celdas if celdas is not None else [None] * n
+        self.alturas = alturas if alturas is not None else [None] * n
+        self.width = sum(prep.anchos)
+        self.height = 0
+        self._fijas = fijas
+        self._tabla = None
+
+    # ---- medidas ----
+
+    def _alto_pie(self, filas) -> float:
+        # Las filas con SPAN se miden con la propia Table (son pocas y siempre iguales)
+        t = Table(filas, colWidths=self.prep.anchos)
+        t.setStyle(_estilo_tabla(len(filas), len(filas)))
+        return t.wrap(self.width, 1e9)[1]
+
+    def _alto_fila(self, i: int) -> float:
+        h = self.alturas[i]
+        if h is None:
+            celdas = self.celdas[i] = _fila_item(self.prep.filas[i])
+            h = max(p.wrap(w - PADDING_PT, 1e9)[1] for p, w in zip(celdas, self.prep.anchos))
+            h = self.alturas[i] = h + PADDING_V_PT
+        return h
+
+    def _medidas_fijas(self) -> Tuple[float, float, float]:
+        """Alto del encabezado, de la fila de subtotal y de la de Total Final."""
+        if self._fijas is None:
+            enc = Table([_fila_encabezado()], colWidths=self.prep.anchos)
+            enc.setStyle(_estilo_tabla(1, 0))
+            self._fijas = (enc.wrap(self.width, 1e9)[1],
+                           self._alto_pie([_fila_subtotal(self.prep.total)]),
+                           self._alto_pie([_fila_total(self.prep.total)]))
+        return self._fijas
+
+    def _cuantas_entran(self, alto_disponible: float, alto_pie: float) -> Tuple[int, float]:
+        """Filas desde `inicio` que entran junto con el encabezado y un pie de alto_pie."""
+        h_enc, _, _ = self._medidas_fijas()
+        usado = h_enc
+        i = self.inicio
+        while i < len(self.prep.filas):
+            h = self._alto_fila(i)
+            if usado + h + alto_pie > alto_disponible:
+                break
+            usado += h
+            i += 1
+        return i, usado
+
+    # ---- armado de cada pedazo ----
+
+    def _sub_tabla(self, fin: int, pies: list) -> Table:
+        h_enc, h_sub, h_tot = self._medidas_fijas()
+        data = [_fila_encabezado()]
+        alturas = [h_enc]
+        for i in range(self.inicio, fin):
+            alturas.append(self._alto_fila(i))
+            data.append(self.celdas[i] or _fila_item(self.prep.filas[i]))
+            self.celdas[i] = None  # ya forma parte de la sub-tabla
+        for fila, h in pies:
+            data.append(fila)
+            alturas.append(h)
+        tbl = Table(data, colWidths=self.prep.anchos, rowHeights=alturas, repeatRows=1)
+        tbl.setStyle(_estilo_tabla(len(data), len(pies)))
+        return tbl
+
+    def _subtotal(self, fin: int) -> float:
+        return sum(f[3] for f in self.prep.filas[self.inicio:fin])
+
+    def _pies_finales(self) -> list:
+        _, h_sub, h_tot = self._medidas_fijas()
+        pies = [(_fila_total(self.prep.total), h_tot)]
+        if self.inicio > 0:  # hubo páginas antes: también el subtotal de esta
+            pies.insert(0, (_fila_subtotal(self._subtotal(len(self.prep.filas))), h_sub))
+        return pies
+
+    # ---- protocolo Flowable ----
+
+    def wrap(self, aw, ah):
+        _, h_sub, h_tot = self._medidas_fijas()
+        alto_pie = h_tot + (h_sub if self.inicio > 0 else 0)
+        fin, usado = self._cuantas_entran(ah, alto_pie)
+        if fin == len(self.prep.filas):
+            # Entra todo lo que queda: es el último pedazo
+            self._tabla = self._sub_tabla(fin, self._pies_finales())
+            self.height = usado + alto_pie
+        else:
+            # No entra: alcanza con informar que sobra para que el frame llame a split()
+            self._tabla = None
+            self.height = ah + 1
+        return self.width, self.height
+
+    def split(self, aw, ah):
+        _, h_sub, _ = self._medidas_fijas()
+        fin, _ = self._cuantas_entran(ah, h_sub)
+        if fin == self.inicio:
+            return []  # ni una fila: a la página siguiente
+        pagina = self._sub_tabla(fin, [(_fila_subtotal(self._subtotal(fin)), h_sub)])
+        resto = TablaItemsPaginada(self.prep, fin, self.celdas, self.alturas, self._fijas)
+        return [pagina, resto]
+
+    def draw(self):
+        if self._tabla is not None:
+            self._tabla.wrapOn(self.canv, self.width, self.height)
+            self._tabla.drawOn(self.canv, 0, 0)
+
+
+def _build_items_table(items: List[Dict], width: float,
+                       paginar: Optional[bool] = None) -> Flowable:
+    """
+    Tabla de items con el TOTAL integrado como última fila.
+    paginar=None decide solo: hasta ITEMS_TABLA_UNICA items va una única tabla; con más,
+    TablaItemsPaginada (sub-tabla por página con encabezado repetido y subtotal).
+    """
+    prep = _preparar_items(items, width)
+    if paginar is None:
+        paginar = len(prep.filas) > ITEMS_TABLA_UNICA
+    if paginar:
+        return TablaItemsPaginada(prep)
+
+    data = [_fila_encabezado()]
+    data.extend(_fila_item(f) for f in prep.filas)
+    data.append(_fila_total(prep.total))
+
+    tbl = Table(data, colWidths=prep.anchos, repeatRows=1)
+    tbl.setStyle(_estilo_tabla(len(data), 1))
     return tbl
 
 
+class TablaMovimientos(Flowable):
+    """
+    Tabla del estado de cuenta alimentada por un iterador (p. ej. un cursor SQLite):
+    solo se traen las filas de la página que se está armando, así la memoria no
+    depende de cuántos movimientos tenga el período. Cada página lleva el encabezado
+    y la última cierra con el saldo final.
+    """
+
+    PADDING_V_PT = 6
+
+    def __init__(self, movimientos: Iterator[Dict], anchos: List[float], saldo: float,
+                 pendientes: Optional[List[Tuple[list, float]]] = None,
+                 fijas: Optional[Tuple[float, float]] = None):
+        super().__init__()
+        self.movimientos = movimientos
+        self.anchos = anchos
+        self.saldo = saldo              # saldo después de la última fila leída
+        self.pendientes = pendientes if pendientes is not None else []  # (celdas, alto)
+        self.agotado = False
+        self.width = sum(anchos)
+        self.height = 0
+        self._fijas = fijas
+        self._tabla = None
+
+    def _fila_encabezado(self) -> list:
+        st = estilos()
+        return [Paragraph("<b>Fecha</b>", st.mov_head),
+                Paragraph("<b>Descripción</b>", st.mov_head),
+                Paragraph("<b>Importe</b>", st.mov_head),
+                Paragraph("<b>Saldo</b>", st.mov_head)]
+
+    def _fila_saldo_final(self) -> list:
+        st = estilos()
+        return [Paragraph("<b>Saldo final:</b>", st.subtotal_left), "", "",
+                Paragraph(f"<b>{_miles(self.saldo)}</b>", st.subtotal_right)]
+
+    def _estilo(self, n_filas: int, pies: int) -> TableStyle:
+        comandos = [
+            ("BOX", (0,0), (-1,-1), 1.2, colors.black),
+            ("INNERGRID", (0,0), (-1,-1-pies), 0.5, colors.black),
+            ("LINEBELOW", (0,0), (-1,0), 1.2, colors.black),
+            ("VALIGN", (0,0), (-1,-1), "MIDDLE"),
+            ("FONT", (0,1), (-1,-1), "Helvetica", estilos().mov_cell.fontSize,
+             estilos().mov_cell.leading),
+            ("ALIGN", (2,1), (3,-1), "RIGHT"),
+            ("LEFTPADDING", (0,0), (-1,-1), 4),
+            ("RIGHTPADDING", (0,0), (-1,-1), 4),
+            ("TOPPADDING", (0,0), (-1,-1), 3),
+            ("BOTTOMPADDING", (0,0), (-1,-1), 3),
+        ]
+        if pies:
+            comandos += [("SPAN", (0, n_filas - 1), (2, n_filas - 1)),
+                         ("LINEABOVE", (0, n_filas - 1), (-1, n_filas - 1), 1.6, colors.black)]
+        return TableStyle(comandos)
+
+    def _medidas_fijas(self) -> Tuple[float, float]:
+        """Alto del encabezado y de la fila de saldo final."""
+        if self._fijas is None:
+            enc = Table([self._fila_encabezado()], colWidths=self.anchos)
+            enc.setStyle(self._estilo(1, 0))
+            pie = Table([self._fila_saldo_final()], colWidths=self.anchos)
+            pie.setStyle(self._estilo(1, 1))
+            self._fijas = (enc.wrap(self.width, 1e9)[1], pie.wrap(self.width, 1e9)[1])
+        return self._fijas
+
+    def _siguiente(self) -> bool:
+        """Lee un movimiento más del iterador y lo deja armado y medido en pendientes."""
+        mov = next(self.movimientos, None)
+        if mov is None:
+            self.agotado = True
+            return False
+        st = estilos()
+        importe = mov.get("total")
+        # Texto plano (una línea, lo dibuja la Table sin armar párrafos); solo la
+        # descripción que no entra en su columna pasa a Paragraph para que haga wrap.
+        descripcion = str(mov.get("descripcion") or "")
+        alto = st.mov_cell.leading
+        if ancho_texto(descripcion, "Helvetica", st.mov_cell.fontSize) > self.anchos[1] - 8:
+            descripcion = Paragraph(_escapar(descripcion), st.mov_cell)
+            alto = max(alto, descripcion.wrap(self.anchos[1] - 8, 1e9)[1])
+        celdas = [_fecha_ddmmyyyy(mov.get("fecha") or ""),
+                  descripcion,
+                  "" if importe is None else _miles(importe),
+                  _miles(mov["saldo_posterior"])]
+        self.pendientes.append((celdas, alto + self.PADDING_V_PT))
+        self.saldo = float(mov["saldo_posterior"])
+        return True
+
+    def _cuantas_entran(self, alto_disponible: float, alto_pie: float) -> Tuple[int, float]:
+        """Filas pendientes que entran (leyendo del iterador solo lo necesario)."""
+        usado = self._medidas_fijas()[0]
+        i = 0
+        while True:
+            if i == len(self.pendientes) and (self.agotado or not self._siguiente()):
+                break
+            alto = self.pendientes[i][1]
+            if usado + alto + alto_pie > alto_disponible:
+                break
+            usado += alto
+            i += 1
+        return i, usado
+
+    def _sub_tabla(self, filas: List[Tuple[list, float]], con_pie: bool) -> Table:
+        h_enc, h_pie = self._medidas_fijas()
+        data = [self._fila_encabezado()] + [c for c, _ in filas]
+        alturas = [h_enc] + [h for _, h in filas]
+        if con_pie:
+            data.append(self._fila_saldo_final())
+            alturas.append(h_pie)
+        tbl = Table(data, colWidths=self.anchos, rowHeights=alturas, repeatRows=1)
+        tbl.setStyle(self._estilo(len(data), 1 if con_pie else 0))
+        return tbl
+
+    def wrap(self, aw, ah):
+        h_pie = self._medidas_fijas()[1]
+        fin, usado = self._cuantas_entran(ah, h_pie)
+        if self.agotado and fin == len(self.pendientes):
+            self._tabla = self._sub_tabla(self.pendientes, con_pie=True)
+            self.height = usado + h_pie
+        else:
+            self._tabla = None
+            self.height = ah + 1
+        return self.width, self.height
+
+    def split(self, aw, ah):
+        fin, _ = self._cuantas_entran(ah, 0)
+        if fin == 0:
+            return []
+        pagina = self._sub_tabla(self.pendientes[:fin], con_pie=False)
+        resto = TablaMovimientos(self.movimientos, self.anchos, self.saldo,
+                                 self.pendientes[fin:], self._fijas)
+        resto.agotado = self.agotado
+        return [pagina, resto]
+
+    def draw(self):
+        if self._tabla is not None:
+            self._tabla.wrapOn(self.canv, self.width, self.height)
+            self._tabla.drawOn(self.canv, 0, 0)
+
+
 # --------------------------
 # Generador principal
 # --------------------------
 
-def build_entrega_pdf(cliente: str, fecha_iso: str, items: List[Dict], out_path: Path) -> Tuple[bytes, str]:
+def _nuevo_documento(buffer: BinaryIO, titulo: str) -> SimpleDocTemplate:
+    return SimpleDocTemplate(
+        buffer,
+        pagesize=A4,
+        leftMargin=14*mm, rightMargin=14*mm,
+        topMargin=10*mm, bottomMargin=14*mm,
+        title=titulo
+    )
+
+
+def _story_entrega(cliente: str, fecha_iso: str, items: List[Dict], page_w: float) -> List[Flowable]:
+    # Story: encabezado + tabla (el total ya va dentro de la tabla)
+    header = _build_header(cliente, fecha_iso, page_w)
+    items_tbl = _build_items_table(items, page_w)
+    return [header, Spacer(0, 6), items_tbl]
+
+
+def render_entrega_pdf(cliente: str, fecha_iso: str, items: List[Dict],
+                       destino: Optional[BinaryIO] = None) -> BinaryIO:
+    """
+    Arma el PDF de la entrega directamente en memoria (o en el file-like `destino`)
+    y devuelve el buffer posicionado al inicio, listo para send_file.
+    """
+    buffer = destino if destino is not None else io.BytesIO()
+
+    doc = _nuevo_documento(buffer, f"Entrega {cliente}")
+    page_w = A4[0] - doc.leftMargin - doc.rightMargin
+
+    doc.build(_story_entrega(cliente, fecha_iso, items, page_w))
+    buffer.seek(0)
+    return buffer
+
+
+def render_entregas_pdf(entregas: List[Dict], destino: Optional[BinaryIO] = None,
+                        titulo: str = "Entregas") -> BinaryIO:
+    """
+    Varias entregas en un solo PDF, cada una desde una página nueva.
+    entregas: [{"cliente", "fecha", "items"}, ...]. El logo se embebe una sola vez.
+    """
+    buffer = destino if destino is not None else io.BytesIO()
+
+    doc = _nuevo_documento(buffer, titulo)
+    page_w = A4[0] - doc.leftMargin - doc.rightMargin
+
+    story = []
+    for e in entregas:
+        if story:
+            story.append(PageBreak())
+        story.extend(_story_entrega(e["cliente"], e["fecha"], e["items"], page_w))
+
+    doc.build(story)
+    buffer.seek(0)
+    return buffer
+
+
+def guardar_archivo(datos: bytes, out_path: Path) -> Path:
+    """
+    Escribe el archivo en disco de forma atómica (archivo temporal + rename), así dos
+    requests que generan el mismo archivo nunca dejan uno a medio escribir.
+    """
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=out_path.parent, prefix=out_path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(datos)
+        os.replace(tmp, out_path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return out_path
+
+
+def guardar_pdf(pdf_bytes: bytes, out_path: Path) -> Path:
+    """Escribe el PDF en disco de forma atómica (ver guardar_archivo)."""
+    return guardar_archivo(pdf_bytes, out_path)
+
+
+def build_entrega_pdf(cliente: str, fecha_iso: str, items: List[Dict],
+                      out_path: Optional[Path] = None) -> Tuple[bytes, Optional[str]]:
     """
     Genera el PDF de la entrega con la estética del ejemplo.
     - Logo grande a la izquierda (data/logo.png|jpg)
@@ -206,25 +623,149 @@ def build_entrega_pdf(cliente: str, fecha_iso: str, items: List[Dict], out_path:
     - Nombre/Fecha grandes
     - Tabla con bordes gruesos; TOTAL integrado como última fila (con línea gruesa arriba)
     - Formato monetario $ 7.000
+    Se arma en memoria; si se pasa out_path además se guarda una copia en disco.
     """
-    out_path = Path(out_path)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+    pdf_bytes = render_entrega_pdf(cliente, fecha_iso, items).getvalue()
+    if out_path is None:
+        return pdf_bytes, None
+    return pdf_bytes, str(guardar_pdf(pdf_bytes, out_path))
 
-    doc = SimpleDocTemplate(
-        str(out_path),
-        pagesize=A4,
-        leftMargin=14*mm, rightMargin=14*mm,
-        topMargin=10*mm, bottomMargin=14*mm,
-        title=f"Entrega {cliente}"
-    )
+
+def build_estado_cuenta_pdf(cliente: str, movimientos: Iterable[Dict],
+                            desde: Optional[str] = None, hasta: Optional[str] = None,
+                            saldo_anterior: float = 0.0,
+                            destino: Optional[BinaryIO] = None) -> BinaryIO:
+    """
+    Estado de cuenta de un revendedor: mismo encabezado que la entrega (logo, nombre,
+    fecha) y la lista de movimientos con el saldo después de cada uno.
+    movimientos: iterable de {"fecha", "descripcion", "total", "saldo_posterior"} en
+    orden cronológico; se consume de a una página, así que puede ser un cursor.
+    Con `desde` la tabla arranca con el saldo anterior a esa fecha.
+    Devuelve el buffer (o `destino`) posicionado al inicio.
+    """
+    buffer = destino if destino is not None else io.BytesIO()
+
+    doc = _nuevo_documento(buffer, f"Estado de cuenta {cliente}")
     page_w = A4[0] - doc.leftMargin - doc.rightMargin
 
-    # Bloques
-    header = _build_header(cliente, fecha_iso, page_w)
-    items_tbl = _build_items_table(items, page_w)
+    st = estilos()
+    fecha_doc = hasta or datetime.now().strftime("%Y-%m-%d")
+    periodo = (f"Desde {_fecha_ddmmyyyy(desde) if desde else 'el inicio'} "
+               f"hasta {_fecha_ddmmyyyy(fecha_doc)}")
+
+    filas = iter(movimientos)
+    if desde:
+        apertura = {"fecha": desde, "descripcion": "Saldo anterior", "total": None,
+                    "saldo_posterior": saldo_anterior}
+        filas = itertools.chain([apertura], filas)
+
+    anchos = [24 * mm, page_w - 24 * mm - 2 * 34 * mm, 34 * mm, 34 * mm]
+    story = [
+        _build_header(cliente, fecha_doc, page_w, titulo=("ESTADO DE", "CUENTA")),
+        Spacer(0, 4),
+        Paragraph(f"<b>{periodo}</b>", st.label),
+        Spacer(0, 6),
+        TablaMovimientos(filas, anchos, saldo_anterior),
+    ]
+    doc.build(story)
+    buffer.seek(0)
+    return buffer
 
-    # Story: encabezado + tabla (el total ya va dentro de la tabla)
-    story = [header, Spacer(0, 6), items_tbl]
+
+# --------------------------
+# Reporte mensual de cuentas
+# --------------------------
+
+# Ancho fijo por tipo de columna; las de texto se reparten lo que sobra.
+_ANCHO_COLUMNA = {"fecha": 22 * mm, "importe": 27 * mm}
+
+
+def _recortar(texto: str, ancho: float, fuente: str, tamano: float) -> str:
+    """Texto de una línea que entra en `ancho` (con … si hubo que cortarlo)."""
+    if ancho_texto(texto, fuente, tamano) <= ancho:
+        return texto
+    while texto and ancho_texto(texto + "…", fuente, tamano) > ancho:
+        texto = texto[:-1]
+    return texto + "…"
+
+
+def _tabla_seccion(seccion: Dict, width: float) -> Table:
+    st = estilos()
+    columnas = seccion["columnas"]
+    fijo = sum(_ANCHO_COLUMNA.get(tipo, 0) for _, _, tipo in columnas)
+    n_texto = sum(1 for _, _, tipo in columnas if tipo not in _ANCHO_COLUMNA) or 1
+    anchos = [_ANCHO_COLUMNA.get(tipo, (width - fijo) / n_texto) for _, _, tipo in columnas]
+    tamano = st.mov_cell.fontSize
+
+    def celdas(fila):
+        out = []
+        for (clave, _, tipo), ancho in zip(columnas, anchos):
+            valor = fila.get(clave)
+            if valor is None or valor == "":
+                out.append("")
+            elif tipo == "importe":
+                out.append(_pesos(valor))
+            elif tipo == "fecha":
+                out.append(_fecha_ddmmyyyy(str(valor)))
+            else:
+                out.append(_recortar(str(valor), ancho - 8, "Helvetica", tamano))
+        return out
+
+    data = [[Paragraph(f"<b>{nombre}</b>", st.mov_head) for _, nombre, _ in columnas]]
+    data.extend(celdas(f) for f in seccion["filas"])
+    total = seccion.get("total")
+    if total is not None:
+        data.append(celdas(total))
+
+    comandos = [
+        ("BOX", (0,0), (-1,-1), 1.2, colors.black),
+        ("INNERGRID", (0,0), (-1,-1), 0.5, colors.black),
+        ("LINEBELOW", (0,0), (-1,0), 1.2, colors.black),
+        ("VALIGN", (0,0), (-1,-1), "MIDDLE"),
+        ("FONT", (0,1), (-1,-1), "Helvetica", tamano, st.mov_cell.leading),
+        ("LEFTPADDING", (0,0), (-1,-1), 4),
+        ("RIGHTPADDING", (0,0), (-1,-1), 4),
+        ("TOPPADDING", (0,0), (-1,-1), 3),
+        ("BOTTOMPADDING", (0,0), (-1,-1), 3),
+    ]
+    for i, (_, _, tipo) in enumerate(columnas):
+        if tipo == "importe":
+            comandos.append(("ALIGN", (i, 1), (i, -1), "RIGHT"))
+    if total is not None:
+        comandos += [("FONT", (0,-1), (-1,-1), "Helvetica-Bold", tamano, st.mov_cell.leading),
+                     ("LINEABOVE", (0,-1), (-1,-1), 1.6, colors.black)]
+
+    tbl = Table(data, colWidths=anchos, repeatRows=1)
+    tbl.setStyle(TableStyle(comandos))
+    return tbl
+
+
+def build_reporte_cuentas_pdf(mes_clave: str, secciones: List[Dict],
+                              destino: Optional[BinaryIO] = None) -> BinaryIO:
+    """
+    Reporte contable de un mes: encabezado de siempre (logo, mes, fecha de emisión)
+    y una tabla por sección.
+    secciones: [{"titulo", "columnas": [(clave, nombre, tipo)], "filas": [dict],
+    "total": dict | None}], con tipo "fecha", "texto" o "importe".
+    Devuelve el buffer (o `destino`) posicionado al inicio.
+    """
+    buffer = destino if destino is not None else io.BytesIO()
+
+    doc = _nuevo_documento(buffer, f"Cuentas {mes_clave}")
+    page_w = A4[0] - doc.leftMargin - doc.rightMargin
+
+    st = estilos()
+    story = [_build_header(_nombre_mes(mes_clave), datetime.now().strftime("%Y-%m-%d"), page_w,
+                           titulo=("REPORTE DE", "CUENTAS"), etiquetas=("Mes:", "Emitido:"))]
+    for seccion in secciones:
+        story.append(Spacer(0, 10))
+        story.append(Paragraph(f"<b>{seccion['titulo']}</b>", st.label))
+        story.append(Spacer(0, 4))
+        if seccion["filas"] or seccion.get("total") is not None:
+            story.append(_tabla_seccion(seccion, page_w))
+        else:
+            story.append(Paragraph("Sin movimientos.", st.mov_cell))
 
     doc.build(story)
-    return out_path.read_bytes(), str(out_path)
+    buffer.seek(0)
+    return buffer
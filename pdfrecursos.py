@@ -0,0 +1,99 @@
+from functools import lru_cache
+from pathlib import Path
+from types import SimpleNamespace
+
+from PIL import Image as PILImage
+from reportlab import rl_config
+from reportlab.lib.enums import TA_LEFT, TA_RIGHT, TA_CENTER
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import Flowable
+
+# --------------------------
+# Recursos de ReportLab armados una sola vez por proceso
+# --------------------------
+
+# Las imágenes van comprimidas en binario (sin la capa ASCII85, que en Python puro es
+# lo más lento de embeber el logo y además agranda el PDF ~25%).
+rl_config.useA85 = 0
+
+# Resolución a la que se guarda el logo: de sobra para imprimir y mucho más liviano
+# que el PNG original (3543 px para un cuadro de 55 mm).
+LOGO_DPI = 300
+
+
+@lru_cache(maxsize=None)
+def estilos() -> SimpleNamespace:
+    """Todos los ParagraphStyle de los PDFs (encabezado y tabla de items)."""
+    base = getSampleStyleSheet()["Normal"]
+    return SimpleNamespace(
+        # Encabezado
+        label=ParagraphStyle("st_label", parent=base, fontSize=18, leading=22),
+        value=ParagraphStyle("st_value", parent=base, fontSize=24, leading=28, spaceAfter=6),
+        title=ParagraphStyle("st_title", parent=base, fontSize=36, leading=38, alignment=TA_LEFT),
+        # Tabla de items
+        head=ParagraphStyle("st_head", parent=base, fontSize=20, leading=22, alignment=TA_CENTER),
+        cell=ParagraphStyle("st_cell", parent=base, fontSize=30, leading=30, alignment=TA_LEFT,
+                            spaceBefore=0, spaceAfter=0),
+        num=ParagraphStyle("st_num", parent=base, fontSize=18, leading=21, alignment=TA_RIGHT),
+        total_left=ParagraphStyle("st_total_left", parent=base, fontSize=22, leading=24,
+                                  alignment=TA_CENTER),
+        total_right=ParagraphStyle("st_total_right", parent=base, fontSize=26, leading=28,
+                                   alignment=TA_RIGHT),
+        # Subtotal de cada página (tabla paginada)
+        subtotal_left=ParagraphStyle("st_subtotal_left", parent=base, fontSize=18, leading=21,
+                                     alignment=TA_CENTER),
+        subtotal_right=ParagraphStyle("st_subtotal_right", parent=base, fontSize=18, leading=21,
+                                      alignment=TA_RIGHT),
+        # Estado de cuenta (muchas filas: letra más chica)
+        mov_head=ParagraphStyle("st_mov_head", parent=base, fontSize=12, leading=14,
+                                alignment=TA_CENTER),
+        mov_cell=ParagraphStyle("st_mov_cell", parent=base, fontSize=11, leading=13,
+                                alignment=TA_LEFT),
+        mov_num=ParagraphStyle("st_mov_num", parent=base, fontSize=11, leading=13,
+                               alignment=TA_RIGHT),
+    )
+
+
+@lru_cache(maxsize=8)
+def _logo_reader(ruta: str, mtime_ns: int, lado_mm: float) -> ImageReader:
+    # mtime_ns es parte de la clave: si se reemplaza el logo se vuelve a decodificar.
+    lado_px = max(1, round(lado_mm / 25.4 * LOGO_DPI))
+    with PILImage.open(ruta) as img:
+        img.load()
+        if max(img.size) > lado_px:
+            img.thumbnail((lado_px, lado_px), PILImage.LANCZOS)
+        return ImageReader(img.copy())
+
+
+def logo(ruta: Path, lado_mm: float) -> ImageReader:
+    """Logo decodificado y escalado a LOGO_DPI, cacheado por (ruta, mtime, tamaño)."""
+    ruta = Path(ruta)
+    return _logo_reader(str(ruta), ruta.stat().st_mtime_ns, lado_mm)
+
+
+class ImagenCacheada(Flowable):
+    """Dibuja un ImageReader ya decodificado (platypus.Image lo relee en cada PDF)."""
+
+    def __init__(self, reader: ImageReader, width: float, height: float):
+        super().__init__()
+        self.reader = reader
+        self.width = width
+        self.height = height
+
+    def draw(self):
+        self.canv.drawImage(self.reader, 0, 0, self.width, self.height, mask="auto")
+
+
+@lru_cache(maxsize=4096)
+def ancho_texto(texto: str, fuente: str, tamano: float) -> float:
+    """stringWidth memoizado: los mismos importes y encabezados se miden en cada PDF."""
+    return stringWidth(texto, fuente, tamano)
+
+
+def limpiar_caches():
+    """Descarta estilos, logo y medidas (benchmarks en frío, tests)."""
+    estilos.cache_clear()
+    _logo_reader.cache_clear()
+    ancho_texto.cache_clear()
@@ -0,0 +1,105 @@
+"""
+Prueba de carrera del descuento de stock de /api/entregas.
+
+Levanta la app contra una base temporal (no toca la real), crea entregas desde
+varios hilos en paralelo y falla si se perdió alguna entrega o algún descuento de
+stock, si el stock bajó de 0 o si el journal de stock_movimientos no cierra con el
+stock final.
+
+Uso: python verificar_concurrencia.py [--hilos 8] [--entregas 25]
+"""
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import click
+
+STOCK_MUCHO = 1_000_000
+STOCK_POCO = 5
+
+
+def crear_entregas_en_paralelo(aplicacion, hilos, por_hilo):
+    """Dispara hilos * por_hilo entregas contra /api/entregas y devuelve (problemas, segundos)."""
+    cliente = aplicacion.app.test_client()
+    mucho = cliente.post("/api/productos", json={"nombre": "Mucho stock", "stock": STOCK_MUCHO}).get_json()["id"]
+    poco = cliente.post("/api/productos", json={"nombre": "Poco stock", "stock": STOCK_POCO}).get_json()["id"]
+
+    # La misma pieza en dos líneas: el descuento tiene que sumar ambas.
+    entrega = {
+        "tipo_cliente": "particular",
+        "cliente_nombre": "Prueba concurrencia",
+        "fecha": datetime.now().strftime("%Y-%m-%d"),
+        "piezas": [
+            {"producto_id": mucho, "nombre_pieza": "Mucho stock", "cantidad": 2, "precio_unitario": 10},
+            {"producto_id": mucho, "nombre_pieza": "Mucho stock", "cantidad": 1, "precio_unitario": 10},
+            {"producto_id": poco, "nombre_pieza": "Poco stock", "cantidad": 1, "precio_unitario": 10},
+        ],
+    }
+    fallos = []
+
+    def trabajar():
+        cliente_hilo = aplicacion.app.test_client()
+        for _ in range(por_hilo):
+            resp = cliente_hilo.post("/api/entregas", json=entrega)
+            if resp.status_code != 200:
+                fallos.append(f"{resp.status_code} {resp.get_data(as_text=True)[:200]}")
+
+    inicio = time.perf_counter()
+    trabajadores = [threading.Thread(target=trabajar) for _ in range(hilos)]
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    segundos = time.perf_counter() - inicio
+
+    conn = aplicacion.get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM entregas")
+        n_entregas = cur.fetchone()[0]
+        cur.execute("SELECT id, stock FROM productos")
+        stock = {f["id"]: f["stock"] for f in cur.fetchall()}
+        cur.execute("SELECT producto_id, SUM(delta) FROM stock_movimientos GROUP BY producto_id")
+        journal = {f[0]: f[1] for f in cur.fetchall()}
+    finally:
+        conn.close()
+
+    total = hilos * por_hilo
+    problemas = list(fallos[:5])
+    if n_entregas != total:
+        problemas.append(f"Entregas guardadas: {n_entregas}, esperadas {total}")
+    esperado = {mucho: STOCK_MUCHO - 3 * total, poco: max(0, STOCK_POCO - total)}
+    for pid, valor in esperado.items():
+        if stock.get(pid) != valor:
+            problemas.append(f"Producto {pid}: stock {stock.get(pid)}, esperado {valor}")
+        if journal.get(pid) != stock.get(pid):
+            problemas.append(f"Producto {pid}: journal suma {journal.get(pid)}, stock {stock.get(pid)}")
+    return problemas, segundos
+
+
+@click.command()
+@click.option("--hilos", type=int, default=8, help="Requests en paralelo.")
+@click.option("--entregas", "por_hilo", type=int, default=25, help="Entregas por hilo.")
+def main(hilos, por_hilo):
+    with tempfile.TemporaryDirectory() as tmp:
+        # La app lee la configuración al importarse: primero el entorno, después el import.
+        os.environ["DB_PATH"] = os.path.join(tmp, "concurrencia.db")
+        os.environ["PDF_PRERENDER"] = "0"
+        import app as aplicacion
+
+        try:
+            problemas, segundos = crear_entregas_en_paralelo(aplicacion, hilos, por_hilo)
+        finally:
+            aplicacion.obtener_pool().cerrar_todo()
+
+    for problema in problemas:
+        print(problema)
+    if problemas:
+        raise SystemExit(1)
+    print(f"OK: {hilos * por_hilo} entregas en {hilos} hilos ({segundos:.1f} s), sin descuentos perdidos.")
+
+
+if __name__ == "__main__":
+    main()